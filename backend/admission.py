@@ -0,0 +1,282 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qs
+from starlette.responses import JSONResponse
+
+# Admission control for the HTTP API.
+# Every request is put in a lane before it reaches a handler:
+#   critical  - health checks, alert/notification delivery, websockets, stats:
+#               never throttled or queued
+#   heavy     - endpoints in HEAVY below: a per-endpoint concurrency limit plus
+#               a shared cap on heavy requests overall, so sync handlers cannot
+#               take every threadpool thread
+#   default   - everything else
+# Heavy and default requests also draw from a per-client token bucket (client =
+# the API key when X-API-Key matches API_KEY, else peer address; an unchecked
+# header would let a client mint fresh buckets, or evict others', per request); heavy calls cost more tokens, scaled by the
+# request (hours of COP, seed count, body size). An empty bucket is a 429 with
+# Retry-After set to when the tokens will be there. A heavy request that cannot
+# get a slot within ADMISSION_QUEUE_MS, or finds the endpoint queue full, is
+# shed with a 503 whose Retry-After comes from the endpoint's recent service time.
+#
+# Configuration (env): ADMISSION_ENABLED (1), ADMISSION_RATE (tokens/s per client, 20),
+# ADMISSION_BURST (60), ADMISSION_QUEUE_MS (2000), ADMISSION_MAX_QUEUE (16),
+# ADMISSION_HEAVY_CONCURRENCY (4), ADMISSION_TRUST_FORWARDED (0)
+
+def _env(name, default):
+    try:
+        return type(default)(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+ENABLED = _env("ADMISSION_ENABLED", "1") not in ("0", "false", "no")
+RATE = _env("ADMISSION_RATE", 20.0)
+BURST = _env("ADMISSION_BURST", 60.0)
+QUEUE_SEC = _env("ADMISSION_QUEUE_MS", 2000.0) / 1000.0
+MAX_QUEUE = _env("ADMISSION_MAX_QUEUE", 16)
+HEAVY_CONCURRENCY = _env("ADMISSION_HEAVY_CONCURRENCY", 4)
+TRUST_FORWARDED = _env("ADMISSION_TRUST_FORWARDED", "0") in ("1", "true", "yes")
+API_KEY = os.getenv("API_KEY")
+MAX_CLIENTS = 10000
+
+CRITICAL = ("/health", "/alert-deliveries", "/notify/", "/ws", "/ws/", "/admission/stats", "/cache/stats")
+
+def _qint(query, name, default):
+    try:
+        return int(query.get(name, [default])[0])
+    except Exception:
+        return default
+
+def _body_cost(per_kb):
+    return lambda query, length: 1.0 + length / 1024.0 / per_kb
+
+# path -> (concurrency, cost(query, content_length))
+HEAVY = {
+    "/api/ai-analyst": (2, lambda q, n: 5.0),
+    "/cop/geojson": (2, lambda q, n: 1.0 + _qint(q, "hours", 168) / 24.0),
+    "/coa/analyze": (4, _body_cost(2)),
+    "/coa/analyze_batch": (2, _body_cost(1)),
+    "/isr/assets/batch_task": (2, _body_cost(2)),
+    "/perf/seed_many": (1, lambda q, n: 1.0 + _qint(q, "count", 1000) / 10000.0),
+    "/seed": (1, lambda q, n: 10.0),
+    "/heatmap": (4, lambda q, n: 2.0),
+    "/replay/frames": (4, lambda q, n: 2.0),
+    "/geocode/batch": (4, _body_cost(4)),
+}
+
+def lane_of(path):
+    if any(path == p or (p.endswith("/") and path.startswith(p)) for p in CRITICAL):
+        return "critical"
+    return "heavy" if path in HEAVY else "default"
+
+class Slots:
+    """FIFO concurrency limit for coroutines on one event loop."""
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self._waiters = deque()
+
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, timeout):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), max(0.0, timeout))
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                self.release()  # granted just as we gave up; pass it on
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+        finally:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+            if not fut.done():
+                fut.cancel()
+
+    def release(self):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(True)  # hand the slot over; active stays the same
+                return
+        self.active -= 1
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, now):
+        self.tokens = BURST
+        self.stamp = now
+
+    def take(self, cost, now):
+        """0 if admitted, else seconds until cost tokens are available."""
+        self.tokens = min(BURST, self.tokens + (now - self.stamp) * RATE)
+        self.stamp = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / RATE
+
+class AdmissionController:
+    def __init__(self):
+        self.enabled = ENABLED
+        self.slots = {path: Slots(limit) for path, (limit, _) in HEAVY.items()}
+        self.heavy = Slots(HEAVY_CONCURRENCY)
+        self.buckets = {}
+        self.metrics = {}
+        self.service_ms = {}  # path -> EWMA of heavy request duration
+        self._lock = threading.Lock()
+
+    def _count(self, path, field, value=1):
+        with self._lock:
+            m = self.metrics.get(path)
+            if m is None:
+                m = self.metrics[path] = {"admitted": 0, "throttled": 0, "shed": 0, "queued": 0, "in_flight": 0,
+                                          "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+            if field == "wait_ms":
+                m["wait_ms_total"] += value
+                m["wait_ms_max"] = max(m["wait_ms_max"], value)
+            else:
+                m[field] += value
+
+    def client_of(self, scope):
+        forwarded = None
+        for k, v in scope.get("headers") or []:
+            # Same check as main.require_api_key; any other key value is just a header
+            if API_KEY and k == b"x-api-key" and v.decode("latin-1") == API_KEY:
+                return "key:" + API_KEY
+            if TRUST_FORWARDED and k == b"x-forwarded-for" and v and forwarded is None:
+                forwarded = v.decode("latin-1").split(",")[0].strip()
+        if forwarded:
+            return forwarded
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def cost(self, scope):
+        path = scope.get("path", "")
+        spec = HEAVY.get(path)
+        if spec is None:
+            return 1.0
+        length = 0
+        for k, v in scope.get("headers") or []:
+            if k == b"content-length":
+                try:
+                    length = int(v)
+                except Exception:
+                    pass
+        try:
+            cost = float(spec[1](parse_qs(scope.get("query_string", b"").decode("latin-1")), length))
+        except Exception:
+            cost = 1.0
+        # A single request must always be admissible on a full bucket
+        return min(max(1.0, cost), BURST)
+
+    def throttle(self, scope):
+        """Seconds the client must wait, 0 when admitted."""
+        now = time.monotonic()
+        client = self.client_of(scope)
+        with self._lock:
+            b = self.buckets.get(client)
+            if b is None:
+                if len(self.buckets) >= MAX_CLIENTS:
+                    # Refilled buckets carry no state worth keeping
+                    full = [c for c, x in self.buckets.items() if x.tokens + (now - x.stamp) * RATE >= BURST]
+                    for c in full or list(self.buckets)[:MAX_CLIENTS // 10]:
+                        del self.buckets[c]
+                b = self.buckets[client] = TokenBucket(now)
+            return b.take(self.cost(scope), now)
+
+    def retry_after(self, path):
+        slots = self.slots[path]
+        with self._lock:
+            ms = self.service_ms.get(path, 1000.0)
+        return max(1, math.ceil(ms / 1000.0 * (slots.waiting() + 1) / slots.limit))
+
+    async def admit_heavy(self, path):
+        """Acquire the endpoint slot and a heavy slot within the queue budget; None when shed."""
+        slots = self.slots[path]
+        if slots.waiting() >= MAX_QUEUE or self.heavy.waiting() >= MAX_QUEUE * 2:
+            return None
+        start = time.monotonic()
+        queued = slots.active >= slots.limit or self.heavy.active >= self.heavy.limit
+        if queued:
+            self._count(path, "queued")
+        if not await slots.acquire(QUEUE_SEC):
+            return None
+        if not await self.heavy.acquire(QUEUE_SEC - (time.monotonic() - start)):
+            slots.release()
+            return None
+        return (time.monotonic() - start) * 1000.0
+
+    def finished(self, path, started):
+        ms = (time.monotonic() - started) * 1000.0
+        with self._lock:
+            prev = self.service_ms.get(path)
+            self.service_ms[path] = ms if prev is None else 0.8 * prev + 0.2 * ms
+
+    def stats(self):
+        with self._lock:
+            endpoints = {p: {**m, "service_ms": round(self.service_ms.get(p, 0.0), 1)} for p, m in self.metrics.items()}
+            clients = len(self.buckets)
+        return {"enabled": self.enabled, "rate": RATE, "burst": BURST, "queue_ms": QUEUE_SEC * 1000.0,
+                "heavy": {"limit": self.heavy.limit, "active": self.heavy.active, "waiting": self.heavy.waiting()},
+                "limits": {p: {"limit": s.limit, "active": s.active, "waiting": s.waiting()} for p, s in self.slots.items()},
+                "clients": clients, "endpoints": endpoints}
+
+admission = AdmissionController()
+
+class AdmissionMiddleware:
+    """ASGI middleware applying `controller` to HTTP requests."""
+
+    def __init__(self, app, controller=admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        ctl = self.controller
+        if scope["type"] != "http" or not ctl.enabled or scope.get("method") == "OPTIONS":
+            return await self.app(scope, receive, send)
+        path = scope.get("path", "")
+        lane = lane_of(path)
+        if lane == "critical":
+            return await self.app(scope, receive, send)
+        # Default-lane paths are aggregated so path parameters do not grow the metrics
+        key = path if lane == "heavy" else "default"
+        wait = ctl.throttle(scope)
+        if wait > 0:
+            ctl._count(key, "throttled")
+            secs = max(1, math.ceil(wait))
+            resp = JSONResponse({"detail": "rate limit exceeded", "retry_after": secs}, status_code=429, headers={"Retry-After": str(secs)})
+            return await resp(scope, receive, send)
+        if lane != "heavy":
+            ctl._count(key, "admitted")
+            return await self.app(scope, receive, send)
+        waited = await ctl.admit_heavy(path)
+        if waited is None:
+            ctl._count(path, "shed")
+            secs = ctl.retry_after(path)
+            resp = JSONResponse({"detail": "server busy", "retry_after": secs}, status_code=503, headers={"Retry-After": str(secs)})
+            return await resp(scope, receive, send)
+        ctl._count(path, "admitted")
+        ctl._count(path, "wait_ms", waited)
+        ctl._count(path, "in_flight")
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ctl.finished(path, started)
+            ctl._count(path, "in_flight", -1)
+            ctl.heavy.release()
+            ctl.slots[path].release()
@@ -0,0 +1,108 @@
+from bisect import bisect_right
+from math import floor
+from database import DataEvent, Anomaly, AlertRule, AlertDelivery
+
+# Alert-rule matching index.
+# Rules are bucketed by (source, spatial cell); a rule without a source or a
+# bbox lands in the wildcard bucket for that dimension. Inside a bucket rules
+# are kept sorted by severity_threshold, so a bisect yields exactly the rules
+# whose threshold the anomaly meets. Matching an anomaly touches at most four
+# buckets instead of every rule.
+
+CELL_DEG = 5.0
+MAX_RULE_CELLS = 64  # rules spanning more cells than this are treated as global
+
+def in_bbox(lat, lon, r: AlertRule):
+    try:
+        if None in (lat, lon):
+            return False
+        if r.min_lat is None or r.min_lon is None or r.max_lat is None or r.max_lon is None:
+            return True
+        return (r.min_lat <= lat <= r.max_lat) and (r.min_lon <= lon <= r.max_lon)
+    except Exception:
+        return False
+
+def _cell(lat, lon, cell_deg=CELL_DEG):
+    return (int(floor(lat / cell_deg)), int(floor(lon / cell_deg)))
+
+def _rule_cells(r: AlertRule, cell_deg=CELL_DEG):
+    if r.min_lat is None or r.min_lon is None or r.max_lat is None or r.max_lon is None:
+        return None
+    lo = _cell(r.min_lat, r.min_lon, cell_deg)
+    hi = _cell(r.max_lat, r.max_lon, cell_deg)
+    n = (hi[0] - lo[0] + 1) * (hi[1] - lo[1] + 1)
+    if n <= 0 or n > MAX_RULE_CELLS:
+        return None
+    return [(i, j) for i in range(lo[0], hi[0] + 1) for j in range(lo[1], hi[1] + 1)]
+
+class RuleIndex:
+    def __init__(self, rules, cell_deg=CELL_DEG):
+        self.cell_deg = cell_deg
+        self.size = 0
+        buckets = {}
+        for r in rules:
+            cells = _rule_cells(r, cell_deg)
+            for c in (cells or [None]):
+                buckets.setdefault((r.source or None, c), []).append(r)
+            self.size += 1
+        self._buckets = {}
+        for k, rs in buckets.items():
+            rs.sort(key=lambda x: x.severity_threshold or 0)
+            self._buckets[k] = ([x.severity_threshold or 0 for x in rs], rs)
+
+    def match(self, source, lat, lon, severity, confidence):
+        if lat is None or lon is None:
+            return []
+        cell = _cell(lat, lon, self.cell_deg)
+        sev = severity or 0
+        conf = confidence or 0.0
+        out = []
+        seen = set()
+        for key in ((source, cell), (source, None), (None, cell), (None, None)):
+            b = self._buckets.get(key)
+            if not b:
+                continue
+            thresholds, rs = b
+            for r in rs[:bisect_right(thresholds, sev)]:
+                if r.id in seen:
+                    continue
+                if conf < (r.min_confidence or 0.0):
+                    continue
+                if not in_bbox(lat, lon, r):
+                    continue
+                seen.add(r.id)
+                out.append(r)
+        return out
+
+def record_alert_deliveries(session, lo_id: int, hi_id: int):
+    """
+    Match anomalies with lo_id < id <= hi_id against all alert rules and add
+    a pending AlertDelivery ledger row for each (rule, anomaly) pair that has
+    not been recorded yet. Returns [(delivery, rule, anomaly, event)].
+    """
+    rules = session.query(AlertRule).all()
+    if not rules or hi_id <= lo_id:
+        return []
+    index = RuleIndex(rules)
+    rows = session.query(Anomaly, DataEvent).join(DataEvent, DataEvent.id == Anomaly.event_id).filter(
+        Anomaly.id > lo_id, Anomaly.id <= hi_id
+    ).all()
+    matches = []
+    for a, ev in rows:
+        for r in index.match(ev.source, ev.latitude, ev.longitude, a.severity, ev.confidence):
+            matches.append((r, a, ev))
+    if not matches:
+        return []
+    done = set(
+        session.query(AlertDelivery.rule_id, AlertDelivery.anomaly_id).filter(
+            AlertDelivery.anomaly_id.in_(set(a.id for _, a, _ in matches))
+        ).all()
+    )
+    out = []
+    for r, a, ev in matches:
+        if (r.id, a.id) in done:
+            continue
+        d = AlertDelivery(rule_id=r.id, anomaly_id=a.id, status="pending")
+        session.add(d)
+        out.append((d, r, a, ev))
+    return out
@@ -0,0 +1,291 @@
+import json
+import os
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+from math import cos, radians
+from sqlalchemy import and_, or_, not_, func
+from database import DataEvent, Anomaly, Forecast, get_data_versions, hour_bucket, as_hour
+import forecast
+
+# Query planner for /api/ai-analyst.
+# parse_intent() turns the free-text question into a small intent dict
+# (window, sources, bbox, near/radius, severity, confidence, kind).
+# compile_filters() turns that into SQL predicates on DataEvent, and each
+# answer kind runs one aggregate query (GROUP BY / COUNT / ORDER BY ... LIMIT)
+# joined on anomalies.event_id, so nothing proportional to the table size is
+# loaded into Python. Radius filters use an indexable lat/lon box plus an
+# equirectangular distance test, which is exact enough at analyst radii.
+#
+# Results are cached under canonical_key(intent), so rewordings of the same
+# question share an entry. Answers are rendered from additive counters; when
+# the clock step or the data version moves, the counters are slid forward by
+# subtracting rows that left the window and adding rows past the last seen
+# ids instead of being recomputed over the whole window.
+#
+# Configuration (env): ANALYST_WINDOW_STEP_SEC (60), ANALYST_CACHE_TTL (3600)
+
+KM_PER_DEG = 111.195
+WINDOW_STEP_SEC = float(os.getenv("ANALYST_WINDOW_STEP_SEC", "60") or 60)
+CACHE_TTL_SEC = float(os.getenv("ANALYST_CACHE_TTL", "3600") or 3600)
+stats = {"hits": 0, "incremental": 0, "full": 0}
+SOURCES = ["adsb", "ais", "usgs_seismic", "noaa_weather", "nasa_eonet", "gdacs_disasters"]
+SOURCE_ALIASES = {
+    "adsb": ["ads-b", "aircraft"],
+    "ais": ["vessel", "maritime"],
+    "usgs_seismic": ["usgs", "seismic", "earthquake"],
+    "noaa_weather": ["noaa", "weather", "storm", "wind"],
+    "nasa_eonet": ["eonet", "nasa events"],
+    "gdacs_disasters": ["gdacs", "disaster"],
+}
+
+def parse_intent(text: str, now=None):
+    q = " ".join((text or "").lower().split())
+    now = now or datetime.utcnow()
+    intent = {"text": q, "bbox": None, "near": None, "min_sev": None, "min_conf": None}
+    m = re.search(r"bbox[:=]\s*([\-0-9\.]+),([\-0-9\.]+),([\-0-9\.]+),([\-0-9\.]+)", q)
+    if m:
+        try:
+            intent["bbox"] = tuple(map(float, m.groups()))
+        except Exception:
+            pass
+    hours = 24
+    for pattern, mult in ((r"last\s*(\d+)\s*hour", 1), (r"last\s*(\d+)\s*day", 24), (r"last\s*(\d+)\s*week", 24 * 7)):
+        m = re.search(pattern, q)
+        if m:
+            hours = int(m.group(1)) * mult
+            break
+    intent["hours"] = hours
+    intent["start"] = now - timedelta(hours=hours)
+    m = re.search(r"severity\s*[>=]+\s*(\d+)", q)
+    if m:
+        intent["min_sev"] = int(m.group(1))
+    m = re.search(r"(min\s*conf|confidence\s*[>=]+)\s*(\d+(?:\.\d+)?)", q)
+    if m:
+        intent["min_conf"] = float(m.group(2))
+    m = re.search(r"near[:=]\s*([\-0-9\.]+)\s*,\s*([\-0-9\.]+)", q)
+    if m:
+        try:
+            r = re.search(r"radius[:=]\s*(\d+)\s*km", q)
+            intent["near"] = (float(m.group(1)), float(m.group(2)), float(r.group(1)) if r else 50.0)
+        except Exception:
+            pass
+    srcs = [s for s in SOURCES if s in q]
+    for k, words in SOURCE_ALIASES.items():
+        if any(t in q for t in words) and k not in srcs:
+            srcs.append(k)
+    intent["sources"] = sorted(set(srcs))
+    if "predict" in q:
+        kind = "predict"
+    elif any(t in q for t in ["how many", "count", "number"]):
+        kind = "count_by_source" if "by source" in q else "count"
+    elif any(t in q for t in ["hotspot", "where", "locations"]):
+        kind = "hotspot"
+    elif any(t in q for t in ["list", "show", "give"]):
+        kind = "list"
+    elif any(t in q for t in ["trend", "timeline", "over time"]):
+        kind = "trend"
+    elif any(t in q for t in ["summary", "brief"]):
+        kind = "summary"
+    else:
+        kind = "scope"
+    intent["kind"] = kind
+    return intent
+
+def radius_clause(lat0, lon0, rkm, lat_col=DataEvent.latitude, lon_col=DataEvent.longitude):
+    """Indexable box plus equirectangular distance; handles boxes crossing the antimeridian."""
+    dlat = rkm / KM_PER_DEG
+    k = max(cos(radians(lat0)), 1e-6)
+    dlon = min(180.0, dlat / k)
+    shifts = [0.0]
+    if lon0 - dlon < -180:
+        shifts.append(-360.0)
+    if lon0 + dlon > 180:
+        shifts.append(360.0)
+    parts = []
+    for sh in shifts:
+        c = lon0 + sh
+        parts.append(and_(
+            lat_col.between(lat0 - dlat, lat0 + dlat),
+            lon_col.between(c - dlon, c + dlon),
+            (lat_col - lat0) * (lat_col - lat0) + (lon_col - c) * (lon_col - c) * (k * k) <= dlat * dlat,
+        ))
+    return or_(*parts) if len(parts) > 1 else parts[0]
+
+def compile_filters(intent, start=None):
+    """Predicates on DataEvent and on Anomaly (the latter assume a join to DataEvent)."""
+    start = intent["start"] if start is None else start
+    ev = [DataEvent.timestamp >= start]
+    if intent["bbox"]:
+        min_lat, min_lon, max_lat, max_lon = intent["bbox"]
+        ev += [DataEvent.latitude.between(min_lat, max_lat), DataEvent.longitude.between(min_lon, max_lon)]
+    if intent["near"]:
+        ev.append(radius_clause(*intent["near"]))
+    if intent["sources"]:
+        ev.append(DataEvent.source.in_(intent["sources"]))
+    an = [Anomaly.timestamp >= start]
+    if len(ev) > 1 or intent["min_conf"] is not None:
+        # Only tie anomalies to in-window events when the question narrows the scope
+        an += ev
+    if intent["min_sev"] is not None:
+        an.append(Anomaly.severity >= intent["min_sev"])
+    if intent["min_conf"] is not None:
+        an.append(DataEvent.confidence >= intent["min_conf"])
+    return ev, an
+
+def canonical_key(intent):
+    """Stable cache key: same question, same key, regardless of wording, case or order."""
+    r4 = lambda t: [round(v, 4) for v in t] if t else None
+    return json.dumps({
+        "kind": intent["kind"], "sources": intent["sources"], "hours": intent["hours"],
+        "bbox": r4(intent["bbox"]), "near": r4(intent["near"]),
+        "min_sev": intent["min_sev"], "min_conf": intent["min_conf"],
+    }, sort_keys=True, separators=(",", ":"))
+
+def _aggregates(session, kind):
+    """Additive (name, side, group-by columns) counters each answer kind is rendered from."""
+    hour = hour_bucket(session, Anomaly.timestamp)
+    if kind in ("predict", "list"):
+        return []
+    if kind == "count_by_source":
+        return [("ev_src", "ev", [DataEvent.source]), ("an_src", "an", [DataEvent.source])]
+    if kind == "hotspot":
+        return [("cells5", "an", [func.round(DataEvent.latitude / 5) * 5, func.round(DataEvent.longitude / 5) * 5])]
+    if kind == "trend":
+        return [("hours", "an", [hour])]
+    if kind == "summary":
+        return [("ev_src", "ev", [DataEvent.source]), ("sev", "an", [Anomaly.severity])]
+    return [("events", "ev", []), ("anomalies", "an", [])]
+
+def _count(session, specs, ev_f, an_f):
+    out = {}
+    for name, side, cols in specs:
+        if side == "ev":
+            q = session.query(*cols, func.count(DataEvent.id)).filter(*ev_f)
+        else:
+            q = session.query(*cols, func.count(Anomaly.id)).join(DataEvent, DataEvent.id == Anomaly.event_id).filter(*an_f)
+        if cols:
+            q = q.group_by(*cols)
+        out[name] = Counter({tuple(r[:-1]): r[-1] for r in q.all() if r[-1]})
+    return out
+
+def _slide(session, intent, specs, old, last_ids):
+    """Move counters computed for old['start'] / old ids to intent['start'] / last_ids.
+
+    Rows are append-only, so the difference is exactly the old rows that fell
+    out of the window plus the new rows (by id) that fall inside it."""
+    (old_e, old_a), (new_e, new_a) = old["last_ids"], last_ids
+    ev0, an0 = compile_filters(intent, old["start"])
+    ev1, an1 = compile_filters(intent, intent["start"])
+    gone = _count(session, specs,
+                  [and_(*ev0), not_(and_(*ev1)), DataEvent.id <= old_e],
+                  [and_(*an0), not_(and_(*an1)), Anomaly.id <= old_a])
+    added = _count(session, specs,
+                   ev1 + [DataEvent.id > old_e, DataEvent.id <= new_e],
+                   an1 + [Anomaly.id > old_a, Anomaly.id <= new_a])
+    out = {}
+    for name, _, _ in specs:
+        c = Counter(old["counters"][name])
+        c.update(added[name])
+        c.subtract(gone[name])
+        out[name] = Counter({k: v for k, v in c.items() if v > 0})
+    return out
+
+def _ser_e(e):
+    return {"id": e.id, "source": e.source, "timestamp": e.timestamp.isoformat() if e.timestamp else None, "latitude": e.latitude, "longitude": e.longitude}
+
+def _ser_a(a):
+    return {"id": a.id, "event_id": a.event_id, "type": a.type, "severity": a.severity, "timestamp": a.timestamp.isoformat() if a.timestamp else None}
+
+def _render(session, intent, counters, ev_f, an_f):
+    kind = intent["kind"]
+    evq = lambda *cols: session.query(*cols).filter(*ev_f)
+    anq = lambda *cols: session.query(*cols).join(DataEvent, DataEvent.id == Anomaly.event_id).filter(*an_f)
+    sample_events = evq(DataEvent).order_by(DataEvent.id).limit(50).all()
+    sample_anoms = anq(Anomaly).order_by(Anomaly.id).limit(50).all()
+    out_lines = []
+    result = {"type": "analysis"}
+
+    if kind == "predict":
+        # Forecasts are fitted in the background (forecast.py); answering is a lookup
+        cell_f = []
+        if intent["bbox"]:
+            min_lat, min_lon, max_lat, max_lon = intent["bbox"]
+            cell_f += [Forecast.latitude.between(min_lat, max_lat), Forecast.longitude.between(min_lon, max_lon)]
+        if intent["near"]:
+            cell_f.append(radius_clause(*intent["near"], lat_col=Forecast.latitude, lon_col=Forecast.longitude))
+        preds, pred_points = forecast.lookup(session, intent["sources"], cell_f)
+        horizon_h = preds[0]["next_hours"] if preds else forecast.HORIZON_H
+        out_lines.append(f"Predicted locations for next {horizon_h} hours:")
+        if not preds:
+            out_lines.append("- No forecasts available yet")
+        for p in sorted(pred_points, key=lambda x: -x["probability"])[:10]:
+            out_lines.append(f"- {p['name']} ({p['source'].upper()}) prob={(p['probability']*100):.0f}%")
+        result.update({"predictions": preds, "predictions_points": pred_points})
+    elif kind == "count_by_source":
+        ev_src = {k[0]: v for k, v in counters["ev_src"].items()}
+        an_src = {k[0]: v for k, v in counters["an_src"].items()}
+        out_lines.append("Counts by source:")
+        for s in sorted(k for k in (ev_src.keys() | an_src.keys()) if k is not None):
+            out_lines.append(f"- {s.upper()} events={ev_src.get(s,0)} anomalies={an_src.get(s,0)}")
+    elif kind == "count":
+        out_lines.append(f"Events={counters['events'][()]} anomalies={counters['anomalies'][()]}")
+    elif kind == "hotspot":
+        cells = [(k, c) for k, c in counters["cells5"].items() if k[0] is not None and k[1] is not None]
+        out_lines.append("Top hotspots:")
+        for (la, lo), c in sorted(cells, key=lambda x: (-x[1], x[0]))[:5]:
+            out_lines.append(f"- ({int(la)},{int(lo)}) anomalies={c}")
+    elif kind == "list":
+        out_lines.append("Top anomalies:")
+        for a, ev in anq(Anomaly, DataEvent).order_by(Anomaly.severity.desc(), Anomaly.id).limit(10).all():
+            out_lines.append(f"- {(ev.source or '').upper()} sev={a.severity} at ({ev.latitude},{ev.longitude}) {ev.timestamp.isoformat() if ev.timestamp else ''}")
+    elif kind == "trend":
+        out_lines.append("Hourly anomaly trend:")
+        for b, c in sorted((as_hour(k[0]), c) for k, c in counters["hours"].items()):
+            out_lines.append(f"- {b.isoformat()} count={c}")
+    elif kind == "summary":
+        by_src = sorted((k[0] or "unknown", c) for k, c in counters["ev_src"].items())
+        sev_hist = sorted(((k[0], c) for k, c in counters["sev"].items()), key=lambda x: (x[0] is None, x[0] or 0))
+        out_lines.append(f"Summary: events={sum(c for _, c in by_src)} anomalies={sum(c for _, c in sev_hist)} window={intent['hours']}h")
+        for src, c in by_src:
+            out_lines.append(f"- {src.upper()} events={c}")
+        if sev_hist:
+            out_lines.append("- Severity: " + ", ".join(f"{k}:{v}" for k, v in sev_hist))
+    else:
+        out_lines.append(f"Scope: sources={[s.upper() for s in intent['sources']] or 'ALL'} window={intent['hours']}h events={counters['events'][()]} anomalies={counters['anomalies'][()]}")
+        for e in sample_events[:10]:
+            out_lines.append(f"- {(e.source or '').upper()} id={e.id} at ({e.latitude},{e.longitude}) {e.timestamp.isoformat() if e.timestamp else ''}")
+
+    result.update({"output": "\n".join(out_lines), "events": [_ser_e(e) for e in sample_events], "anomalies": [_ser_a(a) for a in sample_anoms]})
+    return result
+
+def run_query(session, text, now=None, cache=None):
+    # Snap the clock so repeats within one step share a window and a cache entry
+    step = max(1, int(WINDOW_STEP_SEC))
+    now = now or datetime.utcnow()
+    now = now - timedelta(seconds=(now - datetime(1970, 1, 1)).total_seconds() % step)
+    intent = parse_intent(text, now)
+    key = "analyst:" + canonical_key(intent)
+    versions = get_data_versions(session, "events", "anomalies", "forecasts")
+    state = cache.get(key, shared=False) if cache is not None else None
+    if state is not None and state["versions"] == versions and state["start"] == intent["start"]:
+        stats["hits"] += 1
+        return state["result"]
+
+    # Pin the row set by id so rows committed mid-query are picked up by the next slide, not twice
+    last_ids = (session.query(func.max(DataEvent.id)).scalar() or 0, session.query(func.max(Anomaly.id)).scalar() or 0)
+    specs = _aggregates(session, intent["kind"])
+    ev_f, an_f = compile_filters(intent)
+    ev_f = ev_f + [DataEvent.id <= last_ids[0]]
+    an_f = an_f + [Anomaly.id <= last_ids[1]]
+    if state is not None and state["start"] <= intent["start"] < state["start"] + timedelta(hours=intent["hours"]):
+        counters = _slide(session, intent, specs, state, last_ids)
+        stats["incremental"] += 1
+    else:
+        counters = _count(session, specs, ev_f, an_f)
+        stats["full"] += 1
+    result = _render(session, intent, counters, ev_f, an_f)
+    if cache is not None:
+        cache.set(key, {"versions": versions, "start": intent["start"], "last_ids": last_ids,
+                        "counters": counters, "result": result}, CACHE_TTL_SEC, share=False)
+    return result
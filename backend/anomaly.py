@@ -1,82 +1,125 @@
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
-from database import engine, DataEvent, Anomaly, AlertRule
-from sklearn.ensemble import IsolationForest
+from database import engine, DataEvent, Anomaly, AlertRule, DetectorRule, DetectorState, bump_data_version
+from rules import evaluate_rules, seed_default_rules
+from alerting import record_alert_deliveries
+from correlation import correlate_events, incident_anomaly
+from notify import enqueue_email, digest_interval_sec, get_dispatcher
+from datetime import datetime
 import numpy as np
 import schedule
 import time
+import os
 
 Session = sessionmaker(bind=engine)
 
+def _cursor(session, name):
+    state = session.get(DetectorState, name)
+    if state is None:
+        state = DetectorState(name=name, last_id=0)
+        session.add(state)
+        session.flush()
+    return state
+
 def detect_anomalies():
     with Session() as session:
-        events = session.query(DataEvent).all()
-        if not events:
-            print("Anomaly detection: no events available yet")
-            return
-        
-        # Prepare data for ML: lat, lon
-        coords = [[e.latitude, e.longitude] for e in events if e.latitude is not None and e.longitude is not None]
-        data = np.array(coords)
-        if len(data) < 2:
-            print("Anomaly detection: insufficient geospatial data for IsolationForest")
-            return
-        
-        model = IsolationForest(contamination=0.1)
-        model.fit(data)
-        preds = model.predict(data)
-        scores = model.decision_function(data)
-        
-        for i, pred in enumerate(preds):
-            if pred == -1:  # Anomaly
-                # Derive severity from anomaly score (more negative -> higher severity)
-                score = float(scores[i])
-                sev = int(np.clip(10 * max(0.0, -score), 1, 9))
-                anomaly = Anomaly(
-                    event_id=events[i].id,
-                    type="geo_spatial",
-                    severity=sev,
-                    description=f"Detected geospatial anomaly (algo=IsolationForest, score={score:.4f})",
-                    timestamp=events[i].timestamp,
-                )
-                session.add(anomaly)
-        
-        # Rule-based: high seismic if mag > 4
-        for event in events:
-            if event.source == "usgs_seismic":
-                mag = event.data.get('properties', {}).get('mag') if isinstance(event.data, dict) else None
-                if mag and mag > 4:
-                    anomaly = Anomaly(
-                        event_id=event.id,
-                        type="seismic_high",
-                        severity=7,
-                        description=f"High magnitude earthquake (rule=mag>4, mag={mag})",
-                        timestamp=event.timestamp,
-                    )
-                    session.add(anomaly)
-        
+        state = session.get(DetectorState, "detector")
+        if state is None:
+            # First run: install the default rule set once so deleted rules stay deleted
+            seed_default_rules(session)
+            state = _cursor(session, "detector")
+        if session.get(DetectorState, "alerts") is None:
+            # Only anomalies created from now on are alerted; history is not replayed
+            _cursor(session, "alerts").last_id = session.query(func.max(Anomaly.id)).scalar() or 0
+        lo = state.last_id or 0
+        hi = session.query(func.max(DataEvent.id)).scalar() or 0
+        if hi <= lo:
+            print("Anomaly detection: no new events since last run")
+        else:
+            _detect_batch(session, lo, hi)
+            bump_data_version(session, "anomalies", "incidents")
+            state.last_id = hi
+            state.updated_at = datetime.utcnow()
+        session.commit()
+
+        # Evaluate alert rules against the new anomalies; the ledger makes delivery exactly-once
+        alerts = _cursor(session, "alerts")
+        hi_anom = session.query(func.max(Anomaly.id)).scalar() or 0
+        deliveries = record_alert_deliveries(session, alerts.last_id or 0, hi_anom)
+        for d, r, a, ev in deliveries:
+            # Email goes to the outbox in the same transaction as the ledger row; the row stays
+            # 'queued' until the dispatcher reports the email sent or failed
+            n = _send_email_alert(session, r, a, ev)
+            if n is not None:
+                session.flush()
+                d.notification_id = n.id
+                d.status = "queued"
+            else:
+                # WebSocket only: clients in every process get it from the hub feeder, which tails the ledger
+                d.status = "sent"
+                d.delivered_at = datetime.utcnow()
+        alerts.last_id = hi_anom
+        alerts.updated_at = datetime.utcnow()
         session.commit()
+        if deliveries:
+            get_dispatcher().wake()
+
+# Detection stages, split out so benchmark.py can time each one in isolation
+def extract_features(rows):
+    return np.array([[r.latitude, r.longitude] for r in rows], dtype=np.float64).reshape(-1, 2)
+
+def fit_model(data):
+    # Imported here so importing this module (API process, benchmark setup) does not load scikit-learn
+    from sklearn.ensemble import IsolationForest
+    model = IsolationForest(contamination=0.1)
+    model.fit(data)
+    return model
+
+def score_model(model, data):
+    return model.predict(data), model.decision_function(data)
+
+def insert_anomalies(session, rows, preds, scores, lo: int):
+    created = 0
+    for i, pred in enumerate(preds):
+        if pred == -1 and rows[i].id > lo:  # Anomaly in the new batch
+            # Derive severity from anomaly score (more negative -> higher severity)
+            score = float(scores[i])
+            sev = int(np.clip(10 * max(0.0, -score), 1, 9))
+            anomaly = Anomaly(
+                event_id=rows[i].id,
+                type="geo_spatial",
+                severity=sev,
+                description=f"Detected geospatial anomaly (algo=IsolationForest, score={score:.4f})",
+                timestamp=rows[i].timestamp,
+            )
+            session.add(anomaly)
+            created += 1
+    return created
+
+def _detect_batch(session, lo: int, hi: int):
+    # Prepare data for ML: lat, lon (fit on history, flag only new events)
+    rows = session.query(DataEvent.id, DataEvent.latitude, DataEvent.longitude, DataEvent.timestamp).filter(
+        DataEvent.id <= hi, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)
+    ).all()
+    data = extract_features(rows)
+    if len(data) < 2:
+        print("Anomaly detection: insufficient geospatial data for IsolationForest")
+    else:
+        model = fit_model(data)
+        preds, scores = score_model(model, data)
+        insert_anomalies(session, rows, preds, scores, lo)
 
-        # Evaluate alert rules and notify
-        rules = session.query(AlertRule).all()
-        if rules:
-            # Map event id to event for quick lookup
-            ev_by_id = {e.id: e for e in events}
-            for a in session.query(Anomaly).order_by(Anomaly.id.desc()).limit(50).all():
-                ev = ev_by_id.get(a.event_id)
-                if not ev:
-                    continue
-                for r in rules:
-                    if r.source and ev.source != r.source:
-                        continue
-                    if a.severity < (r.severity_threshold or 0):
-                        continue
-                    if (ev.confidence or 0.0) < (r.min_confidence or 0.0):
-                        continue
-                    lat, lon = ev.latitude, ev.longitude
-                    if not _in_bbox(lat, lon, r):
-                        continue
-                    _send_email_alert(r, a, ev)
-                    _broadcast_alert(a, ev)
+    # Rule-based: declarative detector rules evaluated in SQL over the new id range
+    rules = session.query(DetectorRule).filter(DetectorRule.enabled.isnot(False)).all()
+    evaluate_rules(session, rules, lo, hi)
+
+    # Cross-source correlation: new multi-source incidents surface as anomalies
+    try:
+        with session.begin_nested():
+            for inc, ev_id in correlate_events(session, lo, hi):
+                incident_anomaly(session, inc, ev_id)
+    except Exception as e:
+        print(f"Correlation failed: {e}")
 
 def schedule_detection():
     schedule.every(60).seconds.do(detect_anomalies)
@@ -84,48 +127,17 @@ def schedule_detection():
         schedule.run_pending()
         time.sleep(1)
 
-def _in_bbox(lat, lon, r: AlertRule):
-    try:
-        if None in (lat, lon):
-            return False
-        if r.min_lat is None or r.min_lon is None or r.max_lat is None or r.max_lon is None:
-            return True
-        return (r.min_lat <= lat <= r.max_lat) and (r.min_lon <= lon <= r.max_lon)
-    except Exception:
-        return False
-
-def _send_email_alert(r: AlertRule, a: Anomaly, ev: DataEvent):
-    try:
-        import os, smtplib
-        from email.mime.text import MIMEText
-        host = os.getenv("SMTP_HOST")
-        port = int(os.getenv("SMTP_PORT", "587"))
-        user = os.getenv("SMTP_USERNAME")
-        pwd = os.getenv("SMTP_PASSWORD")
-        from_addr = os.getenv("EMAIL_FROM")
-        to_addr = r.email_to or os.getenv("EMAIL_TO_DEFAULT")
-        if not (host and user and pwd and from_addr and to_addr):
-            return
-        msg = MIMEText(f"Anomaly {a.type} sev={a.severity} src={ev.source} at ({ev.latitude},{ev.longitude}) {a.timestamp}")
-        msg["Subject"] = f"RTAIP Alert: {a.type}"
-        msg["From"] = from_addr
-        msg["To"] = to_addr
-        server = smtplib.SMTP(host, port)
-        server.starttls()
-        server.login(user, pwd)
-        server.sendmail(from_addr, [to_addr], msg.as_string())
-        server.quit()
-    except Exception:
-        pass
-
-def _broadcast_alert(a: Anomaly, ev: DataEvent):
-    try:
-        # Import late to avoid circular init
-        from main import broadcast_alert
-        text = f"ANOMALY {a.type} sev={a.severity} src={ev.source} at ({ev.latitude},{ev.longitude})"
-        broadcast_alert(text)
-    except Exception:
-        pass
+def _send_email_alert(session, r: AlertRule, a: Anomaly, ev: DataEvent):
+    to_addr = r.email_to or os.getenv("EMAIL_TO_DEFAULT")
+    if not to_addr:
+        return None
+    return enqueue_email(
+        session,
+        to_addr,
+        f"RTAIP Alert: {a.type}",
+        f"Anomaly {a.type} sev={a.severity} src={ev.source} at ({ev.latitude},{ev.longitude}) {a.timestamp}",
+        digest=digest_interval_sec() > 0,
+    )
 
 if __name__ == "__main__":
     schedule_detection()
\ No newline at end of file
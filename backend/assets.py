@@ -0,0 +1,157 @@
+import threading
+import numpy as np
+from datetime import datetime
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from database import IsrAsset, bump_data_version, get_data_versions
+from routing import to_xyz, EARTH_R_KM
+
+# ISR asset registry.
+# Assets live in the isr_assets table; every write bumps the "assets" data
+# version. Each process keeps an id map and a cKDTree over the assets' unit
+# vectors and reloads them only when that version moves, so all workers see
+# the same registry and reads never scan a list. batch_task() assigns many
+# targets to many assets at once by minimum-cost matching
+# (scipy linear_sum_assignment) on distance scaled down by target priority.
+
+PRIORITY_WEIGHT = {"low": 1.0, "medium": 2.0, "high": 4.0, "critical": 8.0}
+INFEASIBLE = 1e12
+
+def serialize_asset(a: IsrAsset):
+    return {"id": a.id, "name": a.name, "type": a.type, "lat": a.latitude, "lon": a.longitude,
+            "status": a.status, "metadata": a.meta, "tasking": a.tasking}
+
+def priority_weight(p):
+    if isinstance(p, (int, float)):
+        return max(0.1, float(p))
+    return PRIORITY_WEIGHT.get(str(p or "medium").lower(), PRIORITY_WEIGHT["medium"])
+
+class AssetRegistry:
+    def __init__(self):
+        self.version = None
+        self.by_id = {}
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._tree = None
+        self._lock = threading.Lock()
+
+    def sync(self, session):
+        version = get_data_versions(session, "assets")["assets"]
+        with self._lock:
+            if version == self.version:
+                return self
+            rows = session.query(IsrAsset).order_by(IsrAsset.id).all()
+            self.by_id = {a.id: serialize_asset(a) for a in rows}
+            located = [a for a in self.by_id.values() if a["lat"] is not None and a["lon"] is not None]
+            self._ids = np.array([a["id"] for a in located], dtype=np.int64)
+            self._tree = cKDTree(to_xyz([a["lat"] for a in located], [a["lon"] for a in located])) if located else None
+            self.version = version
+        return self
+
+    def _changed(self, session):
+        bump_data_version(session, "assets")
+        session.commit()
+        self.sync(session)
+
+    def list(self, session):
+        return list(self.sync(session).by_id.values())
+
+    def get(self, session, asset_id):
+        return self.sync(session).by_id.get(asset_id)
+
+    def create(self, session, fields):
+        a = IsrAsset(name=fields.get("name"), type=fields.get("type"), latitude=fields.get("lat"), longitude=fields.get("lon"),
+                     status=fields.get("status") or "available", meta=fields.get("metadata"), tasking=fields.get("tasking"))
+        session.add(a)
+        session.flush()
+        self._changed(session)
+        return a.id
+
+    def update(self, session, asset_id, fields):
+        a = session.get(IsrAsset, asset_id)
+        if a is None:
+            return None
+        cols = {"name": "name", "type": "type", "lat": "latitude", "lon": "longitude", "status": "status", "metadata": "meta", "tasking": "tasking"}
+        for k, v in fields.items():
+            if k in cols and v is not None:
+                setattr(a, cols[k], v)
+        a.updated_at = datetime.utcnow()
+        self._changed(session)
+        return self.by_id.get(asset_id)
+
+    def delete(self, session, asset_id):
+        n = session.query(IsrAsset).filter(IsrAsset.id == asset_id).delete(synchronize_session=False)
+        if n:
+            self._changed(session)
+        return n > 0
+
+    def near(self, session, lat, lon, radius_km, status=None, limit=50):
+        """Assets within radius_km of (lat, lon), nearest first, with distance_km."""
+        self.sync(session)
+        with self._lock:
+            tree, ids, by_id = self._tree, self._ids, self.by_id
+        if tree is None:
+            return []
+        p = to_xyz(lat, lon)
+        chord = 2.0 * np.sin(min(np.pi, radius_km / EARTH_R_KM) / 2.0)
+        idx = tree.query_ball_point(p, chord)
+        if not idx:
+            return []
+        d = 2.0 * np.arcsin(np.clip(np.linalg.norm(tree.data[idx] - p, axis=1) / 2.0, 0.0, 1.0)) * EARTH_R_KM
+        out = []
+        for i in np.argsort(d, kind="stable"):
+            a = by_id.get(int(ids[idx[i]]))
+            if a is None or (status and a["status"] != status):
+                continue
+            out.append({**a, "distance_km": float(d[i])})
+            if len(out) >= limit:
+                break
+        return out
+
+    def batch_task(self, session, targets, max_km=None, status="available", dry_run=False):
+        """Assign targets to assets minimizing sum(distance_km / priority weight).
+
+        Targets: {"lat", "lon", "priority", "description", "types": [...]} dicts. Each asset takes
+        at most one target; when targets outnumber assets the lower-priority or farther ones stay unassigned."""
+        self.sync(session)
+        pool = [a for a in self.by_id.values() if a["lat"] is not None and a["lon"] is not None and (not status or a["status"] == status)]
+        valid = [i for i, t in enumerate(targets) if t.get("lat") is not None and t.get("lon") is not None]
+        if not pool or not valid:
+            return {"assignments": [], "unassigned": list(range(len(targets)))}
+        A = to_xyz([a["lat"] for a in pool], [a["lon"] for a in pool])
+        T = to_xyz([targets[i]["lat"] for i in valid], [targets[i]["lon"] for i in valid])
+        dist = np.arccos(np.clip(A @ T.T, -1.0, 1.0)) * EARTH_R_KM
+        cost = dist / np.array([priority_weight(targets[i].get("priority")) for i in valid])[None, :]
+        if max_km is not None:
+            cost[dist > max_km] = INFEASIBLE
+        for col, i in enumerate(valid):
+            types = targets[i].get("types")
+            if types:
+                allowed = {str(t).lower() for t in types}
+                cost[[(a["type"] or "").lower() not in allowed for a in pool], col] = INFEASIBLE
+        rows, cols = linear_sum_assignment(cost)
+        assignments = []
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            if cost[r, c] >= INFEASIBLE:
+                continue
+            t = targets[valid[c]]
+            assignments.append({"target_index": valid[c], "asset_id": pool[r]["id"], "asset_name": pool[r]["name"],
+                                "distance_km": float(dist[r, c]), "priority": t.get("priority", "medium")})
+        if assignments and not dry_run:
+            seen = {a["id"]: a["status"] for a in pool}
+            won = []
+            for m in assignments:
+                t = targets[m["target_index"]]
+                tasking = {"target": {"lat": t["lat"], "lon": t["lon"], **({"id": t["id"]} if t.get("id") is not None else {})},
+                           "description": t.get("description", ""), "priority": t.get("priority", "medium")}
+                # Conditional on the status the match was made against: a concurrent batch that
+                # tasked this asset first wins, and our target is reported unassigned instead
+                n = session.query(IsrAsset).filter(IsrAsset.id == m["asset_id"], IsrAsset.status == seen[m["asset_id"]]).update(
+                    {"tasking": tasking, "status": "tasked", "updated_at": datetime.utcnow()}, synchronize_session=False)
+                if n:
+                    won.append(m)
+            assignments = won
+            self._changed(session)
+        taken = {m["target_index"] for m in assignments}
+        return {"assignments": assignments, "unassigned": [i for i in range(len(targets)) if i not in taken]}
+
+registry = AssetRegistry()
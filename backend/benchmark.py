@@ -0,0 +1,305 @@
+"""
+Anomaly detection benchmark.
+
+Generates synthetic events with per-source spatial/temporal distributions and
+injected outliers, then times each detection stage from anomaly.py at every
+requested size and writes a JSON report.
+
+    python benchmark.py                                   # 1e4,1e5,1e6,1e7
+    python benchmark.py --sizes 1e4,1e5 --out bench_report.json
+    python benchmark.py --sizes 1e4,1e5 --baseline bench_report.json
+
+With --baseline the run is compared stage by stage against an earlier report
+and exits non-zero when a stage slows down by more than --max-regression or
+recall drops by more than --max-recall-drop.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+
+HUBS = [(40.6, -73.8), (51.5, -0.4), (25.3, 55.4), (1.4, 103.9), (35.5, 139.8), (33.9, -118.4), (49.0, 2.5), (-33.9, 151.2), (19.4, -99.1), (28.6, 77.1)]
+PORTS = [(1.26, 103.8), (31.2, 121.5), (51.9, 4.1), (22.3, 114.2), (35.1, 129.0), (29.9, -90.1), (33.7, -118.3), (-23.9, -46.3), (25.0, 55.1), (53.5, 10.0)]
+RING_OF_FIRE = [(60.0, -150.0), (52.0, 178.0), (43.0, 146.0), (36.0, 141.0), (24.0, 122.0), (14.0, 121.0), (-6.0, 130.0), (-20.0, 169.0), (-38.0, 177.0), (-33.0, -72.0), (-15.0, -75.0), (14.0, -91.0), (19.0, -104.0), (37.0, -122.0)]
+
+SOURCE_MIX = [("adsb", 0.35), ("ais", 0.30), ("noaa_weather", 0.15), ("usgs_seismic", 0.10), ("gdacs_disasters", 0.05), ("nasa_eonet", 0.05)]
+
+class _Row:
+    """Stand-in for the (id, latitude, longitude, timestamp) rows detection reads from the DB."""
+    __slots__ = ("id", "latitude", "longitude", "_ts")
+
+    def __init__(self, id, latitude, longitude, ts):
+        self.id = id
+        self.latitude = latitude
+        self.longitude = longitude
+        self._ts = ts
+
+    @property
+    def timestamp(self):
+        return EPOCH + timedelta(seconds=self._ts)
+
+def _around(rng, centers, n, sd):
+    c = np.asarray(centers, dtype=np.float64)
+    pick = c[rng.integers(0, len(c), n)]
+    return pick[:, 0] + rng.normal(0, sd, n), pick[:, 1] + rng.normal(0, sd, n)
+
+def generate_events(n, outlier_rate=0.01, hours=24, seed=42):
+    """Returns (lat, lon, ts_epoch_sec, source_idx, is_outlier) arrays of length n."""
+    rng = np.random.default_rng(seed)
+    n_out = int(round(n * outlier_rate))
+    n_in = n - n_out
+    counts = rng.multinomial(n_in, [w for _, w in SOURCE_MIX])
+    t_end = time.time()
+    t_start = t_end - hours * 3600
+    lats, lons, ts, src = [], [], [], []
+    for si, ((name, _), k) in enumerate(zip(SOURCE_MIX, counts)):
+        if k == 0:
+            continue
+        if name == "adsb":
+            la, lo = _around(rng, HUBS, k, 3.0)
+            # Diurnal traffic: more flights in local daytime
+            hour = rng.choice(24, size=k, p=_diurnal())
+            t = t_start + (rng.integers(0, max(1, hours // 24), k) * 24 + hour) * 3600 + rng.uniform(0, 3600, k)
+        elif name == "ais":
+            a = np.asarray(PORTS)[rng.integers(0, len(PORTS), k)]
+            b = np.asarray(PORTS)[rng.integers(0, len(PORTS), k)]
+            f = rng.beta(0.5, 0.5, k)[:, None]  # vessels bunch up near ports
+            p = a + (b - a) * f
+            la, lo = p[:, 0] + rng.normal(0, 0.5, k), p[:, 1] + rng.normal(0, 0.5, k)
+            t = rng.uniform(t_start, t_end, k)
+        elif name == "noaa_weather":
+            la = np.round(rng.uniform(25, 49, k)) + rng.normal(0, 0.01, k)
+            lo = np.round(rng.uniform(-125, -67, k)) + rng.normal(0, 0.01, k)
+            t = t_start + np.floor(rng.uniform(0, hours, k)) * 3600  # hourly observations
+        elif name == "usgs_seismic":
+            la, lo = _around(rng, RING_OF_FIRE, k, 1.5)
+            t = rng.uniform(t_start, t_end, k)
+        else:
+            la, lo = rng.uniform(-35, 45, k), rng.uniform(-120, 150, k)
+            t = rng.uniform(t_start, t_end, k)
+        lats.append(la); lons.append(lo); ts.append(t); src.append(np.full(k, si))
+    if n_out:
+        # Outliers: open Southern Ocean and central Pacific, far from every cluster
+        half = n_out // 2
+        lats.append(np.concatenate([rng.uniform(-75, -55, half), rng.uniform(-10, 10, n_out - half)]))
+        lons.append(np.concatenate([rng.uniform(-180, 180, half), rng.uniform(-170, -130, n_out - half)]))
+        ts.append(rng.uniform(t_start, t_end, n_out))
+        src.append(rng.integers(0, len(SOURCE_MIX), n_out))
+    lat = np.clip(np.concatenate(lats), -89.9, 89.9)
+    lon = (np.concatenate(lons) + 180.0) % 360.0 - 180.0
+    ts = np.concatenate(ts)
+    src = np.concatenate(src)
+    truth = np.zeros(n, dtype=bool)
+    truth[n_in:] = True
+    perm = rng.permutation(n)
+    return lat[perm], lon[perm], ts[perm], src[perm], truth[perm]
+
+def _diurnal():
+    h = np.arange(24)
+    w = 1.0 + np.sin((h - 6) / 24.0 * 2 * np.pi).clip(0) * 3
+    return w / w.sum()
+
+def _synthetic_rules(n, seed=7):
+    from database import AlertRule
+    rng = np.random.default_rng(seed)
+    names = [s for s, _ in SOURCE_MIX]
+    rules = []
+    for i in range(n):
+        lat0 = float(rng.uniform(-80, 70)); lon0 = float(rng.uniform(-180, 170))
+        bbox = rng.random() < 0.8
+        rules.append(AlertRule(
+            id=i + 1,
+            name=f"bench-{i}",
+            source=names[int(rng.integers(0, len(names)))] if rng.random() < 0.5 else None,
+            severity_threshold=int(rng.integers(1, 10)),
+            min_confidence=float(rng.uniform(0, 0.8)),
+            min_lat=lat0 if bbox else None, max_lat=lat0 + float(rng.uniform(1, 20)) if bbox else None,
+            min_lon=lon0 if bbox else None, max_lon=lon0 + float(rng.uniform(1, 20)) if bbox else None,
+        ))
+    return rules
+
+def _peak_rss_mb():
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / (1024.0 * 1024.0) if sys.platform == "darwin" else r / 1024.0
+
+def run_size(n, outlier_rate=0.01, rules=1000, seed=42):
+    """Benchmark one size in the current process. Returns a result dict."""
+    tmp = tempfile.mkdtemp(prefix="rtaip-bench-")
+    url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    os.environ["DATABASE_URL"] = url
+    with contextlib.redirect_stdout(io.StringIO()):
+        import database
+        import anomaly
+        from alerting import RuleIndex
+    database.engine.echo = False
+    # database is imported once per process; with --no-isolate every size still needs its own DB
+    from sqlalchemy import create_engine
+    engine = create_engine(url)
+    database.Base.metadata.create_all(engine)
+    anomaly.Session.configure(bind=engine)
+
+    stages = {}
+    def timed(name, fn, *args):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        dt = time.perf_counter() - t0
+        stages[name] = {"seconds": round(dt, 6), "throughput_eps": round(n / dt, 1) if dt > 0 else None}
+        return out
+
+    lat, lon, ts, src, truth = generate_events(n, outlier_rate, seed=seed)
+    rows = [_Row(i + 1, float(a), float(b), float(t)) for i, (a, b, t) in enumerate(zip(lat, lon, ts))]
+    rss_after_generate = _peak_rss_mb()
+
+    data = timed("features", anomaly.extract_features, rows)
+    model = timed("fit", anomaly.fit_model, data)
+    preds, scores = timed("score", anomaly.score_model, model, data)
+
+    def _insert():
+        with anomaly.Session() as session:
+            created = anomaly.insert_anomalies(session, rows, preds, scores, 0)
+            session.commit()
+        return created
+    created = timed("anomaly_insert", _insert)
+    engine.dispose()
+
+    flagged = np.flatnonzero(preds == -1)
+    rule_objs = _synthetic_rules(rules)
+    conf = np.where(src == 0, 0.8, 0.6)
+    sev = np.clip(10 * np.maximum(0.0, -scores), 1, 9).astype(int)
+    names = [s for s, _ in SOURCE_MIX]
+    def _alerts():
+        index = RuleIndex(rule_objs)
+        hits = 0
+        for i in flagged:
+            hits += len(index.match(names[src[i]], lat[i], lon[i], int(sev[i]), float(conf[i])))
+        return hits
+    alert_hits = timed("alert_rules", _alerts)
+
+    tp = int(np.sum((preds == -1) & truth))
+    fp = int(np.sum((preds == -1) & ~truth))
+    fn = int(np.sum((preds != -1) & truth))
+    return {
+        "events": n,
+        "outliers_injected": int(truth.sum()),
+        "anomalies_flagged": int(len(flagged)),
+        "anomalies_inserted": int(created),
+        "alert_rules": rules,
+        "alert_matches": int(alert_hits),
+        "precision": round(tp / (tp + fp), 4) if tp + fp else None,
+        "recall": round(tp / (tp + fn), 4) if tp + fn else None,
+        "stages": stages,
+        "total_seconds": round(sum(s["seconds"] for s in stages.values()), 6),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "peak_rss_generate_mb": round(rss_after_generate, 1),
+    }
+
+def _child(n, outlier_rate, rules, seed, q):
+    try:
+        q.put(run_size(n, outlier_rate, rules, seed))
+    except BaseException as e:
+        q.put({"events": n, "error": f"{type(e).__name__}: {e}"})
+
+def run_isolated(n, outlier_rate, rules, seed):
+    # Fresh interpreter per size so peak RSS is attributable to that size alone
+    ctx = mp.get_context("spawn")
+    q = ctx.Queue()
+    p = ctx.Process(target=_child, args=(n, outlier_rate, rules, seed, q))
+    p.start()
+    res = None
+    while p.is_alive() or not q.empty():
+        try:
+            res = q.get(timeout=1.0)
+            break
+        except Exception:
+            continue
+    p.join()
+    if res is None:
+        res = {"events": n, "error": f"benchmark process exited with code {p.exitcode}"}
+    return res
+
+def _environment():
+    env = {"python": platform.python_version(), "platform": platform.platform(), "numpy": np.__version__, "cpu_count": os.cpu_count()}
+    try:
+        import sklearn
+        env["scikit_learn"] = sklearn.__version__
+    except Exception:
+        pass
+    try:
+        env["git_rev"] = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        pass
+    return env
+
+def compare(report, baseline, max_regression=0.25, max_recall_drop=0.05):
+    """Returns a list of human-readable regressions of report vs baseline."""
+    base = {r["events"]: r for r in baseline.get("results", []) if "error" not in r}
+    problems = []
+    for r in report.get("results", []):
+        b = base.get(r["events"])
+        if not b or "error" in r:
+            continue
+        for stage, s in r["stages"].items():
+            bs = b.get("stages", {}).get(stage)
+            if not bs or not bs.get("seconds"):
+                continue
+            ratio = s["seconds"] / bs["seconds"]
+            if ratio > 1.0 + max_regression:
+                problems.append(f"n={r['events']} {stage}: {bs['seconds']:.3f}s -> {s['seconds']:.3f}s ({(ratio - 1) * 100:.0f}% slower)")
+        if r.get("recall") is not None and b.get("recall") is not None and b["recall"] - r["recall"] > max_recall_drop:
+            problems.append(f"n={r['events']} recall: {b['recall']:.3f} -> {r['recall']:.3f}")
+    return problems
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark anomaly detection stages at increasing event counts.")
+    ap.add_argument("--sizes", default="1e4,1e5,1e6,1e7", help="comma-separated event counts")
+    ap.add_argument("--outlier-rate", type=float, default=0.01)
+    ap.add_argument("--rules", type=int, default=1000, help="synthetic alert rules for the alert_rules stage")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", default="bench_report.json")
+    ap.add_argument("--baseline", help="earlier report to compare against")
+    ap.add_argument("--max-regression", type=float, default=0.25)
+    ap.add_argument("--max-recall-drop", type=float, default=0.05)
+    ap.add_argument("--no-isolate", action="store_true", help="run all sizes in this process")
+    args = ap.parse_args(argv)
+
+    sizes = [int(float(s)) for s in args.sizes.split(",") if s.strip()]
+    report = {"generated_at": datetime.utcnow().isoformat(), "environment": _environment(), "params": {"outlier_rate": args.outlier_rate, "rules": args.rules, "seed": args.seed}, "results": []}
+    for n in sizes:
+        print(f"[bench] n={n:,} ...", flush=True)
+        res = run_size(n, args.outlier_rate, args.rules, args.seed) if args.no_isolate else run_isolated(n, args.outlier_rate, args.rules, args.seed)
+        report["results"].append(res)
+        if "error" in res:
+            print(f"[bench] n={n:,} failed: {res['error']}", flush=True)
+            continue
+        st = "  ".join(f"{k}={v['seconds']:.3f}s" for k, v in res["stages"].items())
+        print(f"[bench] n={n:,} {st} rss={res['peak_rss_mb']}MB precision={res['precision']} recall={res['recall']}", flush=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[bench] report written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems = compare(report, baseline, args.max_regression, args.max_recall_drop)
+        for p in problems:
+            print(f"[bench] REGRESSION {p}")
+        if problems:
+            return 1
+        print("[bench] no regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
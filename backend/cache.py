@@ -0,0 +1,302 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+import shared_cache
+
+# In-process response cache.
+# Bounded by entry count and by an approximate byte budget; the least recently
+# used entries are evicted first. Expired entries are dropped on read and by a
+# background sweeper. get_or_compute() (and get_or_compute_async() for
+# coroutines) coalesces concurrent misses for the same key so only one caller
+# runs the (usually DB-bound) computation while the others wait for its result.
+# With a shared tier (shared_cache.py, on by default), get_or_compute(...,
+# shared=True) - used for EncodedBody/bytes/str results - falls back to the
+# host-wide store on a local miss, writes the result through to it and
+# coalesces misses across processes. Deletions reach every worker's
+# in-process copy.
+#
+# Configuration (env):
+#   CACHE_MAX_ENTRIES (10000)
+#   CACHE_MAX_MB (128)
+#   CACHE_SWEEP_SEC (30)
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def approx_size(obj, _depth=0):
+    """Cheap recursive estimate of an object's memory footprint in bytes."""
+    size = sys.getsizeof(obj)
+    if _depth > 6:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_size(k, _depth + 1) + approx_size(v, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += approx_size(v, _depth + 1)
+    return size
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+class TTLCache:
+    def __init__(self, max_entries=None, max_bytes=None, sweep_sec=None, shared=None):
+        self.max_entries = int(max_entries or _env_float("CACHE_MAX_ENTRIES", 10000))
+        self.max_bytes = int(max_bytes or _env_float("CACHE_MAX_MB", 128) * 1024 * 1024)
+        self.sweep_sec = sweep_sec or _env_float("CACHE_SWEEP_SEC", 30)
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self._sweeper = None
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def get(self, key, shared=True):
+        """Cached value or None; shared=False skips the shared tier for keys it never holds."""
+        shared = shared and self.shared is not None
+        if shared:
+            self._apply_invalidations()
+        value = self._get_local(key)
+        if value is None and shared:
+            value = self._get_shared(key)
+        self._count_lookup(value)
+        return value
+
+    def _get_local(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] < now:
+                self._remove(key)
+                self.expirations += 1
+                item = None
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def _get_shared(self, key):
+        found = self.shared.get(key)
+        if found is None:
+            return None
+        self.set(key, found[0], found[1], share=False)
+        return found[0]
+
+    def _count_lookup(self, value):
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+    def _apply_invalidations(self):
+        for p in self.shared.invalidations():
+            if p.startswith("="):
+                self._delete_local(p[1:])
+            else:
+                self._delete_local_prefix(p)
+
+    def set(self, key, value, ttl_sec=5, size=None, share=True):
+        if share and self.shared is not None:
+            self.shared.set(key, value, ttl_sec)
+        size = approx_size(value) if size is None else size
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                return  # too big to cache, but the previous value must not outlive it
+            self._data[key] = (value, time.time() + ttl_sec, size)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                old, _ = next(iter(self._data.items()))
+                self._remove(old)
+                self.evictions += 1
+        self._ensure_sweeper()
+
+    def delete(self, key):
+        self._delete_local(key)
+        if self.shared is not None and isinstance(key, str):
+            self.shared.delete(key)
+
+    def delete_prefix(self, prefix):
+        self._delete_local_prefix(prefix)
+        if self.shared is not None:
+            self.shared.delete_prefix(prefix)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+        if self.shared is not None:
+            self.shared.delete_prefix("")
+
+    def _delete_local(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def _delete_local_prefix(self, prefix):
+        with self._lock:
+            for k in [k for k in self._data if isinstance(k, str) and k.startswith(prefix)]:
+                self._remove(k)
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get_or_compute(self, key, compute, ttl_sec=5, shared=False):
+        """Return the cached value for key, computing it once across concurrent callers on a miss.
+
+        shared=True (for EncodedBody/bytes/str results) also checks, coalesces on and fills the shared tier."""
+        shared = shared and self.shared is not None and isinstance(key, str)
+        value = self.get(key, shared=shared)
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        claimed = False
+        try:
+            if shared:
+                # Another worker process may already be computing this key
+                claimed = self.shared.claim(key, self.shared.wait_sec)
+                if not claimed:
+                    found = self.shared.wait_for(key)
+                    if found is not None:
+                        flight.value = found[0]
+                        self.set(key, found[0], found[1], share=False)
+                        return found[0]
+            value = compute()
+            flight.value = value
+            if value is not None:
+                self.set(key, value, ttl_sec, share=shared)
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            if claimed:
+                self.shared.release(key)
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    async def get_or_compute_async(self, key, compute, ttl_sec=5, shared=False):
+        """Async counterpart of get_or_compute; compute is a coroutine function."""
+        shared = shared and self.shared is not None and isinstance(key, str)
+        # The shared tier is SQLite: every call into it goes through the threadpool, never the event loop
+        if shared and self.shared.poll_due():
+            await run_in_threadpool(self._apply_invalidations)
+        value = self._get_local(key)
+        if value is None and shared:
+            value = await run_in_threadpool(self._get_shared, key)
+        self._count_lookup(value)
+        if value is not None:
+            return value
+        fut = self._async_flights.get(key)
+        if fut is not None:
+            with self._lock:
+                self.coalesced += 1
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._async_flights[key] = fut
+        claimed = False
+        try:
+            if shared:
+                claimed = await run_in_threadpool(self.shared.claim, key, self.shared.wait_sec)
+                if not claimed:
+                    found = await self.shared.wait_for_async(key)
+                    if found is not None:
+                        self.set(key, found[0], found[1], share=False)
+                        fut.set_result(found[0])
+                        return found[0]
+            value = await compute()
+            if value is not None:
+                if shared:
+                    await run_in_threadpool(self.shared.set, key, value, ttl_sec)
+                self.set(key, value, ttl_sec, share=False)
+            fut.set_result(value)
+            return value
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            self._async_flights.pop(key, None)
+            if claimed:
+                await run_in_threadpool(self.shared.release, key)
+
+    def sweep(self):
+        """Drop expired entries. Returns how many were removed."""
+        now = time.time()
+        with self._lock:
+            dead = [k for k, (_, exp, _) in self._data.items() if exp < now]
+            for k in dead:
+                self._remove(k)
+            self.expirations += len(dead)
+        return len(dead)
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None or self.sweep_sec <= 0:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="cache-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_sec)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Cache sweep failed: {e}")
+
+    def stats(self):
+        shared = self.shared.stats() if self.shared is not None else None
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._flights) + len(self._async_flights),
+                "shared": shared,
+            }
+
+response_cache = TTLCache(shared=shared_cache.from_env())
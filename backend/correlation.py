@@ -0,0 +1,261 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import func
+from database import DataEvent, Anomaly, Incident, IncidentMember
+
+# Spatiotemporal multi-source correlation.
+# New events are linked to any event within CORRELATION_EPS_KM and
+# CORRELATION_WINDOW_H of them (single-linkage, i.e. DBSCAN with
+# min_samples=1). Neighbours are found through a (x, y, z, time) grid hash
+# with sorted cell keys, so candidate pairs for a whole batch come out of a
+# few vectorized searchsorted calls, and components are labelled with
+# scipy's connected_components in O(n + pairs). Connected
+# groups spanning at least CORRELATION_MIN_SOURCES sources become incidents;
+# groups touching existing incidents extend (and, if needed, merge) them.
+
+EPS_KM = float(os.getenv("CORRELATION_EPS_KM", "50"))
+WINDOW_H = float(os.getenv("CORRELATION_WINDOW_H", "6"))
+MIN_SOURCES = int(os.getenv("CORRELATION_MIN_SOURCES", "2"))
+BATCH = 50000
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    p1 = np.radians(lat1)
+    p2 = np.radians(lat2)
+    dlat = p2 - p1
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dlon / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+class _GridHash:
+    """
+    Hash of points on the unit sphere (x, y, z) and time. Cells are eps wide
+    in chord length, so the 27 spatial x 3 temporal neighbouring cells of a
+    point hold every point within eps and one time window of it, with no
+    special casing near the poles or the antimeridian.
+    """
+
+    def __init__(self, lats, lons, secs, eps_km, window_sec):
+        self.cell = max(1e-6, eps_km / 6371.0)
+        self.window_sec = max(1.0, window_sec)
+        self.dim = int(np.ceil(2.0 / self.cell)) + 3
+        self.t0 = float(secs.min()) if len(secs) else 0.0
+        self.tdim = int((float(secs.max()) - self.t0) // self.window_sec) + 3 if len(secs) else 3
+        self.keys = self._keys(lats, lons, secs)
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+
+    def _cells(self, lats, lons, secs):
+        la = np.radians(lats)
+        lo = np.radians(lons)
+        xyz = np.stack([np.cos(la) * np.cos(lo), np.cos(la) * np.sin(lo), np.sin(la)], axis=1)
+        c = np.floor((xyz + 1.0) / self.cell).astype(np.int64) + 1
+        t = np.floor((secs - self.t0) / self.window_sec).astype(np.int64) + 1
+        return c, t
+
+    def _encode(self, c, t):
+        return ((c[:, 0] * self.dim + c[:, 1]) * self.dim + c[:, 2]) * self.tdim + t
+
+    def _keys(self, lats, lons, secs):
+        c, t = self._cells(lats, lons, secs)
+        return self._encode(c, t)
+
+    def pairs(self, idx, lats, lons, secs):
+        """Candidate (i, j) index pairs for points idx, j drawn from neighbouring cells."""
+        c, t = self._cells(lats[idx], lons[idx], secs[idx])
+        src, dst = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    # Time is the lowest key digit, so buckets t-1..t+1 form one contiguous key range
+                    cc = c + np.array([dx, dy, dz])
+                    lo = np.searchsorted(self.sorted_keys, self._encode(cc, t - 1), side="left")
+                    hi = np.searchsorted(self.sorted_keys, self._encode(cc, t + 1), side="right")
+                    cnt = hi - lo
+                    total = int(cnt.sum())
+                    if total == 0:
+                        continue
+                    rep = np.repeat(np.arange(len(idx)), cnt)
+                    within = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+                    src.append(idx[rep])
+                    dst.append(self.order[lo[rep] + within])
+        if not src:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(src), np.concatenate(dst)
+
+def _components(n, src, dst):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    g = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)).tocsr()
+    _, labels = connected_components(g, directed=False)
+    return labels
+
+def correlate_events(session, lo_id: int, hi_id: int, eps_km: float = None, window_h: float = None, min_sources: int = None):
+    """
+    Correlate events with lo_id < id <= hi_id against everything in their
+    time window. Creates/extends/merges incidents and returns
+    [(incident, latest member event id)] for newly created incidents
+    (flushed, not committed).
+    """
+    eps_km = EPS_KM if eps_km is None else eps_km
+    window_h = WINDOW_H if window_h is None else window_h
+    min_sources = MIN_SOURCES if min_sources is None else min_sources
+    created = []
+    start = lo_id
+    while start < hi_id:
+        stop = min(hi_id, start + BATCH)
+        created.extend(_correlate_batch(session, start, stop, eps_km, window_h, min_sources))
+        start = stop
+    return created
+
+def _correlate_batch(session, lo_id, hi_id, eps_km, window_h, min_sources):
+    span = session.query(func.min(DataEvent.timestamp), func.max(DataEvent.timestamp)).filter(
+        DataEvent.id > lo_id, DataEvent.id <= hi_id,
+        DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None), DataEvent.timestamp.isnot(None),
+    ).one()
+    if span[0] is None:
+        return []
+    window = timedelta(hours=window_h)
+    rows = (
+        session.query(DataEvent.id, DataEvent.source, DataEvent.timestamp, DataEvent.latitude, DataEvent.longitude, IncidentMember.incident_id)
+        .outerjoin(IncidentMember, IncidentMember.event_id == DataEvent.id)
+        .filter(
+            DataEvent.timestamp >= span[0] - window, DataEvent.timestamp <= span[1] + window,
+            DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None), DataEvent.id <= hi_id,
+        )
+        .all()
+    )
+    if not rows:
+        return []
+    n = len(rows)
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    sources = [r[1] or "unknown" for r in rows]
+    epoch = datetime(1970, 1, 1)
+    secs = np.fromiter(((r[2] - epoch).total_seconds() for r in rows), dtype=np.float64, count=n)
+    lats = np.fromiter((r[3] for r in rows), dtype=np.float64, count=n)
+    lons = np.fromiter((r[4] for r in rows), dtype=np.float64, count=n)
+    incident_of = [r[5] for r in rows]
+
+    # Events already in the same incident start out connected
+    seed_src, seed_dst = [], []
+    first_of_incident = {}
+    for i, inc in enumerate(incident_of):
+        if inc is None:
+            continue
+        if inc in first_of_incident:
+            seed_src.append(first_of_incident[inc])
+            seed_dst.append(i)
+        else:
+            first_of_incident[inc] = i
+
+    window_sec = window_h * 3600.0
+    grid = _GridHash(lats, lons, secs, eps_km, window_sec)
+    new_idx = np.flatnonzero(ids > lo_id)
+    src_parts = [np.asarray(seed_src, dtype=np.int64)]
+    dst_parts = [np.asarray(seed_dst, dtype=np.int64)]
+    for k in range(0, len(new_idx), 4096):
+        chunk = new_idx[k:k + 4096]
+        a, b = grid.pairs(chunk, lats, lons, secs)
+        keep = (a != b) & (np.abs(secs[a] - secs[b]) <= window_sec)
+        a, b = a[keep], b[keep]
+        keep = _haversine_km(lats[a], lons[a], lats[b], lons[b]) <= eps_km
+        src_parts.append(a[keep])
+        dst_parts.append(b[keep])
+    labels = _components(n, np.concatenate(src_parts), np.concatenate(dst_parts))
+    order = np.argsort(labels, kind="stable")
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    group_of_label = {int(labels[g[0]]): g for g in np.split(order, bounds)}
+
+    created = []
+    new_members = []  # (incident, event index)
+    now = datetime.utcnow()
+    with session.no_autoflush:
+        for lab in np.unique(labels[new_idx]):
+            members = group_of_label[int(lab)]
+            if len(members) < 2:
+                continue
+            inc_ids = [incident_of[m] for m in members if incident_of[m] is not None]
+            existing = sorted(set(inc_ids))
+            fresh = members[[incident_of[m] is None for m in members]]
+            if not len(fresh) and len(existing) <= 1:
+                continue
+            if not existing and len(set(sources[m] for m in members)) < min_sources:
+                continue
+            if existing:
+                inc = session.get(Incident, existing[0])
+                if len(existing) > 1:
+                    session.query(IncidentMember).filter(IncidentMember.incident_id.in_(existing[1:])).update(
+                        {IncidentMember.incident_id: inc.id}, synchronize_session=False
+                    )
+                for other_id in existing[1:]:
+                    other = session.get(Incident, other_id)
+                    _absorb(inc, other.member_count or 0, other.latitude, other.longitude, other.first_seen, other.last_seen, other.sources or [])
+                    session.delete(other)
+            else:
+                inc = Incident(member_count=0, source_count=0, sources=[], created_at=now)
+                session.add(inc)
+                created.append((inc, int(ids[fresh[np.argmax(secs[fresh])]])))
+            if len(fresh):
+                f_lat, f_lon = _mean_latlon(lats[fresh], lons[fresh])
+                f_first = epoch + timedelta(seconds=float(secs[fresh].min()))
+                f_last = epoch + timedelta(seconds=float(secs[fresh].max()))
+                _absorb(inc, len(fresh), f_lat, f_lon, f_first, f_last, [sources[m] for m in fresh])
+                new_members.extend((inc, m) for m in fresh)
+            inc.updated_at = now
+    # One flush assigns ids to every new incident, then members go in as a bulk insert
+    session.flush()
+    if new_members:
+        session.bulk_insert_mappings(IncidentMember, [{"incident_id": inc.id, "event_id": int(ids[m])} for inc, m in new_members])
+    return created
+
+def _mean_latlon(lats, lons, weights=None):
+    """Spherical mean, so groups straddling the antimeridian average correctly."""
+    la = np.radians(np.asarray(lats, dtype=np.float64))
+    lo = np.radians(np.asarray(lons, dtype=np.float64))
+    w = np.ones(len(la)) if weights is None else np.asarray(weights, dtype=np.float64)
+    x = float(np.sum(w * np.cos(la) * np.cos(lo)))
+    y = float(np.sum(w * np.cos(la) * np.sin(lo)))
+    z = float(np.sum(w * np.sin(la)))
+    return float(np.degrees(np.arctan2(z, np.hypot(x, y)))), float(np.degrees(np.arctan2(y, x)))
+
+def _absorb(inc: Incident, count, lat, lon, first_seen, last_seen, srcs):
+    w = inc.member_count or 0
+    if lat is not None and lon is not None:
+        if w and inc.latitude is not None and inc.longitude is not None:
+            inc.latitude, inc.longitude = _mean_latlon([inc.latitude, lat], [inc.longitude, lon], [w, count])
+        else:
+            inc.latitude, inc.longitude = lat, lon
+    inc.member_count = w + count
+    inc.first_seen = min([t for t in (inc.first_seen, first_seen) if t is not None], default=None)
+    inc.last_seen = max([t for t in (inc.last_seen, last_seen) if t is not None], default=None)
+    merged = sorted(set(inc.sources or []) | set(srcs))
+    inc.sources = merged
+    inc.source_count = len(merged)
+
+def incident_anomaly(session, inc: Incident, event_id: int):
+    """Raise a correlated_incident anomaly anchored on the incident's latest member event."""
+    a = Anomaly(
+        event_id=event_id,
+        type="correlated_incident",
+        severity=int(min(9, 3 + 2 * (inc.source_count or 0))),
+        description=f"Correlated incident #{inc.id}: {inc.member_count} events from {', '.join(s.upper() for s in (inc.sources or []))}",
+        timestamp=inc.last_seen or datetime.utcnow(),
+    )
+    session.add(a)
+    return a
+
+def serialize_incident(inc: Incident, member_ids=None):
+    out = {
+        "id": inc.id,
+        "latitude": inc.latitude,
+        "longitude": inc.longitude,
+        "first_seen": inc.first_seen.isoformat() if inc.first_seen else None,
+        "last_seen": inc.last_seen.isoformat() if inc.last_seen else None,
+        "member_count": inc.member_count,
+        "source_count": inc.source_count,
+        "sources": inc.sources or [],
+    }
+    if member_ids is not None:
+        out["event_ids"] = member_ids
+    return out
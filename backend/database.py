@@ -1,5 +1,6 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, ForeignKey, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, ForeignKey, Text, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from datetime import datetime
 import os
 
@@ -21,8 +22,33 @@ else:
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# Async engine for the request path (aiosqlite for SQLite, asyncpg for Postgres)
+def _async_url(url):
+    if url.startswith('sqlite:'):
+        return 'sqlite+aiosqlite:' + url[len('sqlite:'):]
+    for prefix in ('postgresql+psycopg2://', 'postgresql://', 'postgres://'):
+        if url.startswith(prefix):
+            # asyncpg takes SSL/pgbouncer settings via connect_args, not the query string
+            return 'postgresql+asyncpg://' + url[len(prefix):].split('?', 1)[0]
+    return url
+
+if DATABASE_URL.startswith('postgres'):
+    _async_args = {"ssl": "require"}
+    if ':6543' in DATABASE_URL or 'pgbouncer=true' in DATABASE_URL:
+        _async_args["statement_cache_size"] = 0  # pgbouncer transaction mode has no prepared statements
+    async_engine = create_async_engine(_async_url(DATABASE_URL), pool_pre_ping=True, connect_args=_async_args)
+else:
+    async_engine = create_async_engine(_async_url(DATABASE_URL))
+
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
 class DataEvent(Base):
     __tablename__ = 'data_events'
+    __table_args__ = (
+        Index('idx_data_events_lat_lon', 'latitude', 'longitude'),
+        Index('idx_data_events_timestamp', 'timestamp'),
+        Index('idx_data_events_source_ts', 'source', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
     source = Column(String)
@@ -34,6 +60,10 @@ class DataEvent(Base):
 
 class Anomaly(Base):
     __tablename__ = 'anomalies'
+    __table_args__ = (
+        Index('idx_anomalies_event_id', 'event_id'),
+        Index('idx_anomalies_timestamp', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
     event_id = Column(Integer, ForeignKey('data_events.id'))
@@ -56,6 +86,175 @@ class AlertRule(Base):
     max_lon = Column(Float)
     email_to = Column(String)  # optional notification target
 
+class AlertDelivery(Base):
+    __tablename__ = 'alert_deliveries'
+    __table_args__ = (UniqueConstraint('rule_id', 'anomaly_id', name='uq_alert_delivery_rule_anomaly'),)
+
+    id = Column(Integer, primary_key=True)
+    rule_id = Column(Integer, ForeignKey('alert_rules.id'), index=True)
+    anomaly_id = Column(Integer, ForeignKey('anomalies.id'), index=True)
+    status = Column(String, default='pending')  # pending | queued (email in the outbox) | sent | failed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime)
+    notification_id = Column(Integer, index=True)  # outbox row carrying the email, if any
+
+class Notification(Base):
+    __tablename__ = 'notification_outbox'
+
+    id = Column(Integer, primary_key=True)
+    to_addr = Column(String, index=True)
+    subject = Column(String)
+    body = Column(Text)
+    status = Column(String, default='queued', index=True)  # queued | sending | sent | failed | digest | digested
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text)
+    digest_id = Column(Integer)  # outbox row that carried this item when batched into a digest
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+class Incident(Base):
+    __tablename__ = 'incidents'
+
+    id = Column(Integer, primary_key=True)
+    first_seen = Column(DateTime, index=True)
+    last_seen = Column(DateTime, index=True)
+    latitude = Column(Float)  # member centroid
+    longitude = Column(Float)
+    member_count = Column(Integer, default=0)
+    source_count = Column(Integer, default=0)
+    sources = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class IncidentMember(Base):
+    __tablename__ = 'incident_members'
+
+    id = Column(Integer, primary_key=True)
+    incident_id = Column(Integer, ForeignKey('incidents.id'), index=True)
+    event_id = Column(Integer, ForeignKey('data_events.id'), unique=True)
+
+class DetectorRule(Base):
+    __tablename__ = 'detector_rules'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    source = Column(String)  # optional filter
+    field = Column(String)  # normalized column (e.g. confidence) or JSON path into data (e.g. properties.mag)
+    op = Column(String, default='>')
+    value = Column(JSON)
+    type = Column(String)  # anomaly type emitted on match
+    severity = Column(Integer, default=5)
+    description = Column(Text)
+    enabled = Column(Boolean, default=True)
+
+class DetectorState(Base):
+    __tablename__ = 'detector_state'
+
+    name = Column(String, primary_key=True)
+    last_id = Column(Integer, default=0)  # high-water mark of processed rows
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    name = Column(String, primary_key=True)  # events, anomalies, incidents
+    version = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class WorkerLease(Base):
+    __tablename__ = 'worker_leases'
+
+    name = Column(String, primary_key=True)  # background role: ingest, detect, forecast
+    holder = Column(String)  # host:pid of the current leader
+    acquired_at = Column(DateTime)
+    expires_at = Column(DateTime)
+
+def bump_data_version(session, *names):
+    """Increment the named data versions inside the caller's transaction."""
+    from sqlalchemy import update
+    now = datetime.utcnow()
+    dialect = session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        # One upsert per name: two transactions creating the same row must not fail each other's batch
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        for name in names:
+            stmt = insert(DataVersion).values(name=name, version=1, updated_at=now)
+            session.execute(stmt.on_conflict_do_update(index_elements=[DataVersion.name],
+                                                       set_={"version": DataVersion.version + 1, "updated_at": now}))
+        return
+    for name in names:
+        res = session.execute(
+            update(DataVersion).where(DataVersion.name == name).values(version=DataVersion.version + 1, updated_at=now)
+        )
+        if res.rowcount == 0:
+            session.add(DataVersion(name=name, version=1, updated_at=now))
+            session.flush()
+
+def get_data_versions(session, *names):
+    rows = session.query(DataVersion.name, DataVersion.version).filter(DataVersion.name.in_(names)).all()
+    found = dict(rows)
+    return {n: found.get(n, 0) for n in names}
+
+async def get_data_versions_async(session, *names):
+    from sqlalchemy import select
+    rows = (await session.execute(select(DataVersion.name, DataVersion.version).where(DataVersion.name.in_(names)))).all()
+    found = dict(rows)
+    return {n: found.get(n, 0) for n in names}
+
+def hour_bucket(session, col):
+    """SQL expression truncating a timestamp to the hour, per dialect."""
+    from sqlalchemy import func
+    if session.get_bind().dialect.name == "postgresql":
+        return func.date_trunc("hour", col)
+    return func.strftime("%Y-%m-%dT%H:00:00", col)
+
+def as_hour(v):
+    """Normalize an hour_bucket() value (datetime or ISO string) to a naive datetime."""
+    if isinstance(v, datetime):
+        return v.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    return datetime.fromisoformat(str(v))
+
+class AnomalySeries(Base):
+    __tablename__ = 'anomaly_series'
+
+    source = Column(String, primary_key=True)
+    cell = Column(String, primary_key=True)  # "*" for the per-source total, else "lat,lon" of a 1 degree cell
+    hour = Column(DateTime, primary_key=True, index=True)
+    count = Column(Integer, default=0, nullable=False)
+
+class Forecast(Base):
+    __tablename__ = 'forecasts'
+
+    source = Column(String, primary_key=True)
+    cell = Column(String, primary_key=True)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    name = Column(String)
+    horizon_h = Column(Integer)
+    expected_count = Column(Float)
+    probability = Column(Float)
+    confidence = Column(Float)
+    history_h = Column(Integer)  # hours of series that had anomalies
+    generated_at = Column(DateTime, default=datetime.utcnow)
+
+class IsrAsset(Base):
+    __tablename__ = 'isr_assets'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    type = Column(String)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    status = Column(String, default='available', index=True)
+    meta = Column('metadata', JSON)
+    tasking = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class PerfMetric(Base):
     __tablename__ = 'perf_metrics'
     id = Column(Integer, primary_key=True)
@@ -84,6 +283,29 @@ except Exception as e:
 
 # NEW: exportable helper to ensure schema on demand (e.g., via /migrate endpoint)
 
+# Columns and indexes added after first release. create_all only creates missing
+# tables (with their indexes), so existing databases get these here.
+_COLUMNS = [("data_events", "confidence", "{float} DEFAULT 0.5"), ("alert_deliveries", "notification_id", "INTEGER")]
+_INDEXES = [
+    ("idx_data_events_lat_lon", "data_events", "latitude, longitude"),
+    ("idx_data_events_timestamp", "data_events", "timestamp"),
+    ("idx_data_events_source_ts", "data_events", "source, timestamp"),
+    ("idx_anomalies_event_id", "anomalies", "event_id"),
+    ("idx_anomalies_timestamp", "anomalies", "timestamp"),
+    ("ix_alert_deliveries_notification_id", "alert_deliveries", "notification_id"),
+]
+
+def _migrate(eng):
+    from sqlalchemy import inspect, text
+    insp = inspect(eng)
+    float_type = "DOUBLE PRECISION" if eng.dialect.name == "postgresql" else "REAL"
+    with eng.begin() as conn:
+        for table, column, ddl in _COLUMNS:
+            if column not in {c["name"] for c in insp.get_columns(table)}:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl.format(float=float_type)}"))
+        for name, table, cols in _INDEXES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({cols})"))
+
 def ensure_schema():
     """
     Ensure database schema exists.
@@ -100,41 +322,14 @@ def ensure_schema():
                 connect_args={"sslmode": "require"}
             )
             Base.metadata.create_all(direct_engine)
-            try:
-                with direct_engine.connect() as conn:
-                    res = conn.execute("SELECT column_name FROM information_schema.columns WHERE table_name='data_events'").fetchall()
-                    cols = [r[0] for r in res]
-                    if 'confidence' not in cols:
-                        conn.execute("ALTER TABLE data_events ADD COLUMN confidence DOUBLE PRECISION DEFAULT 0.5")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_events_lat_lon ON data_events(latitude, longitude)")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_anomalies_event_id ON anomalies(event_id)")
-            except Exception:
-                pass
+            _migrate(direct_engine)
             return True, "schema ensured via DIRECT_URL"
         # If DIRECT_URL is missing and DATABASE_URL looks like a pgbouncer URL, return a clear message.
         if DATABASE_URL.startswith('postgresql') and (':6543' in DATABASE_URL or 'pgbouncer=true' in DATABASE_URL):
             return False, "DIRECT_URL not set. Please set DIRECT_URL to the Supabase 5432 connection string (not pgbouncer) and retry."
         # Fallback: try runtime engine (e.g., SQLite or direct Postgres without pgbouncer)
         Base.metadata.create_all(engine)
-        try:
-            if DATABASE_URL.startswith('sqlite'):
-                with engine.connect() as conn:
-                    rows = conn.execute("PRAGMA table_info('data_events')").fetchall()
-                    cols = [r[1] for r in rows]
-                    if 'confidence' not in cols:
-                        conn.execute("ALTER TABLE data_events ADD COLUMN confidence REAL DEFAULT 0.5")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_events_lat_lon ON data_events(latitude, longitude)")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_anomalies_event_id ON anomalies(event_id)")
-            elif DATABASE_URL.startswith('postgresql'):
-                with engine.connect() as conn:
-                    res = conn.execute("SELECT column_name FROM information_schema.columns WHERE table_name='data_events'").fetchall()
-                    cols = [r[0] for r in res]
-                    if 'confidence' not in cols:
-                        conn.execute("ALTER TABLE data_events ADD COLUMN confidence DOUBLE PRECISION DEFAULT 0.5")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_data_events_lat_lon ON data_events(latitude, longitude)")
-                    conn.execute("CREATE INDEX IF NOT EXISTS idx_anomalies_event_id ON anomalies(event_id)")
-        except Exception as _:
-            pass
+        _migrate(engine)
         return True, "schema ensured via runtime engine"
     except Exception as e:
         return False, str(e)
\ No newline at end of file
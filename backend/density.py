@@ -0,0 +1,160 @@
+import os
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from database import DataEvent, Anomaly, get_data_versions
+from analyst import SOURCES
+
+# Sliding-window event density at several resolutions.
+# Events are tailed from the database by id and binned once into hourly
+# buckets per resolution. A bucket is a sorted array of cell ids plus a
+# (cells x channels) float32 matrix; the channels are one count per source,
+# one confidence sum per source (so confidence scoring can honour a source
+# filter) and the sum of anomaly severity. A window total is
+# the merge of its buckets and is memoized per (resolution, window, grid
+# version), as is every top-K drawn from it, so repeated queries do no work
+# until new rows arrive. Buckets older than DENSITY_MAX_HOURS are dropped.
+# Windows are whole buckets: a 24 h window covers the current hour and the
+# 23 before it.
+#
+# Configuration (env): DENSITY_MAX_HOURS (168)
+
+RESOLUTIONS = (1.0, 0.25, 0.05)
+CHANNELS = SOURCES + ["other"]
+CONF = len(CHANNELS)  # first confidence channel; CONF + i is CHANNELS[i]'s
+SEV = CONF + len(CHANNELS)
+WIDTH = SEV + 1
+MAX_HOURS = int(os.getenv("DENSITY_MAX_HOURS", "168") or 168)
+
+def _hour(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def cell_ids(lat, lon, res):
+    cols = int(round(360 / res))
+    i = np.clip(((np.asarray(lat, dtype=np.float64) + 90.0) / res).astype(np.int64), 0, int(round(180 / res)) - 1)
+    j = np.clip(((np.asarray(lon, dtype=np.float64) + 180.0) / res).astype(np.int64), 0, cols - 1)
+    return i * cols + j
+
+def cell_center(cell, res):
+    i, j = divmod(int(cell), int(round(360 / res)))
+    return round((i + 0.5) * res - 90.0, 6), round((j + 0.5) * res - 180.0, 6)
+
+def _merge(parts):
+    """Sum (ids, values) pairs into one (sorted unique ids, values)."""
+    parts = [p for p in parts if len(p[0])]
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, WIDTH), dtype=np.float32)
+    ids = np.concatenate([p[0] for p in parts])
+    vals = np.concatenate([p[1] for p in parts])
+    uniq, inv = np.unique(ids, return_inverse=True)
+    out = np.zeros((len(uniq), WIDTH), dtype=np.float32)
+    np.add.at(out, inv, vals)
+    return uniq, out
+
+class DensityGrid:
+    def __init__(self):
+        self.buckets = {res: {} for res in RESOLUTIONS}  # res -> hour -> (ids, values)
+        self.last_ids = (0, 0)
+        self.versions = None
+        self.version = 0  # bumped whenever buckets change; keys the memo
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def _fold(self, hours, lats, lons, vals):
+        if not len(vals):
+            return
+        hours = np.asarray(hours)
+        for res, per_hour in self.buckets.items():
+            cells = cell_ids(lats, lons, res)
+            for h in np.unique(hours):
+                m = hours == h
+                per_hour[h] = _merge([per_hour.get(h, (np.zeros(0, dtype=np.int64), None)), (cells[m], vals[m])])
+
+    def refresh(self, session, now=None):
+        """Fold in rows past the last seen ids and drop expired buckets."""
+        now = now or datetime.utcnow()
+        versions = get_data_versions(session, "events", "anomalies")
+        oldest = _hour(now) - timedelta(hours=MAX_HOURS - 1)
+        with self._lock:
+            stale = [h for per_hour in self.buckets.values() for h in per_hour if h < oldest]
+            if versions == self.versions and not stale:
+                return self
+            le, la = self.last_ids
+            hi_e = session.query(func.max(DataEvent.id)).scalar() or 0
+            hi_a = session.query(func.max(Anomaly.id)).scalar() or 0
+            evs = session.query(DataEvent.timestamp, DataEvent.latitude, DataEvent.longitude, DataEvent.source, DataEvent.confidence).filter(
+                DataEvent.id > le, DataEvent.id <= hi_e, DataEvent.timestamp >= oldest,
+                DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)).all()
+            if evs:
+                col = {s: i for i, s in enumerate(CHANNELS)}
+                vals = np.zeros((len(evs), WIDTH), dtype=np.float32)
+                rows, cols = np.arange(len(evs)), np.array([col.get(e[3], col["other"]) for e in evs])
+                vals[rows, cols] = 1.0
+                vals[rows, CONF + cols] = [e[4] if e[4] is not None else 0.0 for e in evs]
+                self._fold([_hour(e[0]) for e in evs], [e[1] for e in evs], [e[2] for e in evs], vals)
+            ans = session.query(Anomaly.timestamp, DataEvent.latitude, DataEvent.longitude, Anomaly.severity).join(
+                DataEvent, DataEvent.id == Anomaly.event_id).filter(
+                Anomaly.id > la, Anomaly.id <= hi_a, Anomaly.timestamp >= oldest,
+                DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)).all()
+            if ans:
+                vals = np.zeros((len(ans), WIDTH), dtype=np.float32)
+                vals[:, SEV] = [a[3] or 0 for a in ans]
+                self._fold([_hour(a[0]) for a in ans], [a[1] for a in ans], [a[2] for a in ans], vals)
+            for per_hour in self.buckets.values():
+                for h in [h for h in per_hour if h < oldest]:
+                    del per_hour[h]
+            self.last_ids, self.versions = (hi_e, hi_a), versions
+            if evs or ans or stale:
+                self.version += 1
+                self._memo.clear()
+        return self
+
+    def window(self, res, hours, now=None):
+        """(cell ids, channel totals) over the last `hours` hourly buckets."""
+        first = _hour(now or datetime.utcnow()) - timedelta(hours=max(1, min(hours, MAX_HOURS)) - 1)
+        key = ("window", res, first)
+        with self._lock:
+            hit = self._memo.get(key)
+            if hit is None:
+                hit = self._memo[key] = _merge([v for h, v in self.buckets[res].items() if h >= first])
+            return hit
+
+    def top_k(self, res, hours, k=5, sources=None, severity_weight=0.0, use_confidence=False, now=None):
+        """[(cell, lat, lon, score)] of the k highest-scoring cells, best first."""
+        res = min(RESOLUTIONS, key=lambda r: abs(r - res))
+        srcs = tuple(sorted(sources)) if sources else None
+        first = _hour(now or datetime.utcnow()) - timedelta(hours=max(1, min(hours, MAX_HOURS)) - 1)
+        key = ("top", res, first, k, srcs, float(severity_weight), bool(use_confidence))
+        with self._lock:
+            hit = self._memo.get(key)
+        if hit is not None:
+            return hit
+        ids, vals = self.window(res, hours, now)
+        score = self.score(vals, srcs, severity_weight, use_confidence)
+        k = min(max(1, k), len(ids))
+        top = np.argpartition(-score, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        top = top[np.lexsort((ids[top], -score[top]))]
+        out = [(int(ids[i]), *cell_center(ids[i], res), float(score[i])) for i in top if score[i] > 0]
+        with self._lock:
+            if len(self._memo) > 512:
+                self._memo.clear()
+            self._memo[key] = out
+        return out
+
+    @staticmethod
+    def score(vals, sources=None, severity_weight=0.0, use_confidence=False):
+        offset = CONF if use_confidence else 0
+        if sources:
+            base = vals[:, [offset + CHANNELS.index(s) for s in sources if s in CHANNELS]].sum(axis=1, dtype=np.float64)
+        else:
+            base = vals[:, offset:offset + len(CHANNELS)].sum(axis=1, dtype=np.float64)
+        return base + severity_weight * vals[:, SEV]
+
+    def stats(self):
+        with self._lock:
+            return {"version": self.version, "last_ids": list(self.last_ids), "memo": len(self._memo),
+                    "buckets": {str(r): len(b) for r, b in self.buckets.items()},
+                    "cells": {str(r): int(sum(len(v[0]) for v in b.values())) for r, b in self.buckets.items()}}
+
+density = DensityGrid()
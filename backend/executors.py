@@ -0,0 +1,66 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Bounded thread pools for blocking work reached from async handlers.
+# Each peer type gets its own small pool plus a cap on queued calls, so a slow
+# peer (e.g. an online geocoding fallback) saturates only its own pool and callers get an
+# immediate ExecutorBusy instead of piling up behind it; the event loop and the
+# default threadpool stay free for /events and /anomalies.
+#
+# Configuration (env): EXECUTOR_<NAME>_WORKERS, EXECUTOR_<NAME>_QUEUE
+
+class ExecutorBusy(Exception):
+    pass
+
+class BoundedExecutor:
+    def __init__(self, name, workers=2, queue=16):
+        self.name = name
+        self.workers = max(1, int(os.getenv(f"EXECUTOR_{name.upper()}_WORKERS", workers)))
+        self.capacity = self.workers + max(0, int(os.getenv(f"EXECUTOR_{name.upper()}_QUEUE", queue)))
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"exec-{name}")
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _release(self, _fut):
+        self._slots.release()
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ExecutorBusy(f"{self.name} executor saturated ({self.capacity} calls in flight)")
+        with self._lock:
+            self.pending += 1
+        fut = self._pool.submit(fn, *args, **kwargs)
+        fut.add_done_callback(self._release)
+        return fut
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        """Run fn in this pool and await it. Raises ExecutorBusy when the pool is full."""
+        fut = asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(fut, timeout) if timeout else await fut
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "capacity": self.capacity, "pending": self.pending,
+                    "completed": self.completed, "rejected": self.rejected, "timeouts": self.timeouts}
+
+geocode_executor = BoundedExecutor("geocode", workers=4, queue=64)
+routing_executor = BoundedExecutor("routing", workers=4, queue=256)
+
+def executor_stats():
+    return {e.name: e.stats() for e in (geocode_executor, routing_executor)}
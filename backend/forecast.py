@@ -0,0 +1,185 @@
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+import schedule
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+from database import engine, DataEvent, Anomaly, AnomalySeries, Forecast, DetectorState, bump_data_version, hour_bucket, as_hour
+from geocoder import place_names
+
+# Anomaly rate forecasting.
+# update_series() folds anomalies past the "forecast" cursor into hourly
+# counts per source ("*") and per source and 1 degree cell. fit_forecasts()
+# loads the last FORECAST_HISTORY_H hours as one dense (series x hours)
+# matrix and fits additive Holt-Winters (daily season) to every series at
+# once: the recursion loops over time but is vectorized over series and over
+# a small smoothing-parameter grid, keeping the grid point with the lowest
+# one-step error per series. Results (with their place names) replace the
+# forecasts table, so /api/ai-analyst "predict" is a lookup.
+#
+# Configuration (env):
+#   FORECAST_INTERVAL_SEC (300)  FORECAST_HORIZON_H (6)  FORECAST_HISTORY_H (336)
+
+SEASON_H = 24
+INTERVAL_SEC = int(os.getenv("FORECAST_INTERVAL_SEC", "300") or 300)
+HORIZON_H = int(os.getenv("FORECAST_HORIZON_H", "6") or 6)
+HISTORY_H = int(os.getenv("FORECAST_HISTORY_H", str(14 * 24)) or 14 * 24)
+TOTAL = "*"
+PARAM_GRID = [(a, b, g) for a in (0.1, 0.3, 0.6) for b in (0.0, 0.05) for g in (0.05, 0.2)]
+
+Session = sessionmaker(bind=engine)
+
+def _cursor(session, name):
+    state = session.get(DetectorState, name)
+    if state is None:
+        state = DetectorState(name=name, last_id=0)
+        session.add(state)
+        session.flush()
+    return state
+
+def cell_key(lat, lon):
+    return f"{int(lat)},{int(lon)}"
+
+def update_series(session):
+    """Add anomalies since the last run to the hourly series. Returns how many were folded in."""
+    state = _cursor(session, "forecast")
+    lo = state.last_id or 0
+    hi = session.query(func.max(Anomaly.id)).scalar() or 0
+    if hi <= lo:
+        return 0
+    hour = hour_bucket(session, Anomaly.timestamp)
+    lat_b, lon_b = func.round(DataEvent.latitude), func.round(DataEvent.longitude)
+    rows = session.query(DataEvent.source, lat_b, lon_b, hour, func.count(Anomaly.id)).join(
+        DataEvent, DataEvent.id == Anomaly.event_id
+    ).filter(Anomaly.id > lo, Anomaly.id <= hi, Anomaly.timestamp.isnot(None)).group_by(DataEvent.source, lat_b, lon_b, hour).all()
+    deltas = Counter()
+    for src, la, lon, b, c in rows:
+        src = src or "unknown"
+        h = as_hour(b)
+        deltas[(src, TOTAL, h)] += c
+        if la is not None and lon is not None:
+            deltas[(src, cell_key(la, lon), h)] += c
+    for key, c in deltas.items():
+        row = session.get(AnomalySeries, key)
+        if row is None:
+            session.add(AnomalySeries(source=key[0], cell=key[1], hour=key[2], count=c))
+        else:
+            row.count += c
+    state.last_id = hi
+    state.updated_at = datetime.utcnow()
+    return sum(deltas[k] for k in deltas if k[1] == TOTAL)
+
+def holt_winters(Y, alpha, beta, gamma, season=SEASON_H):
+    """Additive Holt-Winters over the rows of Y (series x time); parameters are per row.
+
+    Returns final level, trend, seasonal state and one-step squared error."""
+    k, t_len = Y.shape
+    seasonal = t_len >= 2 * season
+    if seasonal:
+        level = Y[:, :season].mean(axis=1)
+        seas = Y[:, :season] - level[:, None]
+    else:
+        level = Y[:, 0].copy()
+        seas = np.zeros((k, season))
+        gamma = np.zeros(k)
+    trend = np.zeros(k)
+    sse = np.zeros(k)
+    for t in range(t_len):
+        y = Y[:, t]
+        s = seas[:, t % season]
+        sse += (y - (level + trend + s)) ** 2
+        new_level = alpha * (y - s) + (1 - alpha) * (level + trend)
+        trend = beta * (new_level - level) + (1 - beta) * trend
+        seas[:, t % season] = gamma * (y - new_level) + (1 - gamma) * s
+        level = new_level
+    return level, trend, seas, sse
+
+def forecast_matrix(Y, horizon=HORIZON_H, season=SEASON_H):
+    """Fit every series over the parameter grid; returns (K, horizon) non-negative forecasts."""
+    k, t_len = Y.shape
+    g = len(PARAM_GRID)
+    params = np.array(PARAM_GRID)
+    Yr = np.repeat(Y, g, axis=0)
+    alpha, beta, gamma = (np.tile(params[:, i], k) for i in range(3))
+    level, trend, seas, sse = holt_winters(Yr, alpha, beta, gamma, season)
+    best = sse.reshape(k, g).argmin(axis=1) + np.arange(k) * g
+    steps = np.arange(1, horizon + 1)
+    idx = (t_len + steps - 1) % season
+    out = level[best, None] + trend[best, None] * steps[None, :] + seas[best][:, idx]
+    return np.clip(out, 0.0, None)
+
+def fit_forecasts(session, now=None):
+    now = (now or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    first = now - timedelta(hours=HISTORY_H - 1)
+    rows = session.query(AnomalySeries.source, AnomalySeries.cell, AnomalySeries.hour, AnomalySeries.count).filter(
+        AnomalySeries.hour >= first, AnomalySeries.hour <= now
+    ).all()
+    keys = sorted({(r[0], r[1]) for r in rows})
+    session.query(Forecast).delete(synchronize_session=False)
+    if keys:
+        index = {k: i for i, k in enumerate(keys)}
+        Y = np.zeros((len(keys), HISTORY_H))
+        for src, cell, h, c in rows:
+            Y[index[(src, cell)], int((h - first).total_seconds() // 3600)] += c
+        f = forecast_matrix(Y)
+        expected = f.sum(axis=1)
+        active = (Y > 0).sum(axis=1)
+        cells = [tuple(float(v) for v in cell.split(",")) if cell != TOTAL else None for _, cell in keys]
+        named = [c for c in cells if c is not None]
+        names = iter(place_names(named) if named else [])
+        generated = datetime.utcnow()
+        for i, (src, cell) in enumerate(keys):
+            ll = cells[i]
+            session.add(Forecast(
+                source=src, cell=cell,
+                latitude=ll[0] if ll else None, longitude=ll[1] if ll else None,
+                name=next(names) if ll else None,
+                horizon_h=HORIZON_H,
+                expected_count=float(expected[i]),
+                probability=float(1.0 - np.exp(-expected[i])),  # P(at least one) under a Poisson rate
+                confidence=float(min(1.0, 0.5 + min(0.5, active[i] / 24.0))),
+                history_h=int(active[i]),
+                generated_at=generated,
+            ))
+    session.query(AnomalySeries).filter(AnomalySeries.hour < first).delete(synchronize_session=False)
+    bump_data_version(session, "forecasts")
+    return len(keys)
+
+def run_forecast():
+    try:
+        with Session() as session:
+            folded = update_series(session)
+            session.commit()
+            n = fit_forecasts(session)
+            session.commit()
+            print(f"Forecast: folded {folded} anomalies, {n} series")
+    except Exception as e:
+        print(f"Forecast failed: {e}")
+
+def schedule_forecasting():
+    run_forecast()
+    schedule.every(INTERVAL_SEC).seconds.do(run_forecast)
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
+
+def lookup(session, sources=None, cell_filters=(), per_source=3):
+    """Stored forecasts: (per-source predictions, top cells per source)."""
+    q = session.query(Forecast)
+    if sources:
+        q = q.filter(Forecast.source.in_(sources))
+    preds, points = [], []
+    for f in q.filter(Forecast.cell == TOTAL).order_by(Forecast.source).all():
+        preds.append({"source": f.source, "next_hours": f.horizon_h, "probability": f.probability,
+                      "expected_count": f.expected_count, "confidence": f.confidence,
+                      "generated_at": f.generated_at.isoformat() if f.generated_at else None})
+    taken = Counter()
+    for f in q.filter(Forecast.cell != TOTAL, *cell_filters).order_by(Forecast.source, Forecast.expected_count.desc(), Forecast.cell).all():
+        if taken[f.source] >= per_source:
+            continue
+        taken[f.source] += 1
+        points.append({"source": f.source, "latitude": f.latitude, "longitude": f.longitude, "name": f.name or "Unknown",
+                       "probability": f.probability, "expected_count": f.expected_count, "next_hours": f.horizon_h})
+    return preds, points
@@ -0,0 +1,274 @@
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Offline reverse geocoder.
+# Places come from a gazetteer file: the bundled data/places.csv (major cities,
+# capitals and remote outposts) or a GeoNames dump (cities500.txt,
+# cities15000.txt, allCountries.txt) named by GAZETTEER_PATH. The parsed
+# coordinates and names are compiled once into .npy files and memory-mapped on
+# later starts; lookups are nearest-neighbour queries on a KD-tree over unit
+# sphere xyz, where chord length is monotonic in great-circle distance.
+#
+# Configuration (env):
+#   GAZETTEER_PATH          places.csv-style CSV or GeoNames tab-separated dump
+#   GAZETTEER_CACHE_DIR     where compiled arrays go (default: next to the file, else tmp)
+#   GEOCODER_MAX_KM (300)   beyond this a point has no nearest place ("Unknown")
+#   NOMINATIM_URL           optional online fallback for points beyond GEOCODER_MAX_KM;
+#                           never used unless set
+
+EARTH_R_KM = 6371.0088
+BUNDLED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "places.csv")
+_COMPILE_VERSION = 1
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def _to_xyz(lats, lons):
+    la = np.radians(np.asarray(lats, dtype=np.float64))
+    lo = np.radians(np.asarray(lons, dtype=np.float64))
+    c = np.cos(la)
+    return np.column_stack((c * np.cos(lo), c * np.sin(lo), np.sin(la)))
+
+def _read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                yield (row["name"], row.get("country_code") or "", row.get("country") or "", row.get("admin1") or "",
+                       float(row["latitude"]), float(row["longitude"]), int(float(row.get("population") or 0)))
+            except Exception:
+                continue
+
+def _read_geonames(path):
+    # GeoNames main table; admin1 names and country names come from the
+    # admin1CodesASCII.txt / countryInfo.txt companions when they sit alongside
+    base = os.path.dirname(path)
+    admin1 = {}
+    countries = {}
+    try:
+        with open(os.path.join(base, "admin1CodesASCII.txt"), encoding="utf-8") as f:
+            for line in f:
+                p = line.rstrip("\n").split("\t")
+                if len(p) >= 2:
+                    admin1[p[0]] = p[1]
+    except Exception:
+        pass
+    try:
+        with open(os.path.join(base, "countryInfo.txt"), encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                p = line.rstrip("\n").split("\t")
+                if len(p) >= 5:
+                    countries[p[0]] = p[4]
+    except Exception:
+        pass
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            p = line.rstrip("\n").split("\t")
+            if len(p) < 15:
+                continue
+            if p[6] not in ("P", "A"):  # populated places and admin seats only
+                continue
+            try:
+                cc = p[8]
+                yield (p[1], cc, countries.get(cc, ""), admin1.get(f"{cc}.{p[10]}", ""),
+                       float(p[4]), float(p[5]), int(p[14] or 0))
+            except Exception:
+                continue
+
+def _cache_dir(path):
+    d = os.getenv("GAZETTEER_CACHE_DIR")
+    if d:
+        return d
+    near = os.path.join(os.path.dirname(os.path.abspath(path)), ".geocoder_cache")
+    try:
+        os.makedirs(near, exist_ok=True)
+        if os.access(near, os.W_OK):
+            return near
+    except Exception:
+        pass
+    return os.path.join(tempfile.gettempdir(), "rtaip_geocoder_cache")
+
+class Gazetteer:
+    def __init__(self, path=None):
+        self.path = path or os.getenv("GAZETTEER_PATH") or BUNDLED_PATH
+        self.max_km = _env_float("GEOCODER_MAX_KM", 300)
+        self._load()
+
+    def _fingerprint(self):
+        st = os.stat(self.path)
+        h = hashlib.sha1(f"{os.path.abspath(self.path)}|{st.st_size}|{st.st_mtime_ns}|{_COMPILE_VERSION}".encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def _load(self):
+        d = os.path.join(_cache_dir(self.path), self._fingerprint())
+        if not os.path.exists(os.path.join(d, "meta.json")):
+            self._compile(d)
+        with open(os.path.join(d, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        mm = lambda n: np.load(os.path.join(d, n + ".npy"), mmap_mode="r")
+        self.lat = mm("lat")
+        self.lon = mm("lon")
+        self.population = mm("population")
+        self._country_idx = mm("country_idx")
+        self._admin1_idx = mm("admin1_idx")
+        self._name_off = mm("name_off")
+        self._name_blob = mm("names")
+        self._cc = meta["country_codes"]
+        self._countries = meta["countries"]
+        self._admin1 = meta["admin1"]
+        self.size = int(meta["size"])
+        self.tree = cKDTree(_to_xyz(self.lat, self.lon)) if self.size else None
+
+    def _compile(self, d):
+        reader = _read_geonames if self.path.endswith(".txt") else _read_csv
+        rows = list(reader(self.path))
+        # Country names missing from a GeoNames dump fall back to the bundled table
+        fallback = {}
+        if reader is _read_geonames and os.path.exists(BUNDLED_PATH):
+            fallback = {r[1]: r[2] for r in _read_csv(BUNDLED_PATH)}
+        cc_index, countries, admin1_index, admin1 = {}, [], {}, []
+        country_idx = np.empty(len(rows), dtype=np.int32)
+        admin1_idx = np.empty(len(rows), dtype=np.int32)
+        name_off = np.zeros(len(rows) + 1, dtype=np.int64)
+        blob = bytearray()
+        for i, (name, cc, country, adm, _, _, _) in enumerate(rows):
+            if cc not in cc_index:
+                cc_index[cc] = len(countries)
+                countries.append(country or fallback.get(cc, "") or cc)
+            country_idx[i] = cc_index[cc]
+            if adm not in admin1_index:
+                admin1_index[adm] = len(admin1)
+                admin1.append(adm)
+            admin1_idx[i] = admin1_index[adm]
+            blob += name.encode("utf-8")
+            name_off[i + 1] = len(blob)
+        tmp = d + ".tmp"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "lat.npy"), np.array([r[4] for r in rows], dtype=np.float64))
+        np.save(os.path.join(tmp, "lon.npy"), np.array([r[5] for r in rows], dtype=np.float64))
+        np.save(os.path.join(tmp, "population.npy"), np.array([r[6] for r in rows], dtype=np.int64))
+        np.save(os.path.join(tmp, "country_idx.npy"), country_idx)
+        np.save(os.path.join(tmp, "admin1_idx.npy"), admin1_idx)
+        np.save(os.path.join(tmp, "name_off.npy"), name_off)
+        np.save(os.path.join(tmp, "names.npy"), np.frombuffer(bytes(blob), dtype=np.uint8))
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"size": len(rows), "source": self.path, "country_codes": list(cc_index), "countries": countries, "admin1": admin1}, f)
+        try:
+            os.replace(tmp, d)
+        except OSError:
+            # Another process compiled the same file first
+            pass
+
+    def _name(self, i):
+        return bytes(self._name_blob[self._name_off[i]:self._name_off[i + 1]]).decode("utf-8")
+
+    def nearest(self, lats, lons, k=1):
+        """Vectorized nearest-place query. Returns (distance_km, index) arrays."""
+        if self.tree is None:
+            n = len(np.atleast_1d(lats))
+            return np.full(n, np.inf), np.full(n, -1)
+        chord, idx = self.tree.query(_to_xyz(np.atleast_1d(lats), np.atleast_1d(lons)), k=k)
+        dist = 2.0 * np.arcsin(np.clip(chord / 2.0, 0.0, 1.0)) * EARTH_R_KM
+        return dist, idx
+
+    def place(self, i, distance_km=None):
+        ci = int(self._country_idx[i])
+        out = {
+            "name": self._name(i),
+            "country_code": self._cc[ci],
+            "country": self._countries[ci],
+            "admin1": self._admin1[int(self._admin1_idx[i])] or None,
+            "latitude": float(self.lat[i]),
+            "longitude": float(self.lon[i]),
+            "population": int(self.population[i]),
+        }
+        if distance_km is not None:
+            out["distance_km"] = round(float(distance_km), 2)
+        return out
+
+    def lookup_batch(self, coords, max_km=None):
+        """coords: iterable of (lat, lon). Returns a place dict, or None beyond max_km, per coordinate."""
+        coords = [(la, lo) for la, lo in coords]
+        if not coords:
+            return []
+        limit = self.max_km if max_km is None else max_km
+        arr = np.array([(np.nan if la is None else la, np.nan if lo is None else lo) for la, lo in coords], dtype=np.float64)
+        ok = ~np.isnan(arr).any(axis=1)
+        out = [None] * len(coords)
+        if ok.any():
+            dist, idx = self.nearest(arr[ok, 0], arr[ok, 1])
+            for j, d, i in zip(np.flatnonzero(ok), dist, idx):
+                if i >= 0 and d <= limit:
+                    out[j] = self.place(int(i), d)
+        return out
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer()
+    return _gazetteer
+
+def reverse_geocode(lat, lon):
+    return reverse_geocode_batch([(lat, lon)])[0]
+
+def reverse_geocode_batch(coords):
+    return get_gazetteer().lookup_batch(coords)
+
+def format_place(p):
+    if not p:
+        return "Unknown"
+    return f"{p['name']}, {p['country']}" if p.get("country") else p["name"]
+
+def place_names(coords):
+    """Display names ("City, Country") for many coordinates at once."""
+    coords = list(coords)
+    names = [format_place(p) for p in reverse_geocode_batch(coords)]
+    if os.getenv("NOMINATIM_URL"):
+        for i, (la, lo) in enumerate(coords):
+            if names[i] == "Unknown" and la is not None and lo is not None:
+                names[i] = _nominatim_name(la, lo) or "Unknown"
+    return names
+
+def place_name(lat, lon):
+    return place_names([(lat, lon)])[0]
+
+def _nominatim_name(lat, lon):
+    from cache import response_cache
+    key = f"geo:{round(lat,4)},{round(lon,4)}"
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    name = None
+    try:
+        import requests
+        url = os.getenv("NOMINATIM_URL").rstrip("/") + "/reverse"
+        params = {"format": "jsonv2", "lat": str(lat), "lon": str(lon)}
+        r = requests.get(url, params=params, headers={"User-Agent": "RTAIP/1.0"}, timeout=6)
+        if r.ok:
+            j = r.json()
+            addr = j.get("address") or {}
+            city = addr.get("city") or addr.get("town") or addr.get("village") or addr.get("hamlet")
+            country = addr.get("country")
+            if city and country:
+                name = f"{city}, {country}"
+            elif j.get("display_name"):
+                name = j["display_name"].split(",")[0]
+    except Exception:
+        pass
+    response_cache.set(key, name or "Unknown", ttl_sec=86400)
+    return name
@@ -0,0 +1,104 @@
+import struct
+import zlib
+import numpy as np
+from datetime import datetime, timedelta
+from scipy import ndimage
+from database import DataEvent, Anomaly
+
+# Kernel-density heatmaps.
+# The points of a layer/window are loaded once as column arrays (lat, lon,
+# source code, weight) and cached per data version; a request then masks the
+# bbox and sources, bins with histogram2d and smooths with a separable
+# Gaussian (two 1-D passes). Rasters are row-major with row 0 at max_lat and
+# come back either as raw little-endian float32 or as an RGBA PNG encoded here
+# (zlib + CRC chunks), so no imaging dependency is needed. The bandwidth is
+# capped at MAX_BANDWIDTH_KM and the kernel at the raster size, since filter
+# cost grows with sigma and a wider kernel only flattens the grid.
+
+MAX_PIXELS = 2048
+MAX_BANDWIDTH_KM = 500.0
+KM_PER_DEG = 111.32
+
+class PointColumns:
+    def __init__(self, lats, lons, sources, weights):
+        self.lat = np.asarray(lats, dtype=np.float64)
+        self.lon = np.asarray(lons, dtype=np.float64)
+        names, codes = np.unique(np.array(sources, dtype=str), return_inverse=True) if len(sources) else ([], [])
+        self.source_names = list(names)
+        self.src = np.asarray(codes, dtype=np.int32)
+        self.weight = np.asarray(weights, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.lat.nbytes + self.lon.nbytes + self.src.nbytes + self.weight.nbytes
+
+def event_columns(session, hours):
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = session.query(DataEvent.latitude, DataEvent.longitude, DataEvent.source).filter(
+        DataEvent.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)).all()
+    return PointColumns([r[0] for r in rows], [r[1] for r in rows], [r[2] or "unknown" for r in rows], np.ones(len(rows)))
+
+def anomaly_columns(session, hours):
+    # Anomalies weigh by severity
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = session.query(DataEvent.latitude, DataEvent.longitude, DataEvent.source, Anomaly.severity).join(
+        DataEvent, DataEvent.id == Anomaly.event_id).filter(
+        Anomaly.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)).all()
+    return PointColumns([r[0] for r in rows], [r[1] for r in rows], [r[2] or "unknown" for r in rows], [max(1, r[3] or 0) for r in rows])
+
+def grid_shape(bbox, res=None, width=512):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    res = res or (max_lon - min_lon) / max(1, width)
+    cols = int(np.ceil((max_lon - min_lon) / res))
+    rows = int(np.ceil((max_lat - min_lat) / res))
+    scale = max(1.0, max(rows, cols) / MAX_PIXELS)
+    return max(1, int(rows / scale)), max(1, int(cols / scale))
+
+def clamp_bandwidth(km):
+    return max(0.0, min(float(km), MAX_BANDWIDTH_KM))
+
+def density(points, bbox, shape, sources=None, bandwidth_km=25.0):
+    """Smoothed weighted density over bbox as a (rows, cols) float32 array, north up."""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    rows, cols = shape
+    m = (points.lat >= min_lat) & (points.lat <= max_lat) & (points.lon >= min_lon) & (points.lon <= max_lon)
+    if sources:
+        codes = [i for i, s in enumerate(points.source_names) if s in sources]
+        m &= np.isin(points.src, codes)
+    h, _, _ = np.histogram2d(points.lat[m], points.lon[m], bins=(rows, cols),
+                             range=((min_lat, max_lat), (min_lon, max_lon)), weights=points.weight[m])
+    bandwidth_km = clamp_bandwidth(bandwidth_km)
+    if bandwidth_km > 0:
+        mid = np.radians((min_lat + max_lat) / 2.0)
+        sy = min(rows, bandwidth_km / (KM_PER_DEG * (max_lat - min_lat) / rows))
+        sx = min(cols, bandwidth_km / (KM_PER_DEG * max(0.05, np.cos(mid)) * (max_lon - min_lon) / cols))
+        h = ndimage.gaussian_filter1d(h, sy, axis=0, mode="constant", truncate=3.0)
+        h = ndimage.gaussian_filter1d(h, sx, axis=1, mode="constant", truncate=3.0)
+    return np.ascontiguousarray(h[::-1], dtype=np.float32)
+
+# Transparent -> blue -> yellow -> red
+_RAMP = np.array([[0, 0, 255, 0], [0, 128, 255, 140], [255, 255, 0, 200], [255, 0, 0, 240]], dtype=np.float64)
+
+def colorize(grid):
+    peak = float(grid.max())
+    t = np.sqrt(grid / peak) if peak > 0 else np.zeros_like(grid)
+    x = t * (len(_RAMP) - 1)
+    i = np.minimum(x.astype(np.int64), len(_RAMP) - 2)
+    f = (x - i)[..., None]
+    rgba = _RAMP[i] * (1 - f) + _RAMP[i + 1] * f
+    rgba[grid <= 0] = 0
+    return rgba.astype(np.uint8)
+
+def _chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def encode_png(rgba):
+    h, w, _ = rgba.shape
+    raw = np.zeros((h, w * 4 + 1), dtype=np.uint8)  # filter byte 0 per scanline
+    raw[:, 1:] = rgba.reshape(h, w * 4)
+    return (b"\x89PNG\r\n\x1a\n"
+            + _chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0))
+            + _chunk(b"IDAT", zlib.compress(raw.tobytes(), 6))
+            + _chunk(b"IEND", b""))
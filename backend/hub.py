@@ -0,0 +1,302 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from sqlalchemy import select, func
+from database import AsyncSessionLocal, DataEvent, Anomaly, AlertDelivery
+
+# WebSocket broadcast hub.
+# Lives on the server's event loop. A feeder task tails new events, anomalies
+# and alert deliveries by id, so rows written by any process (the detect
+# worker, another API worker) reach this process's clients. publish() is safe
+# to call from any thread for in-process items; it hands them to the loop,
+# which fans them out to every matching client. Each client has a bounded pending buffer drained by
+# its own sender task, so one slow socket never delays the others. When a
+# client falls more than HUB_QUEUE_MAX items behind, its pending deltas are
+# dropped and the next message carries resync=true so it can refetch.
+# Alerts come from the alert ledger, one row per (rule, anomaly): JSON clients
+# get every delivery, legacy text clients one line per anomaly. The sources and
+# bbox filters apply to alerts as to the other channels.
+#
+# Protocol:
+#   text "subscribe: ..."      legacy mode, alert lines as plain text (AlertBar)
+#   {"action": "subscribe", "channels": ["events", "anomalies", "alerts"],
+#    "sources": ["adsb", ...], "bbox": [min_lat, min_lon, max_lat, max_lon]}
+#       -> {"type": "delta", "events": [...], "anomalies": [...], "alerts": [...], "resync": false}
+#          (channels with nothing new are left out)
+#
+# Configuration (env): HUB_QUEUE_MAX (500), HUB_SEND_TIMEOUT (10), HUB_POLL_SEC (1), HUB_BATCH (5000)
+
+CHANNELS = ("events", "anomalies", "alerts")
+MAX_ALERTS_PENDING = 50
+MAX_SEEN_ANOMALIES = 1000
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def compact_event(ev):
+    return {"id": ev.id, "src": ev.source, "ts": ev.timestamp.isoformat() if ev.timestamp else None,
+            "lat": ev.latitude, "lon": ev.longitude, "conf": ev.confidence}
+
+def compact_anomaly(a, ev=None):
+    return {"id": a.id, "eid": a.event_id, "type": a.type, "sev": a.severity,
+            "ts": a.timestamp.isoformat() if a.timestamp else None,
+            "src": ev.source if ev is not None else None,
+            "lat": ev.latitude if ev is not None else None,
+            "lon": ev.longitude if ev is not None else None}
+
+def compact_alert(d, a, ev=None):
+    src = ev.source if ev is not None else None
+    lat = ev.latitude if ev is not None else None
+    lon = ev.longitude if ev is not None else None
+    return {"text": f"ANOMALY {a.type} sev={a.severity} src={src} at ({lat},{lon})", "delivery_id": d.id, "rule_id": d.rule_id,
+            "anomaly_id": a.id, "event_id": a.event_id, "type": a.type, "sev": a.severity, "src": src, "lat": lat, "lon": lon}
+
+class _Client:
+    def __init__(self, ws, max_queue):
+        self.ws = ws
+        self.max_queue = max_queue
+        self.mode = "text"
+        self.channels = {"alerts"}
+        self.sources = None
+        self.bbox = None
+        self.pending = {c: [] for c in CHANNELS}
+        self.size = 0
+        self.resync = False
+        self.dropped = 0
+        self.seen = OrderedDict()  # anomaly ids already alerted to a text client
+        self.wake = asyncio.Event()
+        self.task = None
+
+    def subscribe(self, msg):
+        chans = [c for c in (msg.get("channels") or CHANNELS) if c in CHANNELS]
+        self.channels = set(chans)
+        srcs = msg.get("sources")
+        self.sources = set(s.lower() for s in srcs) if srcs else None
+        bbox = msg.get("bbox")
+        if isinstance(bbox, str):
+            bbox = [p.strip() for p in bbox.split(",")]
+        self.bbox = tuple(float(v) for v in bbox) if bbox and len(bbox) == 4 else None
+        self.mode = "json"
+
+    def wants(self, channel, item):
+        if channel not in self.channels:
+            return False
+        if self.sources is not None and (item.get("src") or "").lower() not in self.sources:
+            return False
+        if self.bbox is not None:
+            lat, lon = item.get("lat"), item.get("lon")
+            if lat is None or lon is None:
+                return False
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                return False
+        return True
+
+    def offer(self, channel, entries):
+        if self.mode == "text" and channel != "alerts":
+            return
+        picked = [e for e in entries if self.wants(channel, e[0])]
+        if self.mode == "text":
+            picked = [e for e in picked if self._first_alert(e[0].get("anomaly_id"))]
+        if not picked:
+            return
+        if channel == "alerts":
+            buf = self.pending["alerts"]
+            buf.extend(picked)
+            del buf[:-MAX_ALERTS_PENDING]
+        elif self.size + len(picked) > self.max_queue:
+            # Slow consumer: coalesce everything queued into a resync marker
+            self.dropped += self.size + len(picked)
+            self.pending["events"] = []
+            self.pending["anomalies"] = []
+            self.size = 0
+            self.resync = True
+        else:
+            self.pending[channel].extend(picked)
+            self.size += len(picked)
+        self.wake.set()
+
+    def _first_alert(self, anomaly_id):
+        # Several rules can match one anomaly; a text client shows it once
+        if anomaly_id in self.seen:
+            return False
+        self.seen[anomaly_id] = True
+        if len(self.seen) > MAX_SEEN_ANOMALIES:
+            self.seen.popitem(last=False)
+        return True
+
+    def take(self):
+        out = self.pending, self.resync
+        self.pending = {c: [] for c in CHANNELS}
+        self.size = 0
+        self.resync = False
+        return out
+
+class Hub:
+    def __init__(self):
+        self.loop = None
+        self.clients = set()
+        self.max_queue = int(_env_float("HUB_QUEUE_MAX", 500))
+        self.send_timeout = _env_float("HUB_SEND_TIMEOUT", 10)
+        self.poll_sec = _env_float("HUB_POLL_SEC", 1)
+        self.batch = int(_env_float("HUB_BATCH", 5000))
+        self._feeder = None
+        self.published = 0
+        self.dropped = 0
+        self.disconnects = 0
+
+    def attach(self, loop=None):
+        if self.loop is None:
+            self.loop = loop or asyncio.get_running_loop()
+        return self
+
+    def publish(self, channel, items):
+        """Thread-safe: queue items (dicts) for every client subscribed to channel."""
+        if self.loop is None or not items:
+            return
+        entries = [(i, json.dumps(i, default=str, separators=(",", ":"))) for i in items]
+        try:
+            self.loop.call_soon_threadsafe(self._fanout, channel, entries)
+        except RuntimeError:
+            pass  # loop closed during shutdown
+
+    def _fanout(self, channel, entries):
+        self.published += len(entries)
+        for c in list(self.clients):
+            c.offer(channel, entries)
+
+    async def serve(self, ws):
+        """Run one client connection until it closes."""
+        self.attach()
+        self._ensure_feeder()
+        await ws.accept()
+        client = _Client(ws, self.max_queue)
+        self.clients.add(client)
+        client.task = asyncio.ensure_future(self._sender(client))
+        try:
+            while True:
+                raw = await ws.receive_text()
+                reply = self._handle(client, raw)
+                if reply is not None:
+                    await ws.send_text(json.dumps(reply))
+        except Exception:
+            pass
+        finally:
+            self.clients.discard(client)
+            self.dropped += client.dropped
+            client.task.cancel()
+
+    def _handle(self, client, raw):
+        text = (raw or "").strip()
+        if not text.startswith("{"):
+            # Legacy clients send "subscribe: anomalies" and read plain-text alert lines
+            return None
+        try:
+            msg = json.loads(text)
+            action = msg.get("action")
+            if action == "subscribe":
+                client.subscribe(msg)
+                return {"type": "subscribed", "channels": sorted(client.channels),
+                        "sources": sorted(client.sources) if client.sources else None,
+                        "bbox": list(client.bbox) if client.bbox else None}
+            if action == "ping":
+                return {"type": "pong"}
+            return {"type": "error", "error": f"unknown action {action!r}"}
+        except Exception as e:
+            return {"type": "error", "error": str(e)}
+
+    async def _sender(self, client):
+        try:
+            while True:
+                await client.wake.wait()
+                client.wake.clear()
+                pending, resync = client.take()
+                if client.mode == "text":
+                    for item, _ in pending["alerts"]:
+                        await asyncio.wait_for(client.ws.send_text(item.get("text") or ""), self.send_timeout)
+                    continue
+                # Fragments were encoded once at publish time and are shared by all clients
+                parts = [f'"{c}":[' + ",".join(frag for _, frag in pending[c]) + "]" for c in CHANNELS if pending[c]]
+                msg = '{"type":"delta",' + "".join(p + "," for p in parts) + f'"resync":{"true" if resync else "false"}}}'
+                await asyncio.wait_for(client.ws.send_text(msg), self.send_timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Send timed out or the socket died: drop the client
+            self.disconnects += 1
+            self.clients.discard(client)
+            try:
+                await client.ws.close()
+            except Exception:
+                pass
+
+    def _ensure_feeder(self):
+        if self._feeder is None or self._feeder.done():
+            self._feeder = asyncio.ensure_future(self._feed())
+
+    async def _feed(self):
+        # Tail new rows by id so writes from any thread or process reach subscribers
+        async with AsyncSessionLocal() as db:
+            last_e = (await db.execute(select(func.max(DataEvent.id)))).scalar() or 0
+            last_a = (await db.execute(select(func.max(Anomaly.id)))).scalar() or 0
+            last_d = (await db.execute(select(func.max(AlertDelivery.id)))).scalar() or 0
+        while True:
+            await asyncio.sleep(self.poll_sec)
+            try:
+                wanted = set()
+                for c in self.clients:
+                    # Text-mode (legacy) clients only ever receive alerts
+                    wanted |= c.channels if c.mode == "json" else {"alerts"} & c.channels
+                async with AsyncSessionLocal() as db:
+                    if "events" in wanted:
+                        rows = (await db.execute(
+                            select(DataEvent).where(DataEvent.id > last_e).order_by(DataEvent.id).limit(self.batch)
+                        )).scalars().all()
+                        if rows:
+                            last_e = rows[-1].id
+                            self._fanout("events", [(i, json.dumps(i, separators=(",", ":"))) for i in map(compact_event, rows)])
+                    else:
+                        last_e = (await db.execute(select(func.max(DataEvent.id)))).scalar() or last_e
+                    if "anomalies" in wanted:
+                        rows = (await db.execute(
+                            select(Anomaly, DataEvent).outerjoin(DataEvent, DataEvent.id == Anomaly.event_id)
+                            .where(Anomaly.id > last_a).order_by(Anomaly.id).limit(self.batch)
+                        )).all()
+                        if rows:
+                            last_a = rows[-1][0].id
+                            items = [compact_anomaly(a, ev) for a, ev in rows]
+                            self._fanout("anomalies", [(i, json.dumps(i, separators=(",", ":"))) for i in items])
+                    else:
+                        last_a = (await db.execute(select(func.max(Anomaly.id)))).scalar() or last_a
+                    if "alerts" in wanted:
+                        rows = (await db.execute(
+                            select(AlertDelivery, Anomaly, DataEvent).join(Anomaly, Anomaly.id == AlertDelivery.anomaly_id)
+                            .outerjoin(DataEvent, DataEvent.id == Anomaly.event_id)
+                            .where(AlertDelivery.id > last_d).order_by(AlertDelivery.id).limit(self.batch)
+                        )).all()
+                        if rows:
+                            last_d = rows[-1][0].id
+                            items = [compact_alert(d, a, ev) for d, a, ev in rows]
+                            self._fanout("alerts", [(i, json.dumps(i, separators=(",", ":"))) for i in items])
+                    else:
+                        last_d = (await db.execute(select(func.max(AlertDelivery.id)))).scalar() or last_d
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Hub feeder error: {e}")
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "json_clients": sum(1 for c in self.clients if c.mode == "json"),
+            "published": self.published,
+            "dropped": self.dropped + sum(c.dropped for c in self.clients),
+            "disconnects": self.disconnects,
+            "max_queue": self.max_queue,
+        }
+
+hub = Hub()
@@ -5,7 +5,7 @@ import schedule
 import time
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker
-from database import engine, DataEvent, Anomaly
+from database import engine, DataEvent, Anomaly, bump_data_version
 
 Session = sessionmaker(bind=engine)
 
@@ -27,6 +27,7 @@ async def ingest_nasa_fires():
             for item in data:  # Assuming list of fires
                 event = DataEvent(source="nasa_fires", timestamp=datetime.utcnow(), latitude=item.get('latitude'), longitude=item.get('longitude'), data=item)
                 session.add(event)
+    bump_data_version(session, "events")
     session.commit()
 
 async def ingest_nasa_eonet():
@@ -58,6 +59,7 @@ async def ingest_nasa_eonet():
                     pass
                 event = DataEvent(source="nasa_eonet", timestamp=ts, latitude=lat, longitude=lon, data=ev, confidence=conf)
                 session.add(event)
+            bump_data_version(session, "events")
             session.commit()
 
 async def ingest_gdacs_disasters():
@@ -99,6 +101,7 @@ async def ingest_gdacs_disasters():
                         pass
                     event = DataEvent(source="gdacs_disasters", timestamp=ts, latitude=lat, longitude=lon, data=feat, confidence=conf)
                     session.add(event)
+                bump_data_version(session, "events")
                 session.commit()
     except Exception as e:
         print(f"GDACS ingestion failed: {e}")
@@ -123,6 +126,7 @@ async def ingest_noaa_weather():
             conf = _confidence_for_noaa(props)
             event = DataEvent(source="noaa_weather", timestamp=datetime.utcnow(), latitude=34.0, longitude=-118.0, data=props, confidence=conf)  # Example coords
             session.add(event)
+            bump_data_version(session, "events")
             session.commit()
 
 def _confidence_for_adsb(state):
@@ -149,6 +153,7 @@ async def ingest_adsb_aircraft():
                 conf = _confidence_for_adsb(state)
                 event = DataEvent(source="adsb", timestamp=datetime.utcnow(), latitude=state[6], longitude=state[5], data=state, confidence=conf)
                 session.add(event)
+            bump_data_version(session, "events")
             session.commit()
 
 def _confidence_for_ais(item):
@@ -175,6 +180,7 @@ async def ingest_ais_maritime():
                 conf = _confidence_for_ais(item)
                 event = DataEvent(source="ais", timestamp=datetime.utcnow(), latitude=item.get('lat'), longitude=item.get('lon'), data=item, confidence=conf)
                 session.add(event)
+            bump_data_version(session, "events")
             session.commit()
 
 def _confidence_for_usgs(feature):
@@ -199,6 +205,7 @@ async def ingest_usgs_seismic():
                 conf = _confidence_for_usgs(feature)
                 event = DataEvent(source="usgs_seismic", timestamp=datetime.utcnow(), latitude=coords[1], longitude=coords[0], data=feature, confidence=conf)
                 session.add(event)
+            bump_data_version(session, "events")
             session.commit()
 
 # Removed Reddit ingestion (ingest_reddit_social) as it is not relevant and lacked geolocation
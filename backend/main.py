@@ -1,7 +1,6 @@
 from fastapi import FastAPI
 import threading
-from ingestion import schedule_ingestion, run_ingestion
-from anomaly import schedule_detection
+from ingestion import run_ingestion
 from database import ensure_schema
 
 app = FastAPI()
@@ -10,16 +9,38 @@ app = FastAPI()
 def read_root():
     return {"Hello": "World"}
 
-from fastapi import FastAPI, Depends, WebSocket
+from fastapi import FastAPI, Depends, WebSocket, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from database import Session, DataEvent, Anomaly, AlertRule, PerfMetric
+from database import Session, DataEvent, Anomaly, AlertRule, AlertDelivery, PerfMetric, DetectorRule, Notification, Incident, IncidentMember, bump_data_version, AsyncSessionLocal, get_data_versions, get_data_versions_async
+from rules import compile_rule, serialize_rule
+from correlation import serialize_incident
+from notify import enqueue_email, get_dispatcher, outbox_stats, smtp_config, start_dispatcher
+from cache import response_cache
+from geocoder import place_names, place_name, reverse_geocode_batch, get_gazetteer
+from executors import geocode_executor, routing_executor, executor_stats, ExecutorBusy
+from hub import hub
+from admission import admission, AdmissionMiddleware
+from telemetry import telemetry, TelemetryMiddleware, profile as sample_profile, collapsed
+from serialization import fragments, json_array, EncodedBody, encoded_response, dumps
+from tiles import build_event_index, build_anomaly_index, encode_tile, MAX_ZOOM
+import analyst
+from density import density, RESOLUTIONS as DENSITY_RESOLUTIONS, cell_ids as density_cell_ids, cell_center as density_cell_center
+from assets import registry as asset_registry
+from heatmap import event_columns, anomaly_columns, grid_shape as heatmap_grid_shape, density as heatmap_density, clamp_bandwidth, colorize, encode_png
+from replay import load_track, filter_track, frames as replay_frames_iter, MAX_FRAMES as REPLAY_MAX_FRAMES, MAX_HOURS as REPLAY_MAX_HOURS
+from routing import build_hazards, score_route, get_raster, plan_route
+import forecast
+from worker import start_embedded, lease_status
+from sqlalchemy import select, text
+from starlette.concurrency import run_in_threadpool
+import asyncio
 import threading
-from ingestion import schedule_ingestion
-from anomaly import schedule_detection
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import json
+import hashlib
 import socket
 import struct
 # New imports for email notifications
@@ -27,8 +48,6 @@ from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 from datetime import timedelta
 import os
-import smtplib
-from email.mime.text import MIMEText
 from fastapi.encoders import jsonable_encoder
 
 app = FastAPI()
@@ -48,58 +67,40 @@ if ALLOWED_ORIGINS_ENV:
 else:
     origins = DEFAULT_ORIGINS
 
+# Telemetry sits inside admission control, so latencies cover admitted requests (queueing and
+# shedding are counted in /admission/stats); admission sits inside CORS so 429/503 responses
+# still carry CORS headers
+app.add_middleware(TelemetryMiddleware, recorder=telemetry)
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["Retry-After"]
 )
 
-cache_store = {}
-def cache_get(key):
-    v = cache_store.get(key)
-    if not v:
-        return None
-    data, exp = v
-    if exp < datetime.utcnow().timestamp():
-        try:
-            del cache_store[key]
-        except Exception:
-            pass
-        return None
-    return data
-
-def cache_set(key, data, ttl_sec=5):
-    cache_store[key] = (data, datetime.utcnow().timestamp() + ttl_sec)
+async def versioned_response(request: Request, db, names, key, compute, ttl_sec=300):
+    # Cache entry and strong ETag both derive from the data versions bumped on write,
+    # so entries go stale exactly when new rows are committed and not on a timer.
+    versions = await get_data_versions_async(db, *names)
+    tag = ".".join(f"{n}{versions[n]}" for n in names)
+    etag = '"' + hashlib.sha1(f"{key}|{tag}".encode("utf-8")).hexdigest()[:24] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    inm = request.headers.get("if-none-match")
+    if inm and (inm.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in inm.split(",")]):
+        return Response(status_code=304, headers=headers)
+    body = await response_cache.get_or_compute_async(f"{key}@{tag}", compute, ttl_sec, shared=True)
+    # Compression of a cold variant is CPU work; keep it off the event loop
+    return await run_in_threadpool(encoded_response, request, body, headers)
 
 def reverse_geocode(lat: float, lon: float):
     try:
         if lat is None or lon is None:
             return None
-        key = f"geo:{round(lat,4)},{round(lon,4)}"
-        cached = cache_get(key)
-        if cached is not None:
-            return cached
-        import requests
-        url = "https://nominatim.openstreetmap.org/reverse"
-        params = {"format": "jsonv2", "lat": str(lat), "lon": str(lon)}
-        headers = {"User-Agent": "RTAIP/1.0"}
-        r = requests.get(url, params=params, headers=headers, timeout=6)
-        name = None
-        if r.ok:
-            j = r.json()
-            disp = j.get("display_name")
-            addr = j.get("address") or {}
-            city = addr.get("city") or addr.get("town") or addr.get("village") or addr.get("hamlet")
-            state = addr.get("state")
-            country = addr.get("country")
-            if city and country:
-                name = f"{city}, {country}"
-            elif disp:
-                name = disp.split(",")[0]
-        cache_set(key, name or "Unknown", ttl_sec=86400)
-        return name or "Unknown"
+        return place_name(lat, lon)
     except Exception:
         return "Unknown"
 
@@ -111,6 +112,26 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def _bbox(bbox: Optional[str]):
+    try:
+        parts = [p.strip() for p in (bbox or "").split(',')]
+        if len(parts) == 4:
+            return tuple(map(float, parts))
+    except Exception:
+        pass
+    return None
+
+def _place_names_bounded(coords, timeout=10):
+    # Offline lookups return at once; the bounded pool only matters when an online fallback is configured
+    try:
+        return geocode_executor.submit(place_names, coords).result(timeout=timeout)
+    except Exception:
+        return ["Unknown"] * len(coords)
+
 # Serialization helpers to ensure valid JSON responses
 def serialize_event(ev: DataEvent):
     return {
@@ -133,98 +154,111 @@ def serialize_anomaly(a: Anomaly):
         "timestamp": a.timestamp.isoformat() if a.timestamp else None,
     }
 
+async def _assemble(db, model, kind, to_dict, id_query, chunk=900):
+    # Rows are immutable: select ids only, load and encode just the rows whose
+    # JSON fragment is not cached yet, then join the fragments into one body.
+    ids = (await db.execute(id_query)).scalars().all()
+    frags = fragments.lookup(kind, ids)
+    missing = [i for i, f in zip(ids, frags) if f is None]
+    if missing:
+        encoded = {}
+        for n in range(0, len(missing), chunk):
+            rows = (await db.execute(select(model).where(model.id.in_(missing[n:n + chunk])))).scalars().all()
+            for row, frag in zip(rows, await run_in_threadpool(fragments.encode, kind, rows, to_dict)):
+                encoded[row.id] = frag
+        frags = [f if f is not None else encoded.get(i) for i, f in zip(ids, frags)]
+    return EncodedBody(json_array([f for f in frags if f is not None]))
+
 @app.get("/events")
-def get_events(db: Session = Depends(get_db), bbox: Optional[str] = None):
+async def get_events(request: Request, db=Depends(get_async_db), bbox: Optional[str] = None):
     key = f"events:{bbox or 'all'}"
-    cached = cache_get(key)
-    if cached is not None:
-        return cached
-    q = db.query(DataEvent)
-    try:
-        if bbox:
-            parts = [p.strip() for p in bbox.split(',')]
-            if len(parts) == 4:
-                min_lat, min_lon, max_lat, max_lon = map(float, parts)
-                q = q.filter(DataEvent.latitude >= min_lat, DataEvent.latitude <= max_lat, DataEvent.longitude >= min_lon, DataEvent.longitude <= max_lon)
-    except Exception:
-        pass
-    events = q.all()
-    data = [serialize_event(ev) for ev in events]
-    cache_set(key, data)
-    return data
+    async def compute():
+        q = select(DataEvent)
+        box = _bbox(bbox)
+        if box:
+            min_lat, min_lon, max_lat, max_lon = box
+            q = q.where(DataEvent.latitude >= min_lat, DataEvent.latitude <= max_lat, DataEvent.longitude >= min_lon, DataEvent.longitude <= max_lon)
+        return await _assemble(db, DataEvent, "event", serialize_event, q.with_only_columns(DataEvent.id).order_by(DataEvent.id))
+    return await versioned_response(request, db, ["events"], key, compute)
 
 @app.get("/anomalies")
-def get_anomalies(db: Session = Depends(get_db), bbox: Optional[str] = None):
+async def get_anomalies(request: Request, db=Depends(get_async_db), bbox: Optional[str] = None):
     key = f"anomalies:{bbox or 'all'}"
-    cached = cache_get(key)
-    if cached is not None:
-        return cached
-    q = db.query(Anomaly)
-    try:
-        if bbox:
-            parts = [p.strip() for p in bbox.split(',')]
-            if len(parts) == 4:
-                min_lat, min_lon, max_lat, max_lon = map(float, parts)
-                from sqlalchemy.orm import aliased
-                Ev = aliased(DataEvent)
-                q = q.join(Ev, Ev.id == Anomaly.event_id).filter(Ev.latitude >= min_lat, Ev.latitude <= max_lat, Ev.longitude >= min_lon, Ev.longitude <= max_lon)
-    except Exception:
-        pass
-    anomalies = q.all()
-    data = [serialize_anomaly(a) for a in anomalies]
-    cache_set(key, data)
-    return data
+    async def compute():
+        q = select(Anomaly)
+        box = _bbox(bbox)
+        if box:
+            min_lat, min_lon, max_lat, max_lon = box
+            q = q.join(DataEvent, DataEvent.id == Anomaly.event_id).where(DataEvent.latitude >= min_lat, DataEvent.latitude <= max_lat, DataEvent.longitude >= min_lon, DataEvent.longitude <= max_lon)
+        return await _assemble(db, Anomaly, "anomaly", serialize_anomaly, q.with_only_columns(Anomaly.id).order_by(Anomaly.id))
+    return await versioned_response(request, db, ["anomalies"], key, compute)
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**response_cache.stats(), "fragments": fragments.stats(), "analyst": dict(analyst.stats)}
+
+@app.get("/admission/stats")
+def admission_stats():
+    return admission.stats()
 
 @app.get("/health")
-def health(db: Session = Depends(get_db)):
+async def health(db=Depends(get_async_db)):
     try:
-        db.execute("SELECT 1")
-        return {"status": "ok"}
+        await db.execute(text("SELECT 1"))
+        return {"status": "ok", "executors": executor_stats()}
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
+# COP GeoJSON export (events → FeatureCollection)
+def _cop_symbol(src: str):
+    s = (src or '').lower()
+    if 'usgs' in s:
+        return 'SEISMIC'
+    if 'noaa' in s:
+        return 'WEATHER'
+    if 'gdacs' in s or 'eonet' in s or 'nasa' in s:
+        return 'DISASTER'
+    if 'adsb' in s:
+        return 'AIRCRAFT'
+    if 'ais' in s:
+        return 'VESSEL'
+    return 'EVENT'
+
+def _cop_feature(ev: DataEvent):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [ev.longitude, ev.latitude]},
+        "properties": {
+            "id": ev.id,
+            "source": ev.source,
+            "timestamp": ev.timestamp.isoformat() if ev.timestamp else None,
+            "confidence": ev.confidence,
+            "symbol": _cop_symbol(ev.source or ''),
+            "data": ev.data,
+        }
+    }
+
+def cop_geojson_body(db, hours: int) -> EncodedBody:
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    ids = [i for (i,) in db.query(DataEvent.id).filter(
+        DataEvent.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)
+    ).order_by(DataEvent.id).all()]
+    frags = fragments.lookup("feature", ids)
+    missing = [i for i, f in zip(ids, frags) if f is None]
+    encoded = {}
+    for n in range(0, len(missing), 900):
+        rows = db.query(DataEvent).filter(DataEvent.id.in_(missing[n:n + 900])).all()
+        encoded.update(zip((r.id for r in rows), fragments.encode("feature", rows, _cop_feature)))
+    feats = [f if f is not None else encoded.get(i) for i, f in zip(ids, frags)]
+    return EncodedBody(b'{"type":"FeatureCollection","features":' + json_array([f for f in feats if f is not None]) + b"}")
+
 # COP GeoJSON export (events → FeatureCollection)
 @app.get("/cop/geojson")
-def cop_geojson(hours: int = 168, db: Session = Depends(get_db)):
+def cop_geojson(request: Request, hours: int = 168, db: Session = Depends(get_db)):
     try:
-        now = datetime.utcnow()
-        start = now - timedelta(hours=max(1, hours))
-        evs = db.query(DataEvent).filter(DataEvent.timestamp >= start).all()
-        def geom_for(ev: DataEvent):
-            if ev.longitude is None or ev.latitude is None:
-                return None
-            return {"type": "Point", "coordinates": [ev.longitude, ev.latitude]}
-        def symbol_for(src: str):
-            s = (src or '').lower()
-            if 'usgs' in s:
-                return 'SEISMIC'
-            if 'noaa' in s:
-                return 'WEATHER'
-            if 'gdacs' in s or 'eonet' in s or 'nasa' in s:
-                return 'DISASTER'
-            if 'adsb' in s:
-                return 'AIRCRAFT'
-            if 'ais' in s:
-                return 'VESSEL'
-            return 'EVENT'
-        feats = []
-        for ev in evs:
-            g = geom_for(ev)
-            if not g:
-                continue
-            feats.append({
-                "type": "Feature",
-                "geometry": g,
-                "properties": {
-                    "id": ev.id,
-                    "source": ev.source,
-                    "timestamp": ev.timestamp.isoformat() if ev.timestamp else None,
-                    "confidence": ev.confidence,
-                    "symbol": symbol_for(ev.source or ''),
-                    "data": jsonable_encoder(ev.data)
-                }
-            })
-        return {"type": "FeatureCollection", "features": feats}
+        version = get_data_versions(db, "events")["events"]
+        body = response_cache.get_or_compute(f"cop:{hours}@{version}", lambda: cop_geojson_body(db, hours), ttl_sec=60, shared=True)
+        return encoded_response(request, body)
     except Exception as e:
         return {"type": "FeatureCollection", "features": [], "error": str(e)}
 
@@ -238,35 +272,202 @@ def require_api_key(headers: dict) -> bool:
     except Exception:
         return False
 
-# ISR tasking recommendations based on event clusters
+# ISR tasking recommendations based on event density (see density.py)
 @app.get("/isr/recommend")
-def isr_recommend(hours: int = 24, limit: int = 5, db: Session = Depends(get_db)):
+def isr_recommend(hours: int = 24, limit: int = 5, resolution: float = 1.0, sources: Optional[str] = None,
+                  severity_weight: float = 0.0, confidence: bool = False, db: Session = Depends(get_db)):
     try:
-        now = datetime.utcnow()
-        start = now - timedelta(hours=max(1, hours))
-        evs = db.query(DataEvent).filter(DataEvent.timestamp >= start).all()
-        grid = {}
-        for e in evs:
-            if e.latitude is None or e.longitude is None:
-                continue
-            latb = round(e.latitude)
-            lonb = round(e.longitude)
-            k = (latb, lonb)
-            grid[k] = grid.get(k, 0) + 1
-        cells = sorted(grid.items(), key=lambda x: -x[1])[:max(1, limit)]
-        out = []
-        for (latb, lonb), c in cells:
-            name = reverse_geocode(float(latb), float(lonb))
-            out.append({"lat": float(latb), "lon": float(lonb), "name": name, "priority": min(1.0, c/float(max(1, cells[0][1]))), "window_hours": hours})
-        return {"targets": out, "count": len(out)}
+        grid = density.refresh(db)
+        srcs = sorted(s.strip().lower() for s in sources.split(",") if s.strip()) if sources else None
+        res = min(DENSITY_RESOLUTIONS, key=lambda r: abs(r - resolution))
+        limit = max(1, limit)
+        inc_version = get_data_versions(db, "incidents")["incidents"]
+        hour = datetime.utcnow().strftime("%Y%m%d%H")
+        key = f"isr:{hours}:{limit}:{res}:{srcs}:{severity_weight}:{confidence}:{hour}@{grid.version}.{inc_version}"
+
+        def compute():
+            start = datetime.utcnow() - timedelta(hours=max(1, hours))
+            incs = [i for i in db.query(Incident).filter(Incident.last_seen >= start).all() if i.latitude is not None and i.longitude is not None]
+            if not incs:
+                cells = [(c, la, lo, sc) for c, la, lo, sc in grid.top_k(res, hours, limit, srcs, severity_weight, confidence)]
+                incs_by_cell = {}
+            else:
+                # Correlated multi-source incidents weigh their cell up by their member count
+                ids, vals = grid.window(res, hours)
+                score = dict(zip(ids.tolist(), grid.score(vals, srcs, severity_weight, confidence).tolist()))
+                incs_by_cell = {}
+                for inc, c in zip(incs, density_cell_ids([i.latitude for i in incs], [i.longitude for i in incs], res).tolist()):
+                    score[c] = score.get(c, 0.0) + (inc.member_count or 0)
+                    incs_by_cell.setdefault(c, []).append(inc.id)
+                top = sorted(((c, sc) for c, sc in score.items() if sc > 0), key=lambda x: (-x[1], x[0]))[:limit]
+                cells = [(c, *density_cell_center(c, res), sc) for c, sc in top]
+            names = _place_names_bounded([(la, lo) for _, la, lo, _ in cells])
+            out = []
+            for (c, la, lo, sc), name in zip(cells, names):
+                out.append({"lat": la, "lon": lo, "name": name, "priority": min(1.0, sc / float(max(1e-9, cells[0][3]))), "score": sc,
+                            "resolution_deg": res, "window_hours": hours, "incidents": incs_by_cell.get(c, [])})
+            return {"targets": out, "count": len(out)}
+
+        return response_cache.get_or_compute(key, compute, ttl_sec=300)
     except Exception as e:
         return {"targets": [], "error": str(e)}
 
+@app.get("/density/stats")
+def density_stats():
+    return density.stats()
+
+# Vector tiles (MVT) of events and anomalies, clustered per zoom (see tiles.py)
+# layer -> (data versions it depends on, index builder); event features carry max_severity from anomalies
+TILE_LAYERS = {"events": (("events", "anomalies"), build_event_index), "anomalies": (("anomalies",), build_anomaly_index)}
+
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+def vector_tile(z: int, x: int, y: int, request: Request, hours: int = 24, layers: str = "events,anomalies", db: Session = Depends(get_db)):
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        return Response(status_code=404)
+    names = [n for n in (l.strip() for l in layers.split(",")) if n in TILE_LAYERS] or ["events"]
+    hours = max(1, min(hours, 24 * 30))
+    versions = get_data_versions(db, *sorted({v for n in names for v in TILE_LAYERS[n][0]}))
+    tag = ".".join(f"{k}{v}" for k, v in sorted(versions.items()))
+    etag = '"' + hashlib.sha1(f"tile:{z}/{x}/{y}|{hours}|{','.join(names)}|{tag}".encode("utf-8")).hexdigest()[:24] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    inm = request.headers.get("if-none-match")
+    if inm and etag in [t.strip().removeprefix("W/") for t in inm.split(",")]:
+        return Response(status_code=304, headers=headers)
+    def render():
+        out = []
+        for n in names:
+            version_names, build = TILE_LAYERS[n]
+            # One cluster index per layer/window/version, built once and shared by all tiles
+            vtag = ".".join(str(versions[v]) for v in version_names)
+            index = response_cache.get_or_compute(f"tileindex:{n}:{hours}@{vtag}", lambda: build(db, hours), ttl_sec=300)
+            out.append((n, index.tile_features(z, x, y)))
+        return encode_tile(out)
+    body = response_cache.get_or_compute(f"tile:{z}/{x}/{y}:{hours}:{','.join(names)}@{tag}", lambda: EncodedBody(render(), "application/vnd.mapbox-vector-tile"), ttl_sec=300, shared=True)
+    return encoded_response(request, body, headers)
+
+# Kernel-density heatmaps of events or anomalies (see heatmap.py)
+HEATMAP_LAYERS = {"events": ("events", event_columns), "anomalies": ("anomalies", anomaly_columns)}
+
+@app.get("/heatmap")
+def heatmap(request: Request, layer: str = "events", bbox: str = "-90,-180,90,180", hours: int = 24, sources: Optional[str] = None,
+            res: Optional[float] = None, width: int = 512, bandwidth_km: float = 25.0, format: str = "png", db: Session = Depends(get_db)):
+    if layer not in HEATMAP_LAYERS or format not in ("png", "f32"):
+        return Response(status_code=400, content=b"layer must be events|anomalies, format png|f32")
+    try:
+        box = _bbox(bbox)
+    except Exception:
+        box = None
+    if not box or box[0] >= box[2] or box[1] >= box[3]:
+        return Response(status_code=400, content=b"bbox must be min_lat,min_lon,max_lat,max_lon")
+    hours = max(1, min(hours, 24 * 30))
+    bandwidth_km = clamp_bandwidth(bandwidth_km)
+    srcs = sorted(s.strip().lower() for s in sources.split(",") if s.strip()) if sources else None
+    shape = heatmap_grid_shape(box, res, max(1, width))
+    version_name, load = HEATMAP_LAYERS[layer]
+    version = get_data_versions(db, version_name)[version_name]
+    key = f"heatmap:{layer}:{box}:{hours}:{srcs}:{shape}:{bandwidth_km}:{format}@{version}"
+    etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest()[:24] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Heatmap-Shape": f"{shape[0]},{shape[1]}",
+               "X-Heatmap-Bbox": ",".join(str(v) for v in box)}
+    inm = request.headers.get("if-none-match")
+    if inm and etag in [t.strip().removeprefix("W/") for t in inm.split(",")]:
+        return Response(status_code=304, headers=headers)
+    def render():
+        # Column arrays per layer/window/version are shared by every bbox and resolution
+        points = response_cache.get_or_compute(f"heatcols:{layer}:{hours}@{version}", lambda: load(db, hours), ttl_sec=60)
+        grid = heatmap_density(points, box, shape, srcs, bandwidth_km)
+        if format == "png":
+            return EncodedBody(encode_png(colorize(grid)), "image/png")
+        return EncodedBody(grid.astype("<f4").tobytes(), "application/octet-stream")
+    body = response_cache.get_or_compute(key, render, ttl_sec=300, shared=True)
+    return encoded_response(request, body, headers)
+
+# Timeline replay: NDJSON frames of active events/anomalies as deltas (see replay.py)
+def _parse_ts(value):
+    dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    # Stored timestamps are naive UTC; convert offsets rather than dropping them
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+@app.get("/replay/frames")
+def replay_frames(start: str, end: Optional[str] = None, step: int = 60, active: Optional[int] = None, bbox: Optional[str] = None,
+                  sources: Optional[str] = None, layers: str = "events,anomalies", keyframe_every: int = 0, db: Session = Depends(get_db)):
+    try:
+        t0 = _parse_ts(start)
+        t1 = _parse_ts(end) if end else datetime.utcnow()
+    except Exception:
+        return Response(status_code=400, content=b"start/end must be ISO timestamps")
+    span = timedelta(hours=REPLAY_MAX_HOURS)
+    step = max(1, min(step, int(span.total_seconds())))
+    active = max(1, min(active or step, int(span.total_seconds())))
+    if t1 < t0:
+        return Response(status_code=400, content=b"end before start")
+    t1 = min(t1, t0 + timedelta(seconds=step * (REPLAY_MAX_FRAMES - 1)), t0 + span)
+    names = [n for n in ("events", "anomalies") if n in [l.strip() for l in layers.split(",")]] or ["events"]
+    box = _bbox(bbox)
+    srcs = sorted(s.strip().lower() for s in sources.split(",") if s.strip()) if sources else None
+    versions = get_data_versions(db, *names)
+    tracks = {n: filter_track(load_track(db, n, t0 - timedelta(seconds=active), t1, versions[n], response_cache), box, srcs) for n in names}
+    tag = ".".join(f"{n}{versions[n]}" for n in names)
+
+    def keyframe(at, bounds):
+        # Full active sets are the expensive frames; reuse them across scrubs
+        key = f"replaykf:{','.join(names)}:{box}:{srcs}:{active}:{at}@{tag}"
+        return response_cache.get_or_compute(key, lambda: dumps({"type": "keyframe", "t": at, **{n: tracks[n].rows(*bounds[n]) for n in names}}) + b"\n", ttl_sec=600, shared=True)
+
+    return StreamingResponse(replay_frames_iter(tracks, t0, t1, step, active, max(0, keyframe_every), keyframe), media_type="application/x-ndjson")
+
+# Offline reverse geocoding (bundled gazetteer or GAZETTEER_PATH, see geocoder.py)
+class GeocodeBatchRequest(BaseModel):
+    points: List[List[float]]
+
+@app.get("/geocode/reverse")
+async def geocode_reverse(lat: float, lon: float):
+    # The lookup (and the gazetteer load, if it is still cold) must not run on the event loop
+    place = (await run_in_threadpool(reverse_geocode_batch, [(lat, lon)]))[0]
+    try:
+        name = await geocode_executor.run(place_name, lat, lon, timeout=10)
+    except Exception:
+        name = "Unknown"
+    return {"place": place, "name": name}
+
+@app.post("/geocode/batch")
+def geocode_batch(req: GeocodeBatchRequest):
+    coords = [(p[0], p[1]) for p in req.points if len(p) >= 2]
+    return {"places": reverse_geocode_batch(coords), "count": len(coords)}
+
+# Correlated incidents (multi-source spatiotemporal groups, see correlation.py)
+@app.get("/incidents")
+def list_incidents(hours: int = 24, min_sources: int = 2, limit: int = 100, db: Session = Depends(get_db)):
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = (
+        db.query(Incident)
+        .filter(Incident.last_seen >= start, Incident.source_count >= min_sources)
+        .order_by(Incident.last_seen.desc())
+        .limit(max(1, min(limit, 1000)))
+        .all()
+    )
+    return {"incidents": [serialize_incident(i) for i in rows], "count": len(rows)}
+
+@app.get("/incidents/{incident_id}")
+def get_incident(incident_id: int, db: Session = Depends(get_db)):
+    inc = db.query(Incident).get(incident_id)
+    if not inc:
+        return {"status": "not_found"}
+    ids = [m for (m,) in db.query(IncidentMember.event_id).filter(IncidentMember.incident_id == incident_id).order_by(IncidentMember.event_id).all()]
+    return serialize_incident(inc, ids)
+
 # COA analysis: risk along waypoints based on proximity to recent events
 class CoaRequest(BaseModel):
     waypoints: List[List[float]]
     hours: int = 24
     radius_km: float = 50.0
+    risk_weight: float = 4.0  # extra cost per km at peak hazard, relative to distance
+
+def coa_hazards(db, hours):
+    # One spatial index per window and events version, shared by every route scored against it
+    hours = max(1, hours)
+    version = get_data_versions(db, "events")["events"]
+    return response_cache.get_or_compute(f"hazards:{hours}@{version}", lambda: build_hazards(db, hours), ttl_sec=60)
 
 @app.post("/coa/analyze")
 def coa_analyze(req: CoaRequest, db: Session = Depends(get_db)):
@@ -276,39 +477,73 @@ def coa_analyze(req: CoaRequest, db: Session = Depends(get_db)):
         wps = req.waypoints or []
         if len(wps) < 2:
             return {"status": "error", "error": "At least two waypoints required"}
-        now = datetime.utcnow()
-        start = now - timedelta(hours=max(1, req.hours))
-        evs = db.query(DataEvent).filter(DataEvent.timestamp >= start).all()
-        def haversine(lat1, lon1, lat2, lon2):
-            from math import radians, sin, cos, sqrt, atan2
-            R = 6371.0
-            dlat = radians(lat2 - lat1)
-            dlon = radians(lon2 - lon1)
-            a = sin(dlat/2)**2 + cos(radians(lat1))*cos(radians(lat2))*sin(dlon/2)**2
-            c = 2*atan2(sqrt(a), sqrt(1-a))
-            return R*c
-        # Build segments
-        segs = [(wps[i][0], wps[i][1], wps[i+1][0], wps[i+1][1]) for i in range(len(wps)-1)]
-        hazards = []
-        total_dist = 0.0
-        for (lat1, lon1, lat2, lon2) in segs:
-            total_dist += haversine(lat1, lon1, lat2, lon2)
-            for e in evs:
-                if e.latitude is None or e.longitude is None:
-                    continue
-                # distance from event to segment endpoints (approx)
-                d1 = haversine(e.latitude, e.longitude, lat1, lon1)
-                d2 = haversine(e.latitude, e.longitude, lat2, lon2)
-                if min(d1, d2) <= req.radius_km:
-                    hazards.append({"source": e.source, "latitude": e.latitude, "longitude": e.longitude, "distance_km": min(d1, d2), "timestamp": e.timestamp.isoformat() if e.timestamp else None})
-        risk = min(1.0, len(hazards) / max(1.0, total_dist / 100.0))
-        # Suggest offset waypoint near top hazard
+        hz = coa_hazards(db, req.hours)
+        res = score_route(hz, wps, req.radius_km)
+        # Suggest a lower-risk path over the hazard raster when the direct route has hazards
         alt = None
-        if hazards:
-            h = sorted(hazards, key=lambda x: x["distance_km"])[0]
-            alt = [h["latitude"] + 0.5, h["longitude"] + 0.5]
-        summary = f"Route distance ~{int(total_dist)} km; hazards {len(hazards)}; risk {(risk*100):.0f}%"
-        return {"status": "ok", "risk": risk, "distance_km": total_dist, "hazards": hazards[:20], "alternative": alt, "summary": summary}
+        if res["hazard_count"]:
+            path, deg = plan_route(get_raster(db, req.hours), wps, req.radius_km, req.risk_weight)
+            alt_res = score_route(hz, path, req.radius_km)
+            alt = {"waypoints": path, "resolution_deg": deg, "risk": alt_res["risk"], "distance_km": alt_res["distance_km"],
+                   "hazard_count": alt_res["hazard_count"], "summary": alt_res["summary"],
+                   "improves": alt_res["hazard_count"] < res["hazard_count"]}
+        return {"status": "ok", "risk": res["risk"], "distance_km": res["distance_km"], "hazards": res["hazards"], "alternative": alt, "summary": res["summary"]}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+class CoaRoute(BaseModel):
+    id: Optional[str] = None
+    waypoints: List[List[float]]
+
+class CoaBatchRequest(BaseModel):
+    routes: List[CoaRoute]
+    hours: int = 24
+    radius_km: float = 50.0
+
+def _route_error(waypoints):
+    """Why a route cannot be scored, or None."""
+    if len(waypoints or []) < 2:
+        return "At least two waypoints required"
+    for j, w in enumerate(waypoints):
+        if len(w) < 2:
+            return f"Waypoint {j} needs lat and lon"
+        if not (-90.0 <= w[0] <= 90.0 and -180.0 <= w[1] <= 180.0):
+            return f"Waypoint {j} is out of range"
+    return None
+
+@app.post("/coa/analyze_batch")
+def coa_analyze_batch(req: CoaBatchRequest, db: Session = Depends(get_db)):
+    try:
+        if not require_api_key(getattr(req, "__dict__", {})):
+            return {"status": "error", "error": "Missing or invalid API key"}
+        hz = coa_hazards(db, req.hours)
+        # One bad route is reported in its own slot; it must not fail the batch
+        futures = []
+        for r in req.routes:
+            err = _route_error(r.waypoints)
+            if err is not None:
+                futures.append(err)
+                continue
+            try:
+                futures.append(routing_executor.submit(score_route, hz, r.waypoints, req.radius_km))
+            except ExecutorBusy:
+                try:
+                    futures.append(score_route(hz, r.waypoints, req.radius_km))
+                except Exception as e:
+                    futures.append(str(e))
+        results = []
+        for i, (r, f) in enumerate(zip(req.routes, futures)):
+            rid = r.id if r.id is not None else str(i)
+            try:
+                res = f if isinstance(f, (dict, str)) else f.result()
+            except Exception as e:
+                res = str(e)
+            if isinstance(res, str):
+                results.append({"id": rid, "status": "error", "error": res})
+            else:
+                results.append({"id": rid, "status": "ok", **res})
+        ranked = sorted((x for x in results if x["status"] == "ok"), key=lambda x: (x["risk"], x["distance_km"]))
+        return {"status": "ok", "routes": results, "ranking": [x["id"] for x in ranked], "hazard_events": len(hz)}
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
@@ -349,9 +584,9 @@ def cop_push_udp(hours: int = 24):
         port = int(os.getenv("C2_UDP_PORT", "0") or "0")
         if not host or port <= 0:
             return {"status": "error", "error": "C2_UDP_HOST/C2_UDP_PORT not set"}
-        fc = cop_geojson(hours)
-        import socket, json as pyjson
-        payload = pyjson.dumps(fc).encode("utf-8")
+        with Session() as db:
+            payload = cop_geojson_body(db, hours).raw
+        import socket
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.sendto(payload, (host, port))
         s.close()
@@ -359,9 +594,7 @@ def cop_push_udp(hours: int = 24):
     except Exception as e:
         return {"status": "error", "error": str(e)}
 
-# ISR asset registry (in-memory)
-ASSETS = []
-
+# ISR asset registry
 class AssetIn(BaseModel):
     name: str
     type: str
@@ -385,63 +618,53 @@ class TaskingRequest(BaseModel):
     description: str = ""
     priority: str = "medium"
 
+class BatchTaskingRequest(BaseModel):
+    targets: List[dict]  # {"lat", "lon", "priority", "description", "types": [...], "id"}
+    max_km: Optional[float] = None
+    status: str = "available"
+    dry_run: bool = False
+
+# Assets are persisted in isr_assets and indexed per process (see assets.py)
 @app.get("/isr/assets")
-def list_assets():
-    return {"assets": ASSETS}
+def list_assets(db: Session = Depends(get_db)):
+    return {"assets": asset_registry.list(db)}
+
+@app.get("/isr/assets/near")
+def assets_near(lat: float, lon: float, radius_km: float = 100.0, status: Optional[str] = None, limit: int = 50, db: Session = Depends(get_db)):
+    assets = asset_registry.near(db, lat, lon, radius_km, status, max(1, min(limit, 1000)))
+    return {"assets": assets, "count": len(assets)}
 
 @app.post("/isr/assets")
-def add_asset(a: AssetIn):
-    item = {
-        "id": len(ASSETS)+1, 
-        "name": a.name, 
-        "type": a.type, 
-        "lat": a.lat, 
-        "lon": a.lon, 
-        "status": a.status,
-        "metadata": a.metadata,
-        "tasking": a.tasking
-    }
-    ASSETS.append(item)
-    return {"id": item["id"]}
+def add_asset(a: AssetIn, db: Session = Depends(get_db)):
+    return {"id": asset_registry.create(db, a.dict())}
+
+@app.post("/isr/assets/batch_task")
+def batch_tasking(req: BatchTaskingRequest, db: Session = Depends(get_db)):
+    try:
+        return {"status": "ok", **asset_registry.batch_task(db, req.targets, req.max_km, req.status, req.dry_run)}
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
 
 @app.put("/isr/assets/{asset_id}")
-def update_asset(asset_id: int, update: AssetUpdate):
-    for asset in ASSETS:
-        if asset.get("id") == asset_id:
-            if update.name is not None:
-                asset["name"] = update.name
-            if update.type is not None:
-                asset["type"] = update.type
-            if update.lat is not None:
-                asset["lat"] = update.lat
-            if update.lon is not None:
-                asset["lon"] = update.lon
-            if update.status is not None:
-                asset["status"] = update.status
-            if update.metadata is not None:
-                asset["metadata"] = update.metadata
-            if update.tasking is not None:
-                asset["tasking"] = update.tasking
-            return asset
-    return {"error": "Asset not found"}
+def update_asset(asset_id: int, update: AssetUpdate, db: Session = Depends(get_db)):
+    asset = asset_registry.update(db, asset_id, update.dict())
+    if asset is None:
+        return {"error": "Asset not found"}
+    return asset
 
 @app.post("/isr/assets/{asset_id}/task")
-def assign_tasking(asset_id: int, tasking: TaskingRequest):
-    for asset in ASSETS:
-        if asset.get("id") == asset_id:
-            asset["tasking"] = {
-                "target": tasking.target,
-                "description": tasking.description,
-                "priority": tasking.priority
-            }
-            asset["status"] = "tasked"
-            return {"status": "tasked"}
-    return {"error": "Asset not found"}
+def assign_tasking(asset_id: int, tasking: TaskingRequest, db: Session = Depends(get_db)):
+    asset = asset_registry.update(db, asset_id, {
+        "tasking": {"target": tasking.target, "description": tasking.description, "priority": tasking.priority},
+        "status": "tasked",
+    })
+    if asset is None:
+        return {"error": "Asset not found"}
+    return {"status": "tasked"}
 
 @app.delete("/isr/assets/{asset_id}")
-def delete_asset(asset_id: int):
-    global ASSETS
-    ASSETS = [x for x in ASSETS if x.get("id") != asset_id]
+def delete_asset(asset_id: int, db: Session = Depends(get_db)):
+    asset_registry.delete(db, asset_id)
     return {"status": "deleted"}
 
 # Email notification request model
@@ -450,41 +673,55 @@ class EmailRequest(BaseModel):
     message: str
     to: Optional[str] = None
     to_email: Optional[str] = None
+    digest: bool = False
 
 @app.post("/notify/email")
-def notify_email(req: EmailRequest):
-    host = os.getenv("SMTP_HOST")
-    port = int(os.getenv("SMTP_PORT", "587"))
-    user = os.getenv("SMTP_USERNAME")
-    pwd = os.getenv("SMTP_PASSWORD")
-    from_addr = os.getenv("EMAIL_FROM")
+async def notify_email(req: EmailRequest, db=Depends(get_async_db)):
+    cfg = smtp_config()
     to_addr = req.to or req.to_email or os.getenv("EMAIL_TO_DEFAULT")
 
     missing = [k for k, v in {
-        "SMTP_HOST": host,
-        "SMTP_USERNAME": user,
-        "SMTP_PASSWORD": pwd,
-        "EMAIL_FROM": from_addr,
+        "SMTP_HOST": os.getenv("SMTP_HOST"),
+        "EMAIL_FROM": os.getenv("EMAIL_FROM"),
         "EMAIL_TO_DEFAULT": to_addr,
     }.items() if not v]
-    if missing:
+    if missing or cfg is None:
         return {"status": "error", "error": "Missing SMTP configuration", "missing": missing}
 
-    msg = MIMEText(req.message or "")
-    msg["Subject"] = req.subject
-    msg["From"] = from_addr
-    msg["To"] = to_addr
-
     try:
-        server = smtplib.SMTP(host, port)
-        server.starttls()
-        server.login(user, pwd)
-        server.sendmail(from_addr, [to_addr], msg.as_string())
-        server.quit()
-        return {"status": "sent", "to": to_addr}
+        # Delivery happens on the dispatcher's pooled SMTP workers, never on the request path
+        n = enqueue_email(db, to_addr, req.subject, req.message or "", digest=req.digest)
+        await db.commit()
+        get_dispatcher().wake()
+        return {"status": "queued", "id": n.id, "to": to_addr, "digest": n.status == "digest"}
     except Exception as e:
+        await db.rollback()
         return {"status": "error", "error": str(e)}
 
+@app.get("/notify/outbox")
+def notify_outbox(limit: int = 50, status: Optional[str] = None, db: Session = Depends(get_db)):
+    q = db.query(Notification)
+    if status:
+        q = q.filter(Notification.status == status)
+    rows = q.order_by(Notification.id.desc()).limit(max(1, min(limit, 500))).all()
+    return {
+        "stats": outbox_stats(db),
+        "items": [
+            {
+                "id": n.id,
+                "to": n.to_addr,
+                "subject": n.subject,
+                "status": n.status,
+                "attempts": n.attempts,
+                "next_attempt_at": n.next_attempt_at.isoformat() if n.next_attempt_at else None,
+                "last_error": n.last_error,
+                "digest_id": n.digest_id,
+                "sent_at": n.sent_at.isoformat() if n.sent_at else None,
+            }
+            for n in rows
+        ],
+    }
+
 # Alert Rules CRUD
 class AlertRuleIn(BaseModel):
     name: str
@@ -546,6 +783,99 @@ def create_alert_rule(rule: AlertRuleIn, db: Session = Depends(get_db)):
 @app.delete("/alert-rules/{rule_id}")
 def delete_alert_rule(rule_id: int, db: Session = Depends(get_db)):
     r = db.query(AlertRule).get(rule_id)
+    if not r:
+        return {"status": "not_found"}
+    db.query(AlertDelivery).filter(AlertDelivery.rule_id == rule_id).delete(synchronize_session=False)
+    db.delete(r)
+    db.commit()
+    return {"status": "deleted"}
+
+@app.get("/alert-deliveries")
+def list_alert_deliveries(limit: int = 100, rule_id: Optional[int] = None, db: Session = Depends(get_db)):
+    q = db.query(AlertDelivery)
+    if rule_id is not None:
+        q = q.filter(AlertDelivery.rule_id == rule_id)
+    rows = q.order_by(AlertDelivery.id.desc()).limit(max(1, min(limit, 1000))).all()
+    return [
+        {
+            "id": d.id,
+            "rule_id": d.rule_id,
+            "anomaly_id": d.anomaly_id,
+            "status": d.status,
+            "created_at": d.created_at.isoformat() if d.created_at else None,
+            "delivered_at": d.delivered_at.isoformat() if d.delivered_at else None,
+            "notification_id": d.notification_id,
+        }
+        for d in rows
+    ]
+
+# Detector Rules CRUD (declarative rules compiled to SQL by rules.py)
+class DetectorRuleIn(BaseModel):
+    name: str
+    source: Optional[str] = None
+    field: str
+    op: str = ">"
+    value: Any = None
+    type: str = "rule_match"
+    severity: int = 5
+    description: Optional[str] = None
+    enabled: bool = True
+
+class DetectorRuleUpdate(BaseModel):
+    name: Optional[str] = None
+    source: Optional[str] = None
+    field: Optional[str] = None
+    op: Optional[str] = None
+    value: Any = None
+    type: Optional[str] = None
+    severity: Optional[int] = None
+    description: Optional[str] = None
+    enabled: Optional[bool] = None
+
+@app.get("/detector-rules")
+def list_detector_rules(db: Session = Depends(get_db)):
+    return [serialize_rule(r) for r in db.query(DetectorRule).order_by(DetectorRule.id).all()]
+
+@app.post("/detector-rules")
+def create_detector_rule(rule: DetectorRuleIn, db: Session = Depends(get_db)):
+    r = DetectorRule(
+        name=rule.name,
+        source=rule.source,
+        field=rule.field,
+        op=rule.op,
+        value=rule.value,
+        type=rule.type,
+        severity=rule.severity,
+        description=rule.description,
+        enabled=rule.enabled,
+    )
+    try:
+        compile_rule(r)
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+    db.add(r)
+    db.commit()
+    db.refresh(r)
+    return {"id": r.id}
+
+@app.put("/detector-rules/{rule_id}")
+def update_detector_rule(rule_id: int, update: DetectorRuleUpdate, db: Session = Depends(get_db)):
+    r = db.query(DetectorRule).get(rule_id)
+    if not r:
+        return {"status": "not_found"}
+    for k, v in update.dict(exclude_unset=True).items():
+        setattr(r, k, v)
+    try:
+        compile_rule(r)
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "error": str(e)}
+    db.commit()
+    return serialize_rule(r)
+
+@app.delete("/detector-rules/{rule_id}")
+def delete_detector_rule(rule_id: int, db: Session = Depends(get_db)):
+    r = db.query(DetectorRule).get(rule_id)
     if not r:
         return {"status": "not_found"}
     db.delete(r)
@@ -559,193 +889,14 @@ class AnalystQuery(BaseModel):
 
 @app.post("/api/ai-analyst")
 def ai_analyst(req: AnalystQuery, db: Session = Depends(get_db)):
-    q = (req.query or "").lower()
-    import re
-    bbox = None
-    m_bbox = re.search(r"bbox[:=]\s*([\-0-9\.]+),([\-0-9\.]+),([\-0-9\.]+),([\-0-9\.]+)", q)
-    if m_bbox:
-        try:
-            bbox = tuple(map(float, [m_bbox.group(1), m_bbox.group(2), m_bbox.group(3), m_bbox.group(4)]))
-        except Exception:
-            bbox = None
-    m_hours = re.search(r"last\s*(\d+)\s*hour", q)
-    m_days = re.search(r"last\s*(\d+)\s*day", q)
-    m_week = re.search(r"last\s*(\d+)\s*week", q)
-    m_sev = re.search(r"severity\s*[>=]+\s*(\d+)", q)
-    m_conf = re.search(r"(min\s*conf|confidence\s*[>=]+)\s*(\d+(?:\.\d+)?)", q)
-    m_near = re.search(r"near[:=]\s*([\-0-9\.]+)\s*,\s*([\-0-9\.]+)", q)
-    m_radius = re.search(r"radius[:=]\s*(\d+)\s*km", q)
-    srcs = []
-    for s in ["adsb","ais","usgs_seismic","noaa_weather","nasa_eonet","gdacs_disasters"]:
-        if s in q:
-            srcs.append(s)
-    for k,v in {"adsb":["ads-b","aircraft"],"ais":["vessel","maritime"],"usgs_seismic":["usgs","seismic","earthquake"],"noaa_weather":["noaa","weather","storm","wind"],"nasa_eonet":["eonet","nasa events"],"gdacs_disasters":["gdacs","disaster"]}.items():
-        if any(t in q for t in v):
-            srcs.append(k)
-    from datetime import datetime, timedelta
-    now = datetime.utcnow()
-    delta = timedelta(hours=24)
-    if m_hours:
-        try:
-            delta = timedelta(hours=int(m_hours.group(1)))
-        except Exception:
-            delta = timedelta(hours=24)
-    elif m_days:
-        try:
-            delta = timedelta(days=int(m_days.group(1)))
-        except Exception:
-            delta = timedelta(days=1)
-    elif m_week:
-        try:
-            delta = timedelta(days=7*int(m_week.group(1)))
-        except Exception:
-            delta = timedelta(days=7)
-    start = now - delta
-    ev_all = db.query(DataEvent).all()
-    an_all = db.query(Anomaly).all()
-    def in_bbox(e):
-        if not bbox:
-            return True
-        if e.latitude is None or e.longitude is None:
-            return False
-        return bbox[0] <= e.latitude <= bbox[2] and bbox[1] <= e.longitude <= bbox[3]
-    def in_radius(e):
-        if not m_near:
-            return True
-        try:
-            lat0 = float(m_near.group(1)); lon0 = float(m_near.group(2))
-            rkm = float(m_radius.group(1)) if m_radius else 50.0
-            if e.latitude is None or e.longitude is None:
-                return False
-            from math import radians, sin, cos, sqrt, atan2
-            R = 6371.0
-            dlat = radians(e.latitude - lat0)
-            dlon = radians(e.longitude - lon0)
-            a = sin(dlat/2)**2 + cos(radians(lat0))*cos(radians(e.latitude))*sin(dlon/2)**2
-            c = 2*atan2(sqrt(a), sqrt(1-a))
-            d = R*c
-            return d <= rkm
-        except Exception:
-            return True
-    min_sev = int(m_sev.group(1)) if m_sev else None
-    min_conf = float(m_conf.group(2)) if m_conf else None
-    evs = [e for e in ev_all if (e.timestamp and e.timestamp >= start) and in_bbox(e) and in_radius(e)]
-    if srcs:
-        evs = [e for e in evs if e.source in srcs]
-    anoms = [a for a in an_all if (a.timestamp and a.timestamp >= start)]
-    if srcs:
-        ev_ids = set(e.id for e in evs)
-        anoms = [a for a in anoms if a.event_id in ev_ids]
-    if min_sev is not None:
-        anoms = [a for a in anoms if (a.severity or 0) >= min_sev]
-    if min_conf is not None:
-        ev_by_id = {e.id: e for e in evs}
-        anoms = [a for a in anoms if (ev_by_id.get(a.event_id) and ((ev_by_id.get(a.event_id).confidence or 0.0) >= min_conf))]
-    def ser_e(e: DataEvent):
-        return {"id": e.id, "source": e.source, "timestamp": e.timestamp.isoformat() if e.timestamp else None, "latitude": e.latitude, "longitude": e.longitude}
-    def ser_a(a: Anomaly):
-        return {"id": a.id, "event_id": a.event_id, "type": a.type, "severity": a.severity, "timestamp": a.timestamp.isoformat() if a.timestamp else None}
-    out_lines: List[str] = []
-    if "predict" in q:
-        by_src_counts = {}
-        for a in anoms:
-            ev = next((e for e in evs if e.id == a.event_id), None)
-            if not ev:
-                continue
-            src = ev.source or "unknown"
-            ts = a.timestamp or now
-            bucket = ts.replace(minute=0, second=0, microsecond=0)
-            d = by_src_counts.setdefault(src, {})
-            d[bucket] = d.get(bucket, 0) + 1
-        preds = []
-        pred_points = []
-        for src, hist in by_src_counts.items():
-            buckets = sorted(hist.keys())
-            series = [hist[b] for b in buckets]
-            if not series:
-                continue
-            alpha = 0.3
-            ewma = series[0]
-            for x in series[1:]:
-                ewma = alpha * x + (1 - alpha) * ewma
-            horizon_h = 6
-            expected = max(0.0, float(ewma) * horizon_h / max(1, len(series)))
-            peak = max(1, max(series))
-            prob = min(1.0, ewma / float(peak))
-            confv = min(1.0, 0.5 + min(0.5, len(series) / 24.0))
-            preds.append({"source": src, "next_hours": horizon_h, "probability": prob, "expected_count": expected, "confidence": confv})
-            grid = {}
-            for a in anoms:
-                ev = next((e for e in evs if e.id == a.event_id and (e.source or "unknown") == src), None)
-                if not ev or ev.latitude is None or ev.longitude is None:
-                    continue
-                latb = round(ev.latitude)
-                lonb = round(ev.longitude)
-                k = (latb, lonb)
-                grid[k] = grid.get(k, 0) + 1
-            top_cells = sorted(grid.items(), key=lambda x: -x[1])[:3]
-            for (latb, lonb), c in top_cells:
-                name = reverse_geocode(float(latb), float(lonb))
-                pred_points.append({"source": src, "latitude": float(latb), "longitude": float(lonb), "name": name, "probability": prob, "next_hours": horizon_h})
-        out_lines.append(f"Predicted locations for next {horizon_h} hours:")
-        for p in sorted(pred_points, key=lambda x: -x["probability"])[:10]:
-            out_lines.append(f"- {p['name']} ({p['source'].upper()}) prob={(p['probability']*100):.0f}%")
-        return {"type": "analysis", "output": "\n".join(out_lines), "events": [ser_e(e) for e in evs[:50]], "anomalies": [ser_a(a) for a in anoms[:50]], "predictions": preds, "predictions_points": pred_points}
-    if any(t in q for t in ["how many","count","number"]):
-        total_e = len(evs)
-        total_a = len(anoms)
-        if "by source" in q:
-            by_src = {}
-            ev_src = {}
-            for e in evs: ev_src[e.source] = ev_src.get(e.source, 0) + 1
-            for a in anoms:
-                ev = next((e for e in evs if e.id == a.event_id), None)
-                if ev: by_src[ev.source] = by_src.get(ev.source, 0) + 1
-            out_lines.append("Counts by source:")
-            for s in sorted(ev_src.keys() | by_src.keys()):
-                out_lines.append(f"- {s.upper()} events={ev_src.get(s,0)} anomalies={by_src.get(s,0)}")
-        else:
-            out_lines.append(f"Events={total_e} anomalies={total_a}")
-    elif any(t in q for t in ["hotspot","where","locations"]):
-        bins = {}
-        for a in anoms:
-            ev = next((e for e in evs if e.id == a.event_id), None)
-            if not ev or ev.latitude is None or ev.longitude is None:
-                continue
-            latb = round(ev.latitude/5)*5
-            lonb = round(ev.longitude/5)*5
-            k = (latb, lonb)
-            bins[k] = bins.get(k, 0) + 1
-        out_lines.append("Top hotspots:")
-        for (latb,lonb), c in sorted(bins.items(), key=lambda x: -x[1])[:5]:
-            out_lines.append(f"- ({latb},{lonb}) anomalies={c}")
-    elif any(t in q for t in ["list","show","give"]):
-        out_lines.append("Top anomalies:")
-        for a in sorted(anoms, key=lambda x: -(x.severity or 0))[:10]:
-            ev = next((e for e in evs if e.id == a.event_id), None)
-            if ev:
-                out_lines.append(f"- {ev.source.upper()} sev={a.severity} at ({ev.latitude},{ev.longitude}) {ev.timestamp.isoformat()}")
-    elif any(t in q for t in ["trend","timeline","over time"]):
-        buckets = {}
-        for a in anoms:
-            ts = a.timestamp or now
-            b = ts.replace(minute=0, second=0, microsecond=0)
-            buckets[b] = buckets.get(b, 0) + 1
-        out_lines.append("Hourly anomaly trend:")
-        for b, c in sorted(buckets.items()):
-            out_lines.append(f"- {b.isoformat()} count={c}")
-    elif any(t in q for t in ["summary","brief"]):
-        by_src = {}
-        for e in evs: by_src[e.source] = by_src.get(e.source, 0) + 1
-        sev_hist = {}
-        for a in anoms: sev_hist[a.severity] = sev_hist.get(a.severity, 0) + 1
-        out_lines.append(f"Summary: events={len(evs)} anomalies={len(anoms)} window={int(delta.total_seconds()/3600)}h")
-        for src, c in sorted(by_src.items()): out_lines.append(f"- {src.upper()} events={c}")
-        if sev_hist: out_lines.append("- Severity: " + ", ".join(f"{k}:{v}" for k,v in sorted(sev_hist.items())))
-    else:
-        out_lines.append(f"Scope: sources={[s.upper() for s in srcs] or 'ALL'} window={int(delta.total_seconds()/3600)}h events={len(evs)} anomalies={len(anoms)}")
-        for e in evs[:10]: out_lines.append(f"- {e.source.upper()} id={e.id} at ({e.latitude},{e.longitude}) {e.timestamp.isoformat()}")
-    return {"type": "analysis", "output": "\n".join(out_lines), "events": [ser_e(e) for e in evs[:50]], "anomalies": [ser_a(a) for a in anoms[:50]]}
+    # The question is compiled into filtered, aggregated SQL (see analyst.py);
+    # repeats and rewordings are served from the intent-keyed cache
+    return analyst.run_query(db, req.query, cache=response_cache)
+
+@app.get("/forecasts")
+def get_forecasts(source: Optional[str] = None, top: int = 10, db: Session = Depends(get_db)):
+    preds, cells = forecast.lookup(db, [source] if source else None, per_source=max(1, min(top, 100)))
+    return {"predictions": preds, "cells": cells}
 
 @app.get("/seed")
 def seed(db: Session = Depends(get_db)):
@@ -773,6 +924,7 @@ def seed(db: Session = Depends(get_db)):
             )
             db.add(ev)
             created_events.append(ev)
+        bump_data_version(db, "events")
         db.commit()
         for ev in created_events:
             db.refresh(ev)
@@ -784,6 +936,7 @@ def seed(db: Session = Depends(get_db)):
             a2 = Anomaly(event_id=created_events[7].id, type="geo_spatial", severity=5, description="Seed: spatial outlier", timestamp=created_events[7].timestamp)
             db.add(a2)
             anomalies_created += 1
+            bump_data_version(db, "anomalies")
             db.commit()
         return {"inserted_events": len(created_events), "inserted_anomalies": anomalies_created}
     except Exception as e:
@@ -810,6 +963,7 @@ def seed_many(count: int = 1000, sources: Optional[str] = None, db: Session = De
             ev = DataEvent(source=src, timestamp=now, latitude=lat, longitude=lon, data=data, confidence=conf)
             db.add(ev)
             created += 1
+        bump_data_version(db, "events")
         db.commit()
         return {"inserted_events": created}
     except Exception as e:
@@ -819,35 +973,18 @@ def seed_many(count: int = 1000, sources: Optional[str] = None, db: Session = De
             pass
         return {"status": "error", "message": str(e)}
 
-subscribers: List[WebSocket] = []
-
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    subscribers.append(websocket)
-    try:
-        while True:
-            _ = await websocket.receive_text()
-            # No-op: server-driven pushes only
-    except Exception:
-        pass
-    finally:
-        try:
-            subscribers.remove(websocket)
-        except Exception:
-            pass
+    # Pub/sub over hub.py: legacy text alerts, or JSON deltas filtered by source/bbox
+    await hub.serve(websocket)
+
+@app.get("/ws/stats")
+def websocket_stats():
+    return hub.stats()
 
 def broadcast_alert(text: str):
-    for ws in list(subscribers):
-        try:
-            # FastAPI WebSocket requires await; here we schedule via thread-safe path
-            import asyncio
-            asyncio.run(ws.send_text(text))
-        except Exception:
-            try:
-                subscribers.remove(ws)
-            except Exception:
-                pass
+    # Safe to call from any thread; delivery happens on the server loop
+    hub.publish("alerts", [{"text": text}])
 
 @app.get("/")
 def read_root():
@@ -860,18 +997,33 @@ def migrate():
 
 @app.on_event("startup")
 def _startup():
+    ok, msg = ensure_schema()
+    if not ok:
+        print(f"Schema check failed: {msg}")
+    # Background roles are lease-guarded (see worker.py): with several API processes only one
+    # runs each role. Set EMBEDDED_WORKERS="" when running `python worker.py ...` separately.
     try:
-        ensure_schema()
+        roles = os.getenv("EMBEDDED_WORKERS", "ingest,detect,forecast")
+        start_embedded([r.strip() for r in roles.split(",") if r.strip()])
     except Exception:
         pass
     try:
-        threading.Thread(target=schedule_ingestion, daemon=True).start()
+        start_dispatcher()
     except Exception:
         pass
+    # Load the gazetteer and build its KD-tree before the first geocode request needs it
+    threading.Thread(target=get_gazetteer, name="gazetteer-warm", daemon=True).start()
+
+@app.on_event("startup")
+async def _start_hub():
+    hub.attach(asyncio.get_running_loop())
+
+@app.get("/workers")
+def workers_status():
     try:
-        threading.Thread(target=schedule_detection, daemon=True).start()
-    except Exception:
-        pass
+        return {"leases": lease_status()}
+    except Exception as e:
+        return {"leases": [], "error": str(e)}
 
 @app.get("/ingest")
 def ingest_now():
@@ -896,6 +1048,23 @@ def perf_metrics(limit: int = 200, db: Session = Depends(get_db)):
     rows = db.query(PerfMetric).order_by(PerfMetric.id.desc()).limit(limit).all()
     return [{"ts": r.ts.isoformat(), "fps": r.fps, "events": r.events, "anomalies": r.anomalies, "zoom": r.zoom, "device": r.device} for r in rows]
 
+@app.get("/perf/server")
+def perf_server(reset: bool = False):
+    return telemetry.snapshot(reset)
+
+# On-demand sampling profiler; collapsed output feeds flamegraph.pl / speedscope directly
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0, interval_ms: float = 5.0, idle: bool = False, format: str = "collapsed"):
+    if not require_api_key(request.headers):
+        return Response(status_code=403, content=b"Missing or invalid API key")
+    try:
+        stacks, meta = await run_in_threadpool(sample_profile, seconds, interval_ms, idle)
+    except RuntimeError as e:
+        return Response(status_code=409, content=str(e).encode("utf-8"))
+    if format == "json":
+        return {**meta, "stacks": [{"stack": s, "count": n} for s, n in stacks.most_common()]}
+    return Response(content=collapsed(stacks), media_type="text/plain", headers={"X-Profile-Samples": str(meta["samples"])})
+
 @app.get("/summary")
 def summary(window: str = "24h", bbox: Optional[str] = None, db: Session = Depends(get_db)):
     now = datetime.utcnow()
@@ -1073,7 +1242,7 @@ def dis_entity_update(pdu: DISPDU):
 
 # HLA Adapter (IEEE 1516)
 @app.post("/c2/hla/object")
-def hla_object_update(pdu: HLAPDU):
+async def hla_object_update(pdu: HLAPDU):
     try:
         # Convert to HLA Object Model format
         hla_data = {
@@ -1097,16 +1266,19 @@ def hla_object_update(pdu: HLAPDU):
         
         if hla_rti_host and hla_rti_port > 0:
             # In a real implementation, this would connect to HLA RTI
-            # For now, we log and return success
-            import socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # For now, we log and return success. The connect is non-blocking and
+            # time-bounded so a dead RTI cannot tie up request workers.
+            timeout = float(os.getenv("HLA_CONNECT_TIMEOUT", "3"))
+            writer = None
             try:
-                sock.connect((hla_rti_host, hla_rti_port))
-                sock.send(json.dumps(hla_data).encode('utf-8'))
+                _, writer = await asyncio.wait_for(asyncio.open_connection(hla_rti_host, hla_rti_port), timeout)
+                writer.write(json.dumps(hla_data).encode('utf-8'))
+                await asyncio.wait_for(writer.drain(), timeout)
             except Exception as e:
-                print(f"HLA RTI send failed: {e}")
+                print(f"HLA RTI send failed: {e!r}")
             finally:
-                sock.close()
+                if writer is not None:
+                    writer.close()
         
         return {"status": "forwarded", "federation": pdu.federation_name, "object": pdu.object_name}
     except Exception as e:
@@ -1141,6 +1313,7 @@ def submit_spotrep(rep: SPOTREP, push_udp: bool = False):
                 data=spotrep_data
             )
             db.add(event)
+            bump_data_version(db, "events")
             db.commit()
             db.refresh(event)
         finally:
@@ -1189,6 +1362,7 @@ def submit_sitrep(rep: SITREP, push_udp: bool = False):
                 data=sitrep_data
             )
             db.add(event)
+            bump_data_version(db, "events")
             db.commit()
             db.refresh(event)
         finally:
@@ -0,0 +1,354 @@
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from sqlalchemy import func, update
+from sqlalchemy.orm import sessionmaker
+from database import engine, Notification, AlertDelivery
+
+# Outbound notification subsystem.
+# Messages are written to the notification_outbox table (usually in the same
+# transaction as the alert that caused them) and delivered by a small pool of
+# worker threads. Workers share a pool of authenticated SMTP connections, retry
+# with exponential backoff and rate limit per recipient. Items enqueued with
+# digest=True are held and folded into one email per recipient per interval.
+# Messages stuck in 'sending' by a crashed worker are requeued every
+# RECOVER_SEC. When an email is sent or finally fails, the alert ledger rows
+# it carries (directly or through a digest) are marked sent/failed.
+#
+# Configuration (env):
+#   SMTP_HOST, SMTP_PORT (587), SMTP_USERNAME, SMTP_PASSWORD, EMAIL_FROM, EMAIL_TO_DEFAULT
+#   SMTP_STARTTLS (1)           set to 0 for a plain local/stand-in SMTP server
+#   NOTIFY_WORKERS (2)          delivery threads, also the SMTP pool size
+#   NOTIFY_MAX_ATTEMPTS (5)     attempts before a message is marked failed
+#   NOTIFY_BACKOFF_SEC (10)     base delay, doubled on every failed attempt
+#   NOTIFY_RATE_PER_MIN (30)    per-recipient send budget
+#   NOTIFY_DIGEST_SEC (0)       >0 batches alert emails into one digest per interval
+
+Session = sessionmaker(bind=engine)
+
+RECOVER_SEC = 60.0
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def smtp_config():
+    host = os.getenv("SMTP_HOST")
+    from_addr = os.getenv("EMAIL_FROM")
+    if not (host and from_addr):
+        return None
+    return {
+        "host": host,
+        "port": _env_int("SMTP_PORT", 587),
+        "user": os.getenv("SMTP_USERNAME"),
+        "password": os.getenv("SMTP_PASSWORD"),
+        "from_addr": from_addr,
+        "starttls": os.getenv("SMTP_STARTTLS", "1") not in ("0", "false", "no"),
+    }
+
+def digest_interval_sec():
+    return max(0, _env_int("NOTIFY_DIGEST_SEC", 0))
+
+def enqueue_email(session, to_addr: str, subject: str, body: str, digest: bool = False):
+    """Add a message to the outbox. The caller owns the transaction."""
+    # With digests off nothing would ever fold the item, so it is queued as a plain email
+    digest = digest and digest_interval_sec() > 0
+    n = Notification(
+        to_addr=to_addr,
+        subject=subject,
+        body=body,
+        status="digest" if digest else "queued",
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+    )
+    session.add(n)
+    return n
+
+class SMTPPool:
+    def __init__(self, size: int = 2, idle_check_sec: float = 30.0):
+        self.size = max(1, size)
+        self.idle_check_sec = idle_check_sec
+        self._idle = []  # [(conn, last_used, config)]
+        self._lock = threading.Lock()
+
+    def _connect(self, cfg):
+        conn = smtplib.SMTP(cfg["host"], cfg["port"], timeout=20)
+        if cfg["starttls"]:
+            conn.starttls()
+        if cfg["user"] and cfg["password"]:
+            conn.login(cfg["user"], cfg["password"])
+        return conn
+
+    def acquire(self, cfg):
+        while True:
+            with self._lock:
+                item = self._idle.pop() if self._idle else None
+            if item is None:
+                return self._connect(cfg)
+            conn, last_used, conn_cfg = item
+            if conn_cfg != cfg:
+                self._close(conn)
+                continue
+            if time.time() - last_used > self.idle_check_sec:
+                try:
+                    if conn.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("noop failed")
+                except Exception:
+                    self._close(conn)
+                    continue
+            return conn
+
+    def release(self, conn, cfg, broken: bool = False):
+        if broken:
+            self._close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time(), cfg))
+                return
+        self._close(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+class RateLimiter:
+    """Token bucket per recipient."""
+
+    def __init__(self, per_min: int = 30):
+        self.rate = max(1, per_min) / 60.0
+        self.burst = float(max(1, per_min))
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key: str):
+        """Returns 0 when a token was taken, otherwise seconds until one is available."""
+        now = time.time()
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - ts) * self.rate)
+            if tokens >= 1.0:
+                self._buckets[key] = (tokens - 1.0, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1.0 - tokens) / self.rate
+
+class Dispatcher:
+    def __init__(self, workers=None, max_attempts=None, backoff_sec=None, rate_per_min=None, poll_sec: float = 2.0):
+        self.workers = max(1, workers or _env_int("NOTIFY_WORKERS", 2))
+        self.max_attempts = max(1, max_attempts or _env_int("NOTIFY_MAX_ATTEMPTS", 5))
+        self.backoff_sec = max(1, backoff_sec or _env_int("NOTIFY_BACKOFF_SEC", 10))
+        self.poll_sec = poll_sec
+        self.pool = SMTPPool(self.workers)
+        self.limiter = RateLimiter(rate_per_min or _env_int("NOTIFY_RATE_PER_MIN", 30))
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_digest = time.time()
+        self._digest_lock = threading.Lock()
+        self._last_recover = time.time()
+        self._recover_lock = threading.Lock()
+
+    def start(self):
+        if self._threads:
+            return self
+        self._recover()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"notify-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        self.pool.close_all()
+
+    def wake(self):
+        self._wake.set()
+
+    def _recover(self):
+        # Messages left in 'sending' by a crashed process go back to the queue
+        try:
+            with Session() as session:
+                session.execute(
+                    update(Notification)
+                    .where(Notification.status == "sending", Notification.next_attempt_at < datetime.utcnow() - timedelta(minutes=5))
+                    .values(status="queued")
+                )
+                session.commit()
+        except Exception as e:
+            print(f"Notify recovery failed: {e}")
+
+    def _maybe_recover(self):
+        # One worker per interval; the others skip
+        with self._recover_lock:
+            if time.time() - self._last_recover < RECOVER_SEC:
+                return
+            self._last_recover = time.time()
+        self._recover()
+
+    def _run(self):
+        while not self._stop.is_set():
+            worked = False
+            try:
+                self._maybe_recover()
+                self.flush_digests()
+                worked = self.process_once()
+            except Exception as e:
+                print(f"Notify worker error: {e}")
+            if not worked:
+                self._wake.wait(self.poll_sec)
+                self._wake.clear()
+
+    def _claim(self, session):
+        now = datetime.utcnow()
+        candidates = (
+            session.query(Notification.id)
+            .filter(Notification.status == "queued", Notification.next_attempt_at <= now)
+            .order_by(Notification.next_attempt_at, Notification.id)
+            .limit(10)
+            .all()
+        )
+        for (nid,) in candidates:
+            res = session.execute(
+                update(Notification)
+                .where(Notification.id == nid, Notification.status == "queued")
+                .values(status="sending", next_attempt_at=now)
+            )
+            session.commit()
+            if res.rowcount == 1:
+                return session.get(Notification, nid)
+        return None
+
+    def process_once(self) -> bool:
+        """Deliver at most one due message. Returns True if a message was handled."""
+        cfg = smtp_config()
+        if cfg is None:
+            return False
+        with Session() as session:
+            n = self._claim(session)
+            if n is None:
+                return False
+            wait = self.limiter.try_acquire(n.to_addr or "")
+            if wait > 0:
+                n.status = "queued"
+                n.next_attempt_at = datetime.utcnow() + timedelta(seconds=wait)
+                session.commit()
+                return True
+            try:
+                self._send(cfg, n)
+                n.status = "sent"
+                n.sent_at = datetime.utcnow()
+                n.last_error = None
+                self._settle_alerts(session, n, "sent")
+            except Exception as e:
+                n.attempts = (n.attempts or 0) + 1
+                n.last_error = str(e)
+                if n.attempts >= self.max_attempts:
+                    n.status = "failed"
+                    self._settle_alerts(session, n, "failed")
+                else:
+                    n.status = "queued"
+                    delay = self.backoff_sec * (2 ** (n.attempts - 1))
+                    n.next_attempt_at = datetime.utcnow() + timedelta(seconds=min(delay, 3600))
+            session.commit()
+            return True
+
+    def _settle_alerts(self, session, n: Notification, status: str):
+        """Mark the ledger rows whose email went out in n (itself or as digest items) sent/failed."""
+        ids = [n.id] + [i for (i,) in session.query(Notification.id).filter(Notification.digest_id == n.id).all()]
+        values = {"status": status}
+        if status == "sent":
+            values["delivered_at"] = n.sent_at
+        session.execute(update(AlertDelivery).where(AlertDelivery.notification_id.in_(ids), AlertDelivery.status == "queued").values(**values))
+
+    def _send(self, cfg, n: Notification):
+        msg = MIMEText(n.body or "")
+        msg["Subject"] = n.subject or ""
+        msg["From"] = cfg["from_addr"]
+        msg["To"] = n.to_addr
+        conn = self.pool.acquire(cfg)
+        try:
+            conn.sendmail(cfg["from_addr"], [n.to_addr], msg.as_string())
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError):
+            self.pool.release(conn, cfg, broken=True)
+            raise
+        except Exception:
+            # Recipient/data errors leave the session usable
+            self.pool.release(conn, cfg)
+            raise
+        self.pool.release(conn, cfg)
+
+    def flush_digests(self, force: bool = False) -> int:
+        """Fold pending digest items into one queued email per recipient. Returns digests created."""
+        interval = digest_interval_sec()
+        # With digests off, every tick folds whatever is left in 'digest' (items held before
+        # NOTIFY_DIGEST_SEC was turned off) so they are not stranded
+        if not force and interval > 0 and time.time() - self._last_digest < interval:
+            return 0
+        if not self._digest_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last_digest = time.time()
+            created = 0
+            with Session() as session:
+                ids = [nid for (nid,) in session.query(Notification.id).filter(Notification.status == "digest").order_by(Notification.id).all()]
+                by_to = {}
+                for nid in ids:
+                    # Claim row by row so concurrent flushers never fold the same item twice
+                    res = session.execute(
+                        update(Notification).where(Notification.id == nid, Notification.status == "digest").values(status="digested")
+                    )
+                    if res.rowcount == 1:
+                        n = session.get(Notification, nid)
+                        by_to.setdefault(n.to_addr, []).append(n)
+                for to_addr, group in by_to.items():
+                    lines = [f"- {n.subject}: {n.body}" for n in group]
+                    d = enqueue_email(session, to_addr, f"RTAIP Alert digest: {len(group)} alerts", "\n".join(lines))
+                    session.flush()
+                    for n in group:
+                        n.digest_id = d.id
+                    created += 1
+                session.commit()
+            if created:
+                self.wake()
+            return created
+        finally:
+            self._digest_lock.release()
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher()
+        return _dispatcher
+
+def start_dispatcher():
+    return get_dispatcher().start()
+
+def outbox_stats(session):
+    rows = session.query(Notification.status, func.count(Notification.id)).group_by(Notification.status).all()
+    return {s: c for s, c in rows}
@@ -0,0 +1,186 @@
+import os
+import numpy as np
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from database import DataEvent, Anomaly
+from serialization import dumps
+
+# Time-sliced replay for the timeline.
+# Each layer is read as time-ordered column arrays and cached in
+# REPLAY_CHUNK_SEC chunks; each run of uncached chunks is loaded with one
+# indexed range scan and split at the chunk boundaries. Chunks that ended more than
+# REPLAY_SETTLE_H ago are cached by time alone; newer chunks are keyed by the
+# data version as well. Rows still land in settled chunks now and then (feeds
+# that report hours or days late, client-supplied spotrep times, anomalies on
+# such events), so every chunk remembers the highest row id it was loaded
+# through and each request looks up the timestamps of rows above that id: a
+# primary-key range over recent inserts. Chunks that received one are
+# reloaded. With rows
+# sorted by timestamp, the set active at t (timestamp in (t - active, t]) is
+# one contiguous index range, so the delta between consecutive frames is two
+# ranges: rows entering [hi_prev, hi) and rows leaving [lo_prev, lo). Frames
+# are emitted as NDJSON; the first frame (and every keyframe_every-th) carries
+# the full active set, and serialized keyframes are cached.
+#
+# A request spans at most REPLAY_MAX_HOURS (and looks back at most as far for
+# the active window), whatever the step.
+#
+# Configuration (env): REPLAY_CHUNK_SEC (3600), REPLAY_SETTLE_H (6), REPLAY_MAX_FRAMES (10000),
+# REPLAY_MAX_HOURS (720)
+
+CHUNK_SEC = int(os.getenv("REPLAY_CHUNK_SEC", "3600") or 3600)
+SETTLE_H = float(os.getenv("REPLAY_SETTLE_H", "6") or 6)
+MAX_FRAMES = int(os.getenv("REPLAY_MAX_FRAMES", "10000") or 10000)
+MAX_HOURS = float(os.getenv("REPLAY_MAX_HOURS", "720") or 720)
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch(dt):
+    return (dt - EPOCH).total_seconds()
+
+class Track:
+    """Rows of one layer sorted by timestamp, as parallel arrays."""
+
+    def __init__(self, ts, ids, lat, lon, src, extra=None):
+        self.ts = np.asarray(ts, dtype=np.float64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.src = np.asarray(src, dtype=object)
+        self.extra = extra or {}
+        self.hi_id = 0  # table max id when loaded; rows above it were not seen
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + len(self.ts) * (8 * 4 + 64 * (1 + len(self.extra)))
+
+    def slice(self, lo, hi):
+        return self.take(slice(lo, hi))
+
+    def take(self, idx):
+        return Track(self.ts[idx], self.ids[idx], self.lat[idx], self.lon[idx], self.src[idx],
+                     {k: v[idx] for k, v in self.extra.items()})
+
+    @staticmethod
+    def concat(tracks):
+        tracks = [t for t in tracks if len(t)]
+        if not tracks:
+            return Track([], [], [], [], [])
+        keys = tracks[0].extra.keys()
+        return Track(np.concatenate([t.ts for t in tracks]), np.concatenate([t.ids for t in tracks]),
+                     np.concatenate([t.lat for t in tracks]), np.concatenate([t.lon for t in tracks]),
+                     np.concatenate([t.src for t in tracks]), {k: np.concatenate([t.extra[k] for t in tracks]) for k in keys})
+
+    def rows(self, lo, hi):
+        out = []
+        for i in range(lo, hi):
+            item = {"id": int(self.ids[i]), "src": self.src[i], "ts": datetime.utcfromtimestamp(self.ts[i]).isoformat(),
+                    "lat": float(self.lat[i]) if self.lat[i] == self.lat[i] else None,
+                    "lon": float(self.lon[i]) if self.lon[i] == self.lon[i] else None}
+            for k, v in self.extra.items():
+                item[k] = v[i].item() if hasattr(v[i], "item") else v[i]
+            out.append(item)
+        return out
+
+def _epochs(values):
+    return np.array(values, dtype="datetime64[us]").astype(np.int64) / 1e6 if values else np.zeros(0)
+
+def load_chunk(session, layer, t0, t1):
+    nan = float("nan")
+    if layer == "events":
+        rows = session.query(DataEvent.timestamp, DataEvent.id, DataEvent.latitude, DataEvent.longitude, DataEvent.source).filter(
+            DataEvent.timestamp >= t0, DataEvent.timestamp < t1).order_by(DataEvent.timestamp, DataEvent.id).all()
+        return Track(_epochs([r[0] for r in rows]), [r[1] for r in rows],
+                     [nan if r[2] is None else r[2] for r in rows], [nan if r[3] is None else r[3] for r in rows],
+                     [r[4] or "unknown" for r in rows])
+    rows = session.query(Anomaly.timestamp, Anomaly.id, DataEvent.latitude, DataEvent.longitude, DataEvent.source,
+                         Anomaly.event_id, Anomaly.type, Anomaly.severity).outerjoin(DataEvent, DataEvent.id == Anomaly.event_id).filter(
+        Anomaly.timestamp >= t0, Anomaly.timestamp < t1).order_by(Anomaly.timestamp, Anomaly.id).all()
+    return Track(_epochs([r[0] for r in rows]), [r[1] for r in rows],
+                 [nan if r[2] is None else r[2] for r in rows], [nan if r[3] is None else r[3] for r in rows],
+                 [r[4] or "unknown" for r in rows],
+                 {"eid": np.array([r[5] for r in rows], dtype=object), "type": np.array([r[6] for r in rows], dtype=object),
+                  "sev": np.array([r[7] for r in rows], dtype=object)})
+
+def _late_chunks(session, layer, lo_id, hi_id, t0, t1):
+    """Start (epoch) of each chunk in [t0, t1) that rows with lo_id < id <= hi_id landed in."""
+    model = DataEvent if layer == "events" else Anomaly
+    rows = session.query(model.timestamp).filter(model.id > lo_id, model.id <= hi_id, model.timestamp >= t0, model.timestamp < t1).all()
+    return {int(to_epoch(r[0]) // CHUNK_SEC) * CHUNK_SEC for r in rows if r[0] is not None}
+
+def load_track(session, layer, start, end, version, cache):
+    """Track covering [start, end], assembled from cached chunks."""
+    settled = to_epoch(datetime.utcnow() - timedelta(hours=SETTLE_H))
+    first = int(to_epoch(start) // CHUNK_SEC) * CHUNK_SEC
+    starts = list(range(first, int(to_epoch(end)) + 1, CHUNK_SEC))
+    keys = [f"replay:{layer}:{c}" + ("" if c + CHUNK_SEC <= settled else f"@{version}") for c in starts]
+    parts = [cache.get(k, shared=False) for k in keys]
+    # Read before any chunk query, so rows committed in between are checked again next time
+    hi_id = session.query(func.max((DataEvent if layer == "events" else Anomaly).id)).scalar() or 0
+    behind = [k for k, p in enumerate(parts) if p is not None and p.hi_id < hi_id]
+    if behind:
+        late = _late_chunks(session, layer, min(parts[k].hi_id for k in behind), hi_id,
+                            EPOCH + timedelta(seconds=starts[behind[0]]), EPOCH + timedelta(seconds=starts[behind[-1]] + CHUNK_SEC))
+        for k in behind:
+            if starts[k] in late:
+                parts[k] = None
+            else:
+                parts[k].hi_id = max(parts[k].hi_id, hi_id)
+    i = 0
+    while i < len(parts):
+        if parts[i] is not None:
+            i += 1
+            continue
+        j = i
+        while j < len(parts) and parts[j] is None:
+            j += 1
+        # One range query for the whole run of missing chunks, split back at chunk boundaries
+        track = load_chunk(session, layer, EPOCH + timedelta(seconds=starts[i]), EPOCH + timedelta(seconds=starts[j - 1] + CHUNK_SEC))
+        cuts = np.searchsorted(track.ts, [starts[k] for k in range(i + 1, j)], side="left").tolist()
+        for k, (lo, hi) in enumerate(zip([0] + cuts, cuts + [len(track)]), start=i):
+            parts[k] = track.slice(lo, hi)
+            parts[k].hi_id = hi_id
+            cache.set(keys[k], parts[k], ttl_sec=3600, share=False)
+        i = j
+    return Track.concat(parts)
+
+def filter_track(track, bbox=None, sources=None):
+    if not bbox and not sources:
+        return track
+    m = np.ones(len(track), dtype=bool)
+    if bbox:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        m &= (track.lat >= min_lat) & (track.lat <= max_lat) & (track.lon >= min_lon) & (track.lon <= max_lon)
+    if sources:
+        m &= np.isin(track.src, list(sources))
+    return track.take(np.flatnonzero(m))
+
+def frames(tracks, start, end, step, active, keyframe_every=0, keyframe=None):
+    """Yield NDJSON lines: a header, then one frame per step from start to end."""
+    t_start, t_end = to_epoch(start), to_epoch(end)
+    n = min(MAX_FRAMES, int((t_end - t_start) // step) + 1)
+    yield dumps({"type": "header", "start": start.isoformat(), "end": end.isoformat(), "step": step, "active": active,
+                 "frames": n, "layers": list(tracks)}) + b"\n"
+    prev = None
+    for k in range(n):
+        t = t_start + k * step
+        bounds = {name: (int(np.searchsorted(tr.ts, t - active, side="right")), int(np.searchsorted(tr.ts, t, side="right")))
+                  for name, tr in tracks.items()}
+        at = datetime.utcfromtimestamp(t).isoformat()
+        if prev is None or (keyframe_every and k % keyframe_every == 0):
+            if keyframe is not None:
+                yield keyframe(at, bounds)
+            else:
+                yield dumps({"type": "keyframe", "t": at, **{name: tr.rows(*bounds[name]) for name, tr in tracks.items()}}) + b"\n"
+        else:
+            frame = {"type": "delta", "t": at}
+            for name, tr in tracks.items():
+                (plo, phi), (lo, hi) = prev[name], bounds[name]
+                # Windows only move forward, so entering and leaving rows are contiguous ranges
+                add = tr.rows(max(phi, lo), hi)
+                gone = tr.ids[plo:min(lo, phi)].tolist()
+                if add or gone:
+                    frame[name] = {"add": add, "remove": gone}
+            yield dumps(frame) + b"\n"
+        prev = bounds
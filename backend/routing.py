@@ -0,0 +1,275 @@
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from sqlalchemy import func, and_
+from database import DataEvent, Anomaly, get_data_versions
+
+# COA route hazard scoring.
+# A HazardSet holds the events of one time window as unit vectors with a
+# cKDTree over them; it is built once per (window, data version) and shared by
+# every route scored against it. For each leg the tree is probed at points
+# sampled along the great circle, no further apart than the hazard radius, so
+# the candidates are exactly the events inside a buffered corridor around the
+# leg. Candidates then get their true distance to the great-circle segment
+# (cross-track distance when the foot of the perpendicular falls inside the
+# leg, otherwise the distance to the nearer endpoint), vectorized in NumPy.
+
+EARTH_R_KM = 6371.0
+MAX_PROBES = 2000  # very long legs with tiny radii get wider (still exact after filtering) probes
+
+def to_xyz(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    c = np.cos(lat)
+    return np.stack([c * np.cos(lon), c * np.sin(lon), np.sin(lat)], axis=-1)
+
+def _angle(u, v):
+    """Angle between unit vectors (broadcasting), stable for tiny and near-pi angles."""
+    return np.arctan2(np.linalg.norm(np.cross(u, v), axis=-1), np.sum(u * v, axis=-1))
+
+def _chord(km):
+    return 2.0 * np.sin(min(np.pi, km / EARTH_R_KM) / 2.0)
+
+class HazardSet:
+    def __init__(self, ids, lats, lons, sources, timestamps):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lat = np.asarray(lats, dtype=np.float64)
+        self.lon = np.asarray(lons, dtype=np.float64)
+        self.sources = list(sources)
+        self.timestamps = list(timestamps)
+        self.xyz = to_xyz(self.lat, self.lon) if len(self.ids) else np.zeros((0, 3))
+        self.tree = cKDTree(self.xyz) if len(self.ids) else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.xyz.nbytes * 3 + len(self.ids) * 120
+
+    def segment_distances(self, a, b, radius_km):
+        """(indices, distance_km) of hazards within radius_km of the great-circle segment a-b."""
+        if self.tree is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        A, B = to_xyz(*a), to_xyz(*b)
+        seg = float(_angle(A, B))
+        # Probe points every <= radius along the leg; a ball of radius + step/2 around each covers the corridor
+        n = min(MAX_PROBES, max(1, int(np.ceil(seg * EARTH_R_KM / max(radius_km, 1e-3)))))
+        t = np.linspace(0.0, 1.0, n + 1)
+        if seg > 1e-12:
+            probes = (np.sin((1 - t) * seg)[:, None] * A + np.sin(t * seg)[:, None] * B) / np.sin(seg)
+        else:
+            probes = np.repeat(A[None, :], len(t), axis=0)
+        step_km = seg * EARTH_R_KM / n
+        hits = self.tree.query_ball_point(probes, _chord(radius_km + step_km / 2.0))
+        idx = np.unique(np.fromiter((i for h in hits for i in h), dtype=np.int64))
+        if not len(idx):
+            return idx, np.zeros(0)
+        P = self.xyz[idx]
+        d_end = np.minimum(_angle(P, A[None, :]), _angle(P, B[None, :]))
+        normal = np.cross(A, B)
+        nn = np.linalg.norm(normal)
+        if nn > 1e-12:
+            normal /= nn
+            s = P @ normal
+            foot = P - s[:, None] * normal[None, :]
+            # Foot of the perpendicular lies on the minor arc a-b
+            inside = (np.cross(A, foot) @ normal >= 0) & (np.cross(foot, B) @ normal >= 0)
+            d = np.where(inside, np.abs(np.arcsin(np.clip(s, -1.0, 1.0))), d_end)
+        else:
+            d = d_end
+        d_km = d * EARTH_R_KM
+        keep = d_km <= radius_km
+        return idx[keep], d_km[keep]
+
+def build_hazards(session, hours):
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = session.query(DataEvent.id, DataEvent.latitude, DataEvent.longitude, DataEvent.source, DataEvent.timestamp).filter(
+        DataEvent.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)
+    ).all()
+    return HazardSet([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+                     [r[3] for r in rows], [r[4] for r in rows])
+
+def route_distance_km(waypoints):
+    pts = to_xyz([w[0] for w in waypoints], [w[1] for w in waypoints])
+    return float(_angle(pts[:-1], pts[1:]).sum() * EARTH_R_KM)
+
+def score_route(hazards, waypoints, radius_km, max_hazards=20):
+    """Risk summary for one route; each hazard counts once at its distance to the nearest leg."""
+    parts = [hazards.segment_distances(waypoints[i][:2], waypoints[i + 1][:2], radius_km) for i in range(len(waypoints) - 1)]
+    idx = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype=np.int64)
+    d = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0)
+    # Keep each hazard once, at its smallest distance over all legs, then nearest first
+    order = np.lexsort((d, idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = idx[order][1:] != idx[order][:-1]
+    idx, d = idx[order][first], d[order][first]
+    near = np.argsort(d, kind="stable")
+    total_dist = route_distance_km(waypoints)
+    out = [{"id": int(hazards.ids[j]), "source": hazards.sources[j], "latitude": float(hazards.lat[j]), "longitude": float(hazards.lon[j]),
+            "distance_km": float(dj), "timestamp": hazards.timestamps[j].isoformat() if hazards.timestamps[j] else None}
+           for j, dj in zip(idx[near[:max_hazards]].tolist(), d[near[:max_hazards]].tolist())]
+    risk = min(1.0, len(idx) / max(1.0, total_dist / 100.0))
+    return {"risk": risk, "distance_km": total_dist, "hazard_count": int(len(idx)), "hazards": out,
+            "summary": f"Route distance ~{int(total_dist)} km; hazards {len(idx)}; risk {(risk*100):.0f}%"}
+
+# --- hazard cost raster and grid pathfinding ---------------------------------
+# Hazard weight (events count 1, anomalies 1 + severity) is accumulated into
+# global lat/lon grids at several resolutions. One HazardRaster per window
+# length is kept and moved forward on refresh: rows that fell out of the
+# window are subtracted and rows past the last seen ids are added, so a new
+# data version costs a delta query, not a rebuild. Planning crops the finest
+# level whose crop stays under RASTER_MAX_CELLS, blurs it to the hazard
+# radius, and runs Dijkstra (scipy csgraph) over the 8-connected grid with
+# edge cost = length_km * (1 + risk_weight * hazard). The antimeridian is not
+# crossed; crops are clipped to [-180, 180].
+
+
+LEVELS_DEG = (1.0, 0.25, 0.125)
+RASTER_MAX_CELLS = int(os.getenv("RASTER_MAX_CELLS", "90000") or 90000)
+RASTER_STEP_SEC = float(os.getenv("RASTER_STEP_SEC", "60") or 60)
+RASTER_WINDOWS = 4
+KM_PER_DEG = 111.32
+
+class HazardRaster:
+    def __init__(self, hours):
+        self.hours = max(1, hours)
+        self.start = None
+        self.versions = None
+        self.last_ids = (0, 0)
+        self.grids = {deg: np.zeros((int(round(180 / deg)), int(round(360 / deg))), dtype=np.float32) for deg in LEVELS_DEG}
+        self.lock = threading.Lock()
+
+    def _add(self, rows, sign):
+        if not rows:
+            return
+        lat = np.array([r[0] for r in rows], dtype=np.float64)
+        lon = np.array([r[1] for r in rows], dtype=np.float64)
+        w = np.array([r[2] for r in rows], dtype=np.float32) * sign
+        for deg, g in self.grids.items():
+            i = np.clip(((lat + 90.0) / deg).astype(np.int64), 0, g.shape[0] - 1)
+            j = np.clip(((lon + 180.0) / deg).astype(np.int64), 0, g.shape[1] - 1)
+            np.add.at(g, (i, j), w)
+            if sign < 0:
+                np.maximum(g, 0, out=g)
+
+    def _rows(self, session, ev_f, an_f):
+        has_ll = [DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)]
+        ev = session.query(DataEvent.latitude, DataEvent.longitude, func.count(DataEvent.id)).filter(*ev_f, *has_ll) \
+            .group_by(DataEvent.latitude, DataEvent.longitude).all()
+        an = session.query(DataEvent.latitude, DataEvent.longitude, func.sum(1 + func.coalesce(Anomaly.severity, 0))).join(
+            DataEvent, DataEvent.id == Anomaly.event_id).filter(*an_f, *has_ll).group_by(DataEvent.latitude, DataEvent.longitude).all()
+        return ev + an
+
+    def refresh(self, session, now=None):
+        now = now or datetime.utcnow()
+        versions = get_data_versions(session, "events", "anomalies")
+        start = now - timedelta(hours=self.hours)
+        with self.lock:
+            if self.start is not None and versions == self.versions and (start - self.start).total_seconds() < RASTER_STEP_SEC:
+                return self
+            hi = (session.query(func.max(DataEvent.id)).scalar() or 0, session.query(func.max(Anomaly.id)).scalar() or 0)
+            if self.start is None or start < self.start or start - self.start >= timedelta(hours=self.hours):
+                for g in self.grids.values():
+                    g.fill(0)
+                self._add(self._rows(session, [DataEvent.timestamp >= start, DataEvent.id <= hi[0]],
+                                     [Anomaly.timestamp >= start, Anomaly.id <= hi[1]]), 1)
+            else:
+                old, (le, la) = self.start, self.last_ids
+                self._add(self._rows(session, [DataEvent.timestamp >= old, DataEvent.timestamp < start, DataEvent.id <= le],
+                                     [Anomaly.timestamp >= old, Anomaly.timestamp < start, Anomaly.id <= la]), -1)
+                self._add(self._rows(session, [DataEvent.timestamp >= start, and_(DataEvent.id > le, DataEvent.id <= hi[0])],
+                                     [Anomaly.timestamp >= start, and_(Anomaly.id > la, Anomaly.id <= hi[1])]), 1)
+            self.start, self.versions, self.last_ids = start, versions, hi
+        return self
+
+    def crop(self, min_lat, min_lon, max_lat, max_lon):
+        """(deg, lat0, lon0, grid copy) at the finest level whose crop fits RASTER_MAX_CELLS."""
+        min_lat, max_lat = max(-90.0, min_lat), min(90.0, max_lat)
+        min_lon, max_lon = max(-180.0, min_lon), min(180.0, max_lon)
+        for deg in sorted(LEVELS_DEG):
+            i0, i1 = int((min_lat + 90) // deg), int(np.ceil((max_lat + 90) / deg))
+            j0, j1 = int((min_lon + 180) // deg), int(np.ceil((max_lon + 180) / deg))
+            if (i1 - i0) * (j1 - j0) <= RASTER_MAX_CELLS or deg == max(LEVELS_DEG):
+                g = self.grids[deg]
+                with self.lock:
+                    sub = g[i0:i1, j0:j1].astype(np.float64)
+                return deg, i0 * deg - 90.0, j0 * deg - 180.0, sub
+
+_rasters = OrderedDict()
+_rasters_lock = threading.Lock()
+
+def get_raster(session, hours):
+    hours = max(1, hours)
+    with _rasters_lock:
+        r = _rasters.get(hours)
+        if r is None:
+            r = _rasters[hours] = HazardRaster(hours)
+            while len(_rasters) > RASTER_WINDOWS:
+                _rasters.popitem(last=False)
+        _rasters.move_to_end(hours)
+    return r.refresh(session)
+
+def _simplify(cells):
+    """Keep only the cells where the step direction changes."""
+    if len(cells) <= 2:
+        return cells
+    out = [cells[0]]
+    for a, b, c in zip(cells, cells[1:], cells[2:]):
+        if (b[0] - a[0], b[1] - a[1]) != (c[0] - b[0], c[1] - b[1]):
+            out.append(b)
+    out.append(cells[-1])
+    return out
+
+def plan_route(raster, waypoints, radius_km=50.0, risk_weight=4.0):
+    """Lowest-cost path through the waypoints over the hazard raster, as [[lat, lon], ...]."""
+    lats = [w[0] for w in waypoints]
+    lons = [w[1] for w in waypoints]
+    margin = max(2.0, 0.25 * max(max(lats) - min(lats), max(lons) - min(lons)))
+    deg, lat0, lon0, h = raster.crop(min(lats) - margin, min(lons) - margin, max(lats) + margin, max(lons) + margin)
+    rows, cols = h.shape
+    # Spread each hazard over its radius, then scale to [0, 1]
+    h = ndimage.gaussian_filter(h, sigma=max(0.5, radius_km / (KM_PER_DEG * deg) / 2.0), mode="constant")
+    if h.max() > 0:
+        h /= h.max()
+    node = np.arange(rows * cols).reshape(rows, cols)
+    lat_c = lat0 + (np.arange(rows) + 0.5) * deg
+    dy = KM_PER_DEG * deg
+    src, dst, cost = [], [], []
+    for di, dj in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        a = node[0:rows - di, max(0, -dj):cols - max(0, dj)]
+        b = node[di:rows, max(0, dj):cols + min(0, dj)]
+        mid_lat = lat_c[0:rows - di] + di * deg / 2.0
+        dx = KM_PER_DEG * deg * np.cos(np.radians(mid_lat))[:, None] * abs(dj)
+        length = np.broadcast_to(np.sqrt(dx ** 2 + (dy * di) ** 2), a.shape)
+        w = length * (1.0 + risk_weight * (h.flat[a] + h.flat[b]) / 2.0)
+        src.append(a.ravel()); dst.append(b.ravel()); cost.append(w.ravel())
+    graph = coo_matrix((np.concatenate(cost), (np.concatenate(src), np.concatenate(dst))), shape=(rows * cols, rows * cols)).tocsr()
+
+    def cell(lat, lon):
+        i = min(rows - 1, max(0, int((lat - lat0) / deg)))
+        j = min(cols - 1, max(0, int((lon - lon0) / deg)))
+        return int(node[i, j])
+
+    stops = [cell(la, lo) for la, lo in zip(lats, lons)]
+    _, pred = dijkstra(graph, directed=False, indices=stops[:-1], return_predecessors=True)
+    out = []
+    for k in range(len(stops) - 1):
+        leg, n = [], stops[k + 1]
+        while n != stops[k] and n >= 0:
+            leg.append(n)
+            n = pred[k, n]
+        leg.append(stops[k])
+        leg.reverse()
+        pts = [[lat0 + (i + 0.5) * deg, lon0 + (j + 0.5) * deg] for i, j in _simplify([divmod(int(c), cols) for c in leg])]
+        # Legs start and end on the requested waypoints, not on cell centres
+        if len(pts) < 2:
+            pts = [None, None]
+        pts[0], pts[-1] = [lats[k], lons[k]], [lats[k + 1], lons[k + 1]]
+        out.extend(pts if not out else pts[1:])
+    return out, deg
@@ -0,0 +1,146 @@
+from sqlalchemy import and_, insert, literal, select
+from database import DataEvent, Anomaly, DetectorRule
+
+# Declarative detector rules.
+# Each DetectorRule is a single predicate over an event: a normalized column
+# (source/confidence/latitude/longitude) or a JSON path into DataEvent.data.
+# Rules compile to SQL and run as one INSERT ... SELECT per rule over the id
+# range of newly ingested events, so no Python loop over the table is needed.
+
+NORMALIZED_FIELDS = {
+    "source": DataEvent.source,
+    "confidence": DataEvent.confidence,
+    "latitude": DataEvent.latitude,
+    "longitude": DataEvent.longitude,
+}
+
+OPS = (">", ">=", "<", "<=", "==", "!=", "in", "contains", "exists")
+
+DEFAULT_RULES = [
+    {
+        "name": "USGS high magnitude",
+        "source": "usgs_seismic",
+        "field": "properties.mag",
+        "op": ">",
+        "value": 4,
+        "type": "seismic_high",
+        "severity": 7,
+        "description": "High magnitude earthquake",
+    },
+    {
+        "name": "GDACS red alert",
+        "source": "gdacs_disasters",
+        "field": "properties.alertlevel",
+        "op": "in",
+        "value": ["Red", "red", "RED"],
+        "type": "disaster_red_alert",
+        "severity": 8,
+        "description": "GDACS red alert level",
+    },
+]
+
+def _json_path(field: str):
+    parts = [p for p in field.split(".") if p != ""]
+    if parts and parts[0] in ("data", "$"):
+        parts = parts[1:]
+    if not parts:
+        raise ValueError(f"empty JSON path: {field!r}")
+    return tuple(int(p) if p.lstrip("-").isdigit() else p for p in parts)
+
+def _field_expr(field: str, value):
+    if field in NORMALIZED_FIELDS:
+        return NORMALIZED_FIELDS[field]
+    path = DataEvent.data[_json_path(field)]
+    sample = value[0] if isinstance(value, (list, tuple)) and value else value
+    if isinstance(sample, bool):
+        return path.as_boolean()
+    if isinstance(sample, (int, float)):
+        return path.as_float()
+    if sample is None:
+        return path
+    return path.as_string()
+
+def compile_rule(rule: DetectorRule):
+    """Compile a rule into a SQLAlchemy boolean clause over DataEvent."""
+    field = (rule.field or "").strip()
+    op = (rule.op or ">").strip()
+    value = rule.value
+    if not field:
+        raise ValueError("rule field is required")
+    if op not in OPS:
+        raise ValueError(f"unsupported op {op!r}; expected one of {', '.join(OPS)}")
+    expr = _field_expr(field, value)
+    if op == ">":
+        pred = expr > value
+    elif op == ">=":
+        pred = expr >= value
+    elif op == "<":
+        pred = expr < value
+    elif op == "<=":
+        pred = expr <= value
+    elif op == "==":
+        pred = expr == value
+    elif op == "!=":
+        pred = expr != value
+    elif op == "in":
+        if not isinstance(value, (list, tuple)) or not value:
+            raise ValueError("'in' requires a non-empty list value")
+        pred = expr.in_(list(value))
+    elif op == "contains":
+        pred = expr.contains(str(value), autoescape=True)
+    elif field in NORMALIZED_FIELDS:
+        pred = expr.isnot(None)
+    else:
+        # The raw JSON element is never SQL NULL on SQLite (a missing key reads as 'null');
+        # the extracted scalar is NULL for both a missing key and a JSON null
+        pred = DataEvent.data[_json_path(field)].as_string().isnot(None)
+    if rule.source:
+        pred = and_(DataEvent.source == rule.source, pred)
+    return pred
+
+def evaluate_rules(session, rules, lo_id: int, hi_id: int) -> int:
+    """
+    Run every enabled rule over events with lo_id < id <= hi_id.
+    Matches are inserted straight into anomalies via INSERT ... SELECT.
+    Returns the number of anomalies created.
+    """
+    created = 0
+    for r in rules:
+        if r.enabled is False:
+            continue
+        try:
+            pred = compile_rule(r)
+        except Exception as e:
+            print(f"Detector rule {r.id} ({r.name}) skipped: {e}")
+            continue
+        desc = f"{r.description or r.name} (rule={r.field}{r.op}{r.value})"
+        sel = select(
+            DataEvent.id,
+            literal(r.type or "rule_match"),
+            literal(int(r.severity or 5)),
+            literal(desc),
+            DataEvent.timestamp,
+        ).where(DataEvent.id > lo_id, DataEvent.id <= hi_id, pred)
+        res = session.execute(
+            insert(Anomaly).from_select(["event_id", "type", "severity", "description", "timestamp"], sel)
+        )
+        created += max(0, res.rowcount or 0)
+    return created
+
+def seed_default_rules(session):
+    for d in DEFAULT_RULES:
+        session.add(DetectorRule(enabled=True, **d))
+
+def serialize_rule(r: DetectorRule):
+    return {
+        "id": r.id,
+        "name": r.name,
+        "source": r.source,
+        "field": r.field,
+        "op": r.op,
+        "value": r.value,
+        "type": r.type,
+        "severity": r.severity,
+        "description": r.description,
+        "enabled": bool(r.enabled) if r.enabled is not None else True,
+    }
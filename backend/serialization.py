@@ -0,0 +1,127 @@
+import gzip
+import os
+import threading
+from collections import OrderedDict
+import orjson
+from fastapi.responses import Response
+
+try:
+    import brotli  # optional: enables "br" for clients that ask for it
+except ImportError:
+    brotli = None
+
+# Response serialization.
+# Event and anomaly rows never change once written, so each row's JSON is
+# encoded once with orjson and kept as bytes in a bounded LRU keyed by
+# (kind, id). List responses are assembled by joining cached fragments, and
+# the assembled body is compressed lazily per negotiated encoding (br, gzip)
+# and memoized alongside the raw bytes.
+#
+# Configuration (env):
+#   SERIALIZE_FRAGMENT_MAX (500000)   cached row fragments
+#   SERIALIZE_MIN_COMPRESS (1024)     smaller bodies are sent as-is
+
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=str, option=_ORJSON_OPTS)
+
+class FragmentCache:
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or _env_int("SERIALIZE_FRAGMENT_MAX", 500000)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, kind, ids):
+        """Cached fragments for ids, None where a row has not been encoded yet."""
+        with self._lock:
+            out = []
+            for i in ids:
+                frag = self._data.get((kind, i))
+                if frag is not None:
+                    self._data.move_to_end((kind, i))
+                out.append(frag)
+            hit = sum(1 for f in out if f is not None)
+            self.hits += hit
+            self.misses += len(out) - hit
+        return out
+
+    def encode(self, kind, rows, to_dict):
+        """Encode rows (objects with .id), store and return their fragments."""
+        frags = [dumps(to_dict(r)) for r in rows]
+        with self._lock:
+            for r, f in zip(rows, frags):
+                self._data[(kind, r.id)] = f
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return frags
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
+
+fragments = FragmentCache()
+
+def json_array(frags) -> bytes:
+    return b"[" + b",".join(frags) + b"]"
+
+def negotiate(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header, honouring q=0."""
+    prefs = {}
+    for part in (accept_encoding or "").lower().split(","):
+        bits = part.strip().split(";")
+        if not bits[0]:
+            continue
+        q = 1.0
+        for b in bits[1:]:
+            b = b.strip()
+            if b.startswith("q="):
+                try:
+                    q = float(b[2:])
+                except ValueError:
+                    q = 0.0
+        prefs[bits[0]] = q
+    for enc in (("br",) if brotli is not None else ()) + ("gzip",):
+        if prefs.get(enc, prefs.get("*", 0.0)) > 0:
+            return enc
+    return None
+
+class EncodedBody:
+    """Serialized response body plus lazily built compressed variants."""
+
+    def __init__(self, raw: bytes, media_type="application/json"):
+        self.raw = raw
+        self.media_type = media_type
+        self._variants = {}
+
+    def variant(self, encoding):
+        if encoding is None or len(self.raw) < _env_int("SERIALIZE_MIN_COMPRESS", 1024):
+            return self.raw, None
+        body = self._variants.get(encoding)
+        if body is None:
+            if encoding == "br":
+                body = brotli.compress(self.raw, quality=4)
+            else:
+                body = gzip.compress(self.raw, compresslevel=5)
+            self._variants[encoding] = body
+        return body, encoding
+
+    def __sizeof__(self):
+        # Lets the response cache budget count the payload, not just the wrapper
+        return object.__sizeof__(self) + len(self.raw) + sum(len(v) for v in self._variants.values())
+
+def encoded_response(request, body: EncodedBody, headers=None, status_code=200):
+    content, enc = body.variant(negotiate(request.headers.get("accept-encoding")))
+    h = dict(headers or {})
+    h["Vary"] = "Accept-Encoding"
+    if enc:
+        h["Content-Encoding"] = enc
+    return Response(content=content, status_code=status_code, media_type=body.media_type, headers=h)
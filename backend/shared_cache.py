@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from starlette.concurrency import run_in_threadpool
+
+# Cross-process cache tier.
+# A SQLite file in WAL mode that every worker process on the host opens, used
+# by cache.TTLCache as a second level behind its in-process LRU. Only values
+# that round-trip as bytes are shared: EncodedBody responses (/events,
+# /anomalies, COP, tiles, heatmaps), raw bytes and strings (geocoder names);
+# anything else stays process-local. Each entry has an absolute expiry; the
+# file is kept under SHARED_CACHE_MAX_MB by dropping expired entries and then
+# those expiring soonest. claim()/release() give cross-process miss coalescing:
+# the first process to miss a key computes it while the others wait for it to
+# appear. Deletions are appended to an invalidation log that every process
+# polls, so delete/delete_prefix/clear reach all in-process caches.
+#
+# The file lives in .rtaip-cache/ under the working directory, named from
+# DATABASE_URL, so deployments on one host never see each other's keys. The
+# directory is created 0700 and the file 0600; a file or directory owned by
+# another user, or open to group/other, disables the tier rather than letting
+# that user read or forge cached responses.
+#
+# Configuration (env):
+#   SHARED_CACHE (1)  SHARED_CACHE_PATH  SHARED_CACHE_MAX_MB (512)  SHARED_CACHE_MAX_ITEM_MB (64)
+#   SHARED_CACHE_WAIT_MS (5000)  SHARED_CACHE_POLL_MS (250)
+
+KIND_BODY, KIND_BYTES, KIND_STR = 1, 2, 3
+TRIM_EVERY = 64
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, str(default)) or default)
+    except Exception:
+        return default
+
+def default_path():
+    url = os.environ.get("DATABASE_URL", "sqlite:///rtaip.db")
+    tag = hashlib.sha1(f"{url}|{os.getcwd()}".encode("utf-8")).hexdigest()[:12]
+    return os.path.join(os.getcwd(), ".rtaip-cache", f"shared-{tag}.sqlite")
+
+def _check_private(path, st):
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {st.st_uid}, not this user")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"{path} is accessible to other users (mode {st.st_mode & 0o777:o})")
+
+def open_private(path, own_dir=False):
+    """Create path for this user only; raises if it (or, with own_dir, its directory) is not private."""
+    if own_dir:
+        d = os.path.dirname(path)
+        os.makedirs(d, mode=0o700, exist_ok=True)
+        _check_private(d, os.lstat(d))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    try:
+        _check_private(path, os.fstat(fd))
+    finally:
+        os.close(fd)
+
+def encode(value):
+    """(kind, payload, media) for shareable values, else None."""
+    from serialization import EncodedBody
+    if isinstance(value, EncodedBody):
+        return KIND_BODY, value.raw, value.media_type
+    if isinstance(value, (bytes, bytearray)):
+        return KIND_BYTES, bytes(value), None
+    if isinstance(value, str):
+        return KIND_STR, value.encode("utf-8"), None
+    return None
+
+def decode(kind, payload, media):
+    from serialization import EncodedBody
+    if kind == KIND_BODY:
+        return EncodedBody(bytes(payload), media or "application/json")
+    if kind == KIND_STR:
+        return bytes(payload).decode("utf-8")
+    return bytes(payload)
+
+class SharedCache:
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or os.getenv("SHARED_CACHE_PATH") or default_path()
+        open_private(self.path, own_dir=self.path == default_path())
+        self.max_bytes = int(max_bytes or _env_float("SHARED_CACHE_MAX_MB", 512) * 1024 * 1024)
+        self.max_item = int(_env_float("SHARED_CACHE_MAX_ITEM_MB", 64) * 1024 * 1024)
+        self.wait_sec = _env_float("SHARED_CACHE_WAIT_MS", 5000) / 1000.0
+        self.poll_sec = _env_float("SHARED_CACHE_POLL_MS", 250) / 1000.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seq = None
+        self._polled = 0.0
+        self._writes_since_trim = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.waits = 0
+        self.errors = 0
+        self.trimmed = 0
+        self._init()
+
+    def _conn(self):
+        # One connection per thread and per process (a forked child must not reuse the parent's)
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=2.0, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = c, os.getpid()
+        return c
+
+    def _init(self):
+        c = self._conn()
+        c.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, kind INTEGER, media TEXT, value BLOB, size INTEGER, expires REAL)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_entries_expires ON entries(expires)")
+        c.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires REAL)")
+        c.execute("CREATE TABLE IF NOT EXISTS invalidations (seq INTEGER PRIMARY KEY AUTOINCREMENT, prefix TEXT, at REAL)")
+        self._seq = c.execute("SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()[0]
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def get(self, key):
+        """(value, seconds left) or None."""
+        try:
+            row = self._conn().execute("SELECT kind, media, value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            self._count("errors")
+            return None
+        now = time.time()
+        if row is None or row[3] < now:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return decode(row[0], row[2], row[1]), row[3] - now
+
+    def set(self, key, value, ttl_sec):
+        enc = encode(value)
+        if enc is None:
+            return False
+        if len(enc[1]) > self.max_item:
+            self.delete(key)  # do not leave an older value behind for other processes
+            return False
+        kind, payload, media = enc
+        try:
+            self._conn().execute("INSERT OR REPLACE INTO entries (key, kind, media, value, size, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                                 (key, kind, media, sqlite3.Binary(payload), len(payload), time.time() + ttl_sec))
+        except sqlite3.Error:
+            self._count("errors")
+            return False
+        with self._lock:
+            self.writes += 1
+            self._writes_since_trim += 1
+            due = self._writes_since_trim >= TRIM_EVERY
+            if due:
+                self._writes_since_trim = 0
+        if due:
+            self.trim()
+        return True
+
+    def trim(self):
+        """Drop expired entries, then the soonest-expiring until under 90% of max_bytes."""
+        try:
+            c = self._conn()
+            now = time.time()
+            n = c.execute("DELETE FROM entries WHERE expires < ?", (now,)).rowcount
+            c.execute("DELETE FROM claims WHERE expires < ?", (now,))
+            total = c.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total > self.max_bytes * 0.9:
+                rows = c.execute("SELECT key, size FROM entries ORDER BY expires LIMIT 64").fetchall()
+                if not rows:
+                    break
+                c.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in rows])
+                total -= sum(s for _, s in rows)
+                n += len(rows)
+            with self._lock:
+                self.trimmed += n
+        except sqlite3.Error:
+            self._count("errors")
+
+    def claim(self, key, ttl_sec):
+        """True if this process should compute key; False if another process already is."""
+        now = time.time()
+        try:
+            c = self._conn()
+            c.execute("DELETE FROM claims WHERE key = ? AND expires < ?", (key, now))
+            return c.execute("INSERT OR IGNORE INTO claims (key, expires) VALUES (?, ?)", (key, now + ttl_sec)).rowcount == 1
+        except sqlite3.Error:
+            self._count("errors")
+            return True
+
+    def release(self, key):
+        try:
+            self._conn().execute("DELETE FROM claims WHERE key = ?", (key,))
+        except sqlite3.Error:
+            self._count("errors")
+
+    def claimed(self, key):
+        try:
+            row = self._conn().execute("SELECT expires FROM claims WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            self._count("errors")
+            return False
+        return row is not None and row[0] >= time.time()
+
+    def wait_for(self, key):
+        """Wait while another process holds the claim on key; the shared value if it appeared."""
+        self._count("waits")
+        deadline = time.time() + self.wait_sec
+        while time.time() < deadline and self.claimed(key):
+            time.sleep(0.02)
+        return self.get(key)
+
+    async def wait_for_async(self, key):
+        # SQLite calls can block on a writer's lock; keep them off the event loop
+        self._count("waits")
+        deadline = time.time() + self.wait_sec
+        while time.time() < deadline and await run_in_threadpool(self.claimed, key):
+            await asyncio.sleep(0.02)
+        return await run_in_threadpool(self.get, key)
+
+    def delete_prefix(self, prefix):
+        """Delete entries by key prefix ("" for all) and log it for the other processes."""
+        try:
+            c = self._conn()
+            if prefix:
+                # Range scan on the primary key instead of LIKE, which would need escaping
+                c.execute("DELETE FROM entries WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+            else:
+                c.execute("DELETE FROM entries")
+            c.execute("INSERT INTO invalidations (prefix, at) VALUES (?, ?)", (prefix, time.time()))
+            c.execute("DELETE FROM invalidations WHERE at < ?", (time.time() - 3600,))
+        except sqlite3.Error:
+            self._count("errors")
+
+    def delete(self, key):
+        try:
+            c = self._conn()
+            c.execute("DELETE FROM entries WHERE key = ?", (key,))
+            c.execute("INSERT INTO invalidations (prefix, at) VALUES (?, ?)", ("=" + key, time.time()))
+        except sqlite3.Error:
+            self._count("errors")
+
+    def poll_due(self):
+        return time.time() - self._polled >= self.poll_sec
+
+    def invalidations(self):
+        """Prefixes (or "=key" exact keys) deleted by any process since the last poll, at most every poll_sec.
+        A process also sees its own deletions here; applying them twice is harmless."""
+        now = time.time()
+        with self._lock:
+            if now - self._polled < self.poll_sec:
+                return []
+            self._polled = now
+            seq = self._seq
+        try:
+            rows = self._conn().execute("SELECT seq, prefix FROM invalidations WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        except sqlite3.Error:
+            self._count("errors")
+            return []
+        if not rows:
+            return []
+        with self._lock:
+            self._seq = max(self._seq, rows[-1][0])
+        return [p for _, p in rows]
+
+    def stats(self):
+        try:
+            entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        with self._lock:
+            return {"path": self.path, "entries": entries, "bytes": size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "writes": self.writes, "waits": self.waits,
+                    "trimmed": self.trimmed, "errors": self.errors}
+
+def from_env():
+    if os.getenv("SHARED_CACHE", "1").lower() in ("0", "false", "no", "off"):
+        return None
+    try:
+        return SharedCache()
+    except Exception as e:
+        print(f"Shared cache disabled: {e}")
+        return None
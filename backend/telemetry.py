@@ -0,0 +1,229 @@
+import bisect
+import contextvars
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Server-side request telemetry.
+# TelemetryMiddleware times every HTTP request and files it under its route
+# template ("GET /incidents/{incident_id}"), with latency and response-size
+# histograms, status counts and the time spent in SQL. SQL time comes from
+# cursor-execute events on every SQLAlchemy engine (sync and async), added to
+# an accumulator the middleware puts in a contextvar; threadpool and greenlet
+# hops copy the context, so sync handlers and async sessions are both covered.
+# Histograms use fixed log-spaced buckets, so recording is a bisect and an
+# increment, and p50/p95/p99 are interpolated within a bucket (a few percent).
+#
+# profile() is a wall-clock sampling profiler: a thread snapshots every
+# thread's stack (sys._current_frames) each interval for N seconds and returns
+# collapsed stacks ("frame;frame;frame count", root first), which
+# flamegraph.pl, speedscope and inferno read directly. It costs nothing when
+# idle and one stack walk per thread per sample while running.
+#
+# Configuration (env): TELEMETRY_ENABLED (1), PROFILE_MAX_SEC (60)
+
+ENABLED = os.getenv("TELEMETRY_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+PROFILE_MAX_SEC = float(os.getenv("PROFILE_MAX_SEC", "60") or 60)
+
+def _log_bounds(lo, hi, per_decade=12):
+    n = int(math.ceil(math.log10(hi / lo) * per_decade))
+    return [lo * 10 ** (i / per_decade) for i in range(n + 1)]
+
+LATENCY_BOUNDS_MS = _log_bounds(0.1, 120000.0)
+SIZE_BOUNDS = _log_bounds(16.0, 1024.0 ** 3)
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "n", "total", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.n += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        if not self.n:
+            return None
+        rank = q * self.n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = self.bounds[i - 1] if i > 0 else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(self.max, lo + (hi - lo) * (rank - seen) / c)
+            seen += c
+        return self.max
+
+    def summary(self, digits=2):
+        if not self.n:
+            return {"count": 0}
+        r = lambda v: round(v, digits)
+        return {"count": self.n, "mean": r(self.total / self.n), "p50": r(self.quantile(0.5)), "p95": r(self.quantile(0.95)),
+                "p99": r(self.quantile(0.99)), "max": r(self.max)}
+
+class RouteStats:
+    __slots__ = ("latency", "size", "db", "queries", "status", "bytes")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BOUNDS_MS)
+        self.size = Histogram(SIZE_BOUNDS)
+        self.db = Histogram(LATENCY_BOUNDS_MS)
+        self.queries = 0
+        self.status = Counter()
+        self.bytes = 0
+
+    def summary(self):
+        n = self.latency.n
+        return {"latency_ms": self.latency.summary(), "size_bytes": self.size.summary(0), "bytes_total": self.bytes,
+                "db_ms": self.db.summary(), "db_queries_per_request": round(self.queries / n, 2) if n else None,
+                "db_share": round(self.db.total / self.latency.total, 3) if self.latency.total else None,
+                "status": {str(k): v for k, v in sorted(self.status.items())}}
+
+class DbTimer:
+    __slots__ = ("seconds", "queries")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+_db_timer = contextvars.ContextVar("rtaip_db_timer", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    if _db_timer.get() is not None:
+        conn.info["_telemetry_t0"] = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    timer = _db_timer.get()
+    t0 = conn.info.pop("_telemetry_t0", None)
+    if timer is not None and t0 is not None:
+        timer.seconds += time.perf_counter() - t0
+        timer.queries += 1
+
+class Telemetry:
+    def __init__(self):
+        self.enabled = ENABLED
+        self.routes = {}
+        self.since = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, key, status, seconds, size, timer):
+        with self._lock:
+            s = self.routes.get(key)
+            if s is None:
+                s = self.routes[key] = RouteStats()
+            s.latency.add(seconds * 1000.0)
+            s.size.add(size)
+            s.db.add(timer.seconds * 1000.0)
+            s.queries += timer.queries
+            s.status[status] += 1
+            s.bytes += size
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            out = {"since": self.since, "uptime_sec": round(time.time() - self.since, 1),
+                   "routes": {k: s.summary() for k, s in sorted(self.routes.items())}}
+            if reset:
+                self.routes = {}
+                self.since = time.time()
+        return out
+
+telemetry = Telemetry()
+
+def _route_key(scope):
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    # Unmatched paths (404s, scans) share one entry so they cannot grow the table
+    return f"{scope.get('method', 'GET')} {path}" if path else "unmatched"
+
+class TelemetryMiddleware:
+    """ASGI middleware recording per-route latency, response size and DB time."""
+
+    def __init__(self, app, recorder=telemetry):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.recorder.enabled:
+            return await self.app(scope, receive, send)
+        timer = DbTimer()
+        token = _db_timer.set(timer)
+        state = {"status": 500, "size": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["size"] += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _db_timer.reset(token)
+            try:
+                self.recorder.record(_route_key(scope), state["status"], time.perf_counter() - start, state["size"], timer)
+            except Exception as e:
+                print(f"Telemetry record failed: {e}")
+
+# Sampling profiler
+_profile_lock = threading.Lock()
+_IDLE = {("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+         ("queue.py", "get"), ("thread.py", "_worker"), ("_base.py", "wait"), ("socket.py", "accept")}
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def profile(seconds, interval_ms=5.0, include_idle=False):
+    """Sample all thread stacks for `seconds`; returns (collapsed stack counts, metadata).
+
+    Raises RuntimeError when a profile is already running."""
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("a profile is already running")
+    try:
+        seconds = max(0.1, min(float(seconds), PROFILE_MAX_SEC))
+        interval = max(0.001, float(interval_ms) / 1000.0)
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names.update((t.ident, t.name) for t in threading.enumerate() if t.ident not in names)
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if not include_idle and leaf in _IDLE:
+                    continue
+                labels = []
+                f = frame
+                while f is not None:
+                    labels.append(_frame_label(f.f_code))
+                    f = f.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(labels))] += 1
+            samples += 1
+            time.sleep(interval)
+        return stacks, {"seconds": seconds, "interval_ms": interval * 1000.0, "samples": samples,
+                        "stacks": len(stacks), "frames_sampled": sum(stacks.values())}
+    finally:
+        _profile_lock.release()
+
+def collapsed(stacks):
+    return "".join(f"{s} {n}\n" for s, n in stacks.most_common())
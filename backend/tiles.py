@@ -0,0 +1,192 @@
+import math
+import struct
+import numpy as np
+from datetime import datetime, timedelta
+from database import DataEvent, Anomaly
+
+# Mapbox Vector Tiles (spec v2.1) of events and anomalies.
+# A PointIndex is built per (layer, time window, data version). Points are
+# projected to normalized Web Mercator once; for every zoom up to
+# CLUSTER_MAX_ZOOM they are binned into a grid of CELLS_PER_TILE x
+# CELLS_PER_TILE cells per tile, each level derived from the one below by
+# halving the cell index, so a cluster at zoom z is exactly the union of its
+# children at z+1. Levels are sorted by tile key, which turns a tile request
+# into one searchsorted range. Above CLUSTER_MAX_ZOOM individual points are
+# served from an x-sorted array. The protobuf encoding is hand-rolled; only
+# POINT features are needed.
+
+EXTENT = 4096
+CELLS_PER_TILE = 32          # cluster cell = 128 extent units (~16 px on a 512 px tile)
+CLUSTER_MAX_ZOOM = 12
+MAX_ZOOM = 22
+MAX_LAT = 85.05112878
+
+def lonlat_to_world(lat, lon):
+    """Normalized Web Mercator: x, y in [0, 1), y grows southwards."""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    lon = np.asarray(lon, dtype=np.float64)
+    x = (lon + 180.0) / 360.0
+    s = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + s) / (1 - s)) / (4 * math.pi)
+    return np.clip(x, 0.0, 1.0 - 1e-12), np.clip(y, 0.0, 1.0 - 1e-12)
+
+class _Level:
+    __slots__ = ("tile_key", "x", "y", "count", "max_sev", "first_id")
+
+class PointIndex:
+    def __init__(self, ids, lats, lons, sources, severities):
+        ids = np.asarray(ids, dtype=np.int64)
+        ok = ~(np.isnan(np.asarray(lats, dtype=np.float64)) | np.isnan(np.asarray(lons, dtype=np.float64)))
+        self.size = int(ok.sum())
+        x, y = lonlat_to_world(np.asarray(lats, dtype=np.float64)[ok], np.asarray(lons, dtype=np.float64)[ok])
+        src_names, src_codes = np.unique(np.asarray(sources, dtype=object)[ok].astype(str), return_inverse=True)
+        self.source_names = list(src_names)
+        sev = np.asarray(severities, dtype=np.int64)[ok]
+        ids = ids[ok]
+        order = np.argsort(x, kind="stable")
+        self.px, self.py, self.pid, self.psrc, self.psev = x[order], y[order], ids[order], src_codes[order], sev[order]
+        self.levels = {}
+        self._build_levels(x, y, ids, sev)
+
+    def _build_levels(self, x, y, ids, sev):
+        if self.size == 0:
+            return
+        n = (1 << CLUSTER_MAX_ZOOM) * CELLS_PER_TILE
+        cx = (x * n).astype(np.int64)
+        cy = (y * n).astype(np.int64)
+        w = np.ones(len(x), dtype=np.int64)
+        sx, sy = x.copy(), y.copy()  # weighted sums for centroids
+        first = ids.copy()
+        for z in range(CLUSTER_MAX_ZOOM, -1, -1):
+            n = (1 << z) * CELLS_PER_TILE
+            key = cx * n + cy
+            uniq, inv = np.unique(key, return_inverse=True)
+            m = len(uniq)
+            cnt = np.bincount(inv, weights=w, minlength=m).astype(np.int64)
+            sxs = np.bincount(inv, weights=sx, minlength=m)
+            sys_ = np.bincount(inv, weights=sy, minlength=m)
+            msev = np.zeros(m, dtype=np.int64)
+            np.maximum.at(msev, inv, sev)
+            fid = np.full(m, np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(fid, inv, first)
+            ux, uy = uniq // n, uniq % n
+            lvl = _Level()
+            tile_key = (ux // CELLS_PER_TILE) * (1 << z) + (uy // CELLS_PER_TILE)
+            order = np.argsort(tile_key, kind="stable")
+            lvl.tile_key = tile_key[order]
+            lvl.count = cnt[order]
+            lvl.x = (sxs / cnt)[order]
+            lvl.y = (sys_ / cnt)[order]
+            lvl.max_sev = msev[order]
+            lvl.first_id = fid[order]
+            self.levels[z] = lvl
+            # Parent level: halve cell coordinates, carry sums up
+            cx, cy, w, sx, sy, sev, first = ux >> 1, uy >> 1, cnt, sxs, sys_, msev, fid
+
+    def tile_features(self, z, tx, ty):
+        """Returns [(id, x_px, y_px, props)] in tile extent units."""
+        scale = float(1 << z)
+        out = []
+        if self.size == 0:
+            return out
+        if z <= CLUSTER_MAX_ZOOM:
+            lvl = self.levels[z]
+            k = tx * (1 << z) + ty
+            lo, hi = np.searchsorted(lvl.tile_key, [k, k + 1])
+            xs = ((lvl.x[lo:hi] * scale - tx) * EXTENT).astype(np.int64)
+            ys = ((lvl.y[lo:hi] * scale - ty) * EXTENT).astype(np.int64)
+            for i in range(hi - lo):
+                c = int(lvl.count[lo + i])
+                props = {"count": c, "cluster": c > 1, "max_severity": int(lvl.max_sev[lo + i])}
+                out.append((int(lvl.first_id[lo + i]), int(xs[i]), int(ys[i]), props))
+            return out
+        x0, x1 = tx / scale, (tx + 1) / scale
+        y0, y1 = ty / scale, (ty + 1) / scale
+        lo, hi = np.searchsorted(self.px, [x0, x1])
+        sel = np.flatnonzero((self.py[lo:hi] >= y0) & (self.py[lo:hi] < y1)) + lo
+        for i in sel:
+            props = {"count": 1, "cluster": False, "source": self.source_names[self.psrc[i]], "max_severity": int(self.psev[i])}
+            out.append((int(self.pid[i]), int((self.px[i] * scale - tx) * EXTENT), int((self.py[i] * scale - ty) * EXTENT), props))
+        return out
+
+def build_event_index(session, hours):
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = session.query(DataEvent.id, DataEvent.latitude, DataEvent.longitude, DataEvent.source).filter(
+        DataEvent.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)
+    ).all()
+    sev = {}
+    for eid, s in session.query(Anomaly.event_id, Anomaly.severity).join(DataEvent, DataEvent.id == Anomaly.event_id).filter(DataEvent.timestamp >= start).all():
+        sev[eid] = max(sev.get(eid, 0), s or 0)
+    return PointIndex([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+                      [r[3] or "unknown" for r in rows], [sev.get(r[0], 0) for r in rows])
+
+def build_anomaly_index(session, hours):
+    start = datetime.utcnow() - timedelta(hours=max(1, hours))
+    rows = session.query(Anomaly.id, DataEvent.latitude, DataEvent.longitude, Anomaly.type, Anomaly.severity).join(
+        DataEvent, DataEvent.id == Anomaly.event_id
+    ).filter(Anomaly.timestamp >= start, DataEvent.latitude.isnot(None), DataEvent.longitude.isnot(None)).all()
+    return PointIndex([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+                      [r[3] or "anomaly" for r in rows], [r[4] or 0 for r in rows])
+
+# --- protobuf encoding -------------------------------------------------------
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def _field(num, wire, payload):
+    key = _varint((num << 3) | wire)
+    if wire == 2:
+        return key + _varint(len(payload)) + payload
+    return key + payload
+
+def _value(v):
+    if isinstance(v, bool):
+        return _field(7, 0, _varint(int(v)))
+    if isinstance(v, int):
+        return _field(6, 0, _varint(_zigzag(v))) if v < 0 else _field(5, 0, _varint(v))
+    if isinstance(v, float):
+        return _field(3, 1, struct.pack("<d", v))
+    return _field(1, 2, str(v).encode("utf-8"))
+
+def encode_layer(name, features, extent=EXTENT):
+    keys, key_idx, values, val_idx = [], {}, [], {}
+    body = bytearray()
+    for fid, x, y, props in features:
+        tags = []
+        for k, v in props.items():
+            if v is None:
+                continue
+            if k not in key_idx:
+                key_idx[k] = len(keys)
+                keys.append(k)
+            vk = (type(v).__name__, v)
+            if vk not in val_idx:
+                val_idx[vk] = len(values)
+                values.append(v)
+            tags += [key_idx[k], val_idx[vk]]
+        geom = _varint((1 & 0x7) | (1 << 3)) + _varint(_zigzag(x)) + _varint(_zigzag(y))  # MoveTo(1)
+        feat = (_field(1, 0, _varint(max(0, fid)))
+                + _field(2, 2, b"".join(_varint(t) for t in tags))
+                + _field(3, 0, _varint(1))  # POINT
+                + _field(4, 2, geom))
+        body += _field(2, 2, feat)
+    layer = (_field(15, 0, _varint(2)) + _field(1, 2, name.encode("utf-8")) + bytes(body)
+             + b"".join(_field(3, 2, k.encode("utf-8")) for k in keys)
+             + b"".join(_field(4, 2, _value(v)) for v in values)
+             + _field(5, 0, _varint(extent)))
+    return _field(3, 2, layer)
+
+def encode_tile(layers):
+    """layers: [(name, features)] -> MVT bytes. Empty layers are skipped."""
+    return b"".join(encode_layer(name, feats) for name, feats in layers if feats)
@@ -0,0 +1,178 @@
+import argparse
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+import schedule
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
+from database import Session, WorkerLease, ensure_schema
+
+# Background workers with leader election.
+# Ingestion, detection and forecasting each run as a role. A role only does
+# work while its process holds the role's row in worker_leases: the holder
+# renews expires_at every WORKER_LEASE_SEC / 3 from a heartbeat thread, and
+# any other process may take the row over once it has expired. Acquire and
+# renew are a single conditional UPDATE (plus an INSERT for the first claim),
+# so this works the same on SQLite and Postgres without advisory locks.
+#
+# Roles run either as dedicated processes:
+#   python worker.py ingest detect forecast
+# or embedded in the API (EMBEDDED_WORKERS, see main.py). Embedded roles are
+# guarded by the same lease, so N uvicorn workers still run one copy of each.
+# Role modules (scikit-learn for detection) are imported on first leadership,
+# not at API import time.
+#
+# Configuration (env): WORKER_LEASE_SEC (30), WORKER_ID (host:pid)
+
+LEASE_SEC = float(os.getenv("WORKER_LEASE_SEC", "30") or 30)
+
+def worker_id():
+    # Evaluated per call so processes forked after import get their own id
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+def _ingest():
+    from ingestion import run_ingestion
+    return run_ingestion
+
+def _detect():
+    from anomaly import detect_anomalies
+    return detect_anomalies
+
+def _forecast():
+    from forecast import run_forecast
+    return run_forecast
+
+def _forecast_interval():
+    from forecast import INTERVAL_SEC
+    return INTERVAL_SEC
+
+# role -> (job loader, interval in seconds, run immediately on leadership)
+ROLES = {
+    "ingest": (_ingest, lambda: 30, False),
+    "detect": (_detect, lambda: 60, False),
+    "forecast": (_forecast, _forecast_interval, True),
+}
+
+def acquire_lease(name, holder=None, ttl=LEASE_SEC):
+    """Take or renew the lease on `name`; True when `holder` owns it afterwards."""
+    holder = holder or worker_id()
+    now = datetime.utcnow()
+    with Session() as session:
+        n = session.query(WorkerLease).filter(
+            WorkerLease.name == name, or_(WorkerLease.holder == holder, WorkerLease.expires_at < now)
+        ).update({"holder": holder, "expires_at": now + timedelta(seconds=ttl),
+                  "acquired_at": case((WorkerLease.holder == holder, WorkerLease.acquired_at), else_=now)}, synchronize_session=False)
+        if n:
+            session.commit()
+            return True
+        try:
+            session.add(WorkerLease(name=name, holder=holder, acquired_at=now, expires_at=now + timedelta(seconds=ttl)))
+            session.commit()
+            return True
+        except IntegrityError:
+            session.rollback()
+            return False
+
+def release_lease(name, holder=None):
+    holder = holder or worker_id()
+    with Session() as session:
+        session.query(WorkerLease).filter(WorkerLease.name == name, WorkerLease.holder == holder).update(
+            {"expires_at": datetime.utcnow()}, synchronize_session=False)
+        session.commit()
+
+def lease_status():
+    now, me = datetime.utcnow(), worker_id()
+    with Session() as session:
+        return [{"role": l.name, "holder": l.holder, "self": l.holder == me, "live": bool(l.expires_at and l.expires_at > now),
+                 "acquired_at": l.acquired_at.isoformat() if l.acquired_at else None,
+                 "expires_at": l.expires_at.isoformat() if l.expires_at else None}
+                for l in session.query(WorkerLease).order_by(WorkerLease.name).all()]
+
+class RoleRunner:
+    """Runs one role's schedule while this process holds its lease."""
+
+    def __init__(self, role, holder=None):
+        self.role = role
+        self.holder = holder or worker_id()
+        self.leader = False
+        self.stop = threading.Event()
+        self._scheduler = None
+
+    def _heartbeat(self):
+        while not self.stop.is_set():
+            try:
+                held = acquire_lease(self.role, self.holder)
+            except Exception as e:
+                print(f"Worker {self.role}: lease check failed: {e}")
+                held = False
+            if held != self.leader:
+                print(f"Worker {self.role}: {'acquired' if held else 'lost'} leadership ({self.holder})")
+                self.leader = held
+            self.stop.wait(LEASE_SEC / 3.0)
+
+    def _start_jobs(self):
+        load, interval, eager = ROLES[self.role]
+        job = load()
+        self._scheduler = schedule.Scheduler()
+        self._scheduler.every(interval()).seconds.do(job)
+        if eager:
+            job()
+
+    def run(self):
+        beat = threading.Thread(target=self._heartbeat, name=f"lease-{self.role}", daemon=True)
+        beat.start()
+        try:
+            while not self.stop.is_set():
+                if self.leader:
+                    try:
+                        if self._scheduler is None:
+                            self._start_jobs()
+                        self._scheduler.run_pending()
+                    except Exception as e:
+                        print(f"Worker {self.role}: job failed: {e}")
+                elif self._scheduler is not None:
+                    # Another process took over; start from a fresh schedule if we win it back
+                    self._scheduler = None
+                self.stop.wait(1)
+        finally:
+            self.stop.set()
+            beat.join(LEASE_SEC)  # so a last renewal cannot land after the release
+            if self.leader:
+                release_lease(self.role, self.holder)
+                self.leader = False
+
+def start_embedded(roles):
+    """Start lease-guarded role runners as daemon threads; returns the runners."""
+    runners = []
+    for role in roles:
+        if role not in ROLES:
+            print(f"Worker: unknown role {role!r}")
+            continue
+        r = RoleRunner(role)
+        threading.Thread(target=r.run, name=f"worker-{role}", daemon=True).start()
+        runners.append(r)
+    return runners
+
+def main():
+    parser = argparse.ArgumentParser(description="RTAIP background worker")
+    parser.add_argument("roles", nargs="+", choices=sorted(ROLES) + ["all"])
+    args = parser.parse_args()
+    roles = sorted(ROLES) if "all" in args.roles else list(dict.fromkeys(args.roles))
+    ensure_schema()
+    runners = [RoleRunner(role) for role in roles]
+    threads = [threading.Thread(target=r.run, name=f"worker-{r.role}") for r in runners]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for r in runners:
+            r.stop.set()
+        for t in threads:
+            t.join(LEASE_SEC)
+
+if __name__ == "__main__":
+    main()
@@ -67,7 +67,7 @@ const AlertBar = ({ anomalies }) => {
       })
         .then(res => res.json())
         .then(resp => {
-          if (resp.status === 'sent') {
+          if (resp.status === 'sent' || resp.status === 'queued') {
             sentIdsRef.current.add(anom.id);
           } else {
             console.warn('Email notify error', resp);